@@ -15,3 +15,7 @@ class AppConfig(object):
 
     def __getitem__(self, item):
         return self.app_config[item]
+
+    def get(self, section, key, default = None):
+        # Optional settings, older config files do not have every section
+        return self.app_config.get(section, {}).get(key, default)
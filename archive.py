@@ -0,0 +1,178 @@
+import threading, zlib
+from collections import OrderedDict
+from bson import Binary
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+from appconfig import AppConfig
+from logger import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DUPLICATE_KEY = 11000
+
+class RawArchive(object):
+    """
+    Compressed archive of the raw P1 telegrams
+
+    Most lines of a telegram are the same from one reading to the next, so every
+    meter has a keyframe: a telegram stored on its own. The following telegrams
+    are compressed with that keyframe as preset dictionary, which leaves little
+    more than the changed registers. A new keyframe is written every
+    keyframe_interval telegrams of a meter.
+
+    {_id, signature, createdAt, codec, base, z}, base is None for a keyframe and
+    the _id of the keyframe otherwise.
+    """
+    def __init__(self, db, config: AppConfig, name = 'smart_meter_data_archive'):
+        self.collection = db[name]
+        self.collection.create_index([('signature', ASCENDING), ('createdAt', ASCENDING)])
+        self.keyframe_interval = config.get('archive', 'keyframe_interval', 1000)
+        self.level = config.get('archive', 'level', 6)
+        self.codec = config.get('archive', 'codec', 'zlib')
+        if self.codec == 'zstd' and zstandard == None:
+            logger.warning(msg="zstandard is not installed, archive uses zlib")
+            self.codec = 'zlib'
+
+        # signature -> [keyframe _id, keyframe telegram, telegrams since], for at most max_meters meters
+        self.max_meters = config.get('archive', 'max_meters', 100000)
+        self._keyframes = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Reader side: keyframe _id -> telegram
+        self._bases = OrderedDict()
+        self._bases_size = 1024
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _compress(self, codec, data, base):
+        if codec == 'zstd':
+            dictionary = zstandard.ZstdCompressionDict(base, dict_type=zstandard.DICT_TYPE_RAWCONTENT) if base else None
+            return zstandard.ZstdCompressor(level=self.level, dict_data=dictionary).compress(data)
+        if base:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=base)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def _decompress(codec, data, base):
+        if codec == 'zstd':
+            dictionary = zstandard.ZstdCompressionDict(base, dict_type=zstandard.DICT_TYPE_RAWCONTENT) if base else None
+            return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data)
+        if base:
+            decompressor = zlib.decompressobj(-15, zdict=base)
+        else:
+            decompressor = zlib.decompressobj(-15)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def _encode(self, envelope, keyframe):
+        data = envelope.p1.encode()
+        if keyframe:
+            z = self._compress(self.codec, data, None)
+            base = None
+        else:
+            state = self._keyframes[envelope.signature]
+            z = self._compress(self.codec, data, state[1])
+            base = state[0]
+        self.bytes_in += len(data)
+        self.bytes_out += len(z)
+        return {
+            '_id': envelope._id,
+            'signature': envelope.signature,
+            'createdAt': envelope.createdAt,
+            'codec': self.codec,
+            'base': base,
+            'z': Binary(z)
+        }
+
+    def insert(self, batch):
+        """
+        Returns the number of telegrams that could not be stored
+        """
+        with self._lock:
+            keyframes = []
+            others = []
+            created = []
+            for envelope in batch:
+                state = self._keyframes.get(envelope.signature)
+                if state == None or state[2] >= self.keyframe_interval:
+                    keyframes.append(self._encode(envelope, True))
+                    self._keyframes[envelope.signature] = [envelope._id, envelope.p1.encode(), 0]
+                    created.append(envelope.signature)
+                else:
+                    others.append(self._encode(envelope, False))
+                    state[2] += 1
+                self._keyframes.move_to_end(envelope.signature)
+            while len(self._keyframes) > self.max_meters:
+                self._keyframes.popitem(last=False)
+
+            try:
+                # Keyframes first, a telegram is never stored before its keyframe
+                rejected = set(self._insert(keyframes))
+                dependents = []
+                if rejected:
+                    # Telegrams depending on a rejected keyframe would not be readable
+                    dependents = [document for document in others if document['base'] in rejected]
+                    others = [document for document in others if document['base'] not in rejected]
+                    for document in keyframes:
+                        if document['_id'] in rejected:
+                            self._keyframes.pop(document['signature'], None)
+                return len(rejected) + len(dependents) + len(self._insert(others))
+            except Exception:
+                # A retry of this batch has to write the same keyframes again
+                for signature in created:
+                    self._keyframes.pop(signature, None)
+                raise
+
+    def _insert(self, documents):
+        # Returns the _ids of rejected documents, duplicates are from an earlier attempt
+        if not documents:
+            return []
+        try:
+            self.collection.insert_many(documents, ordered=False)
+            return []
+        except BulkWriteError as e:
+            errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY]
+            if errors:
+                logger.error(msg="Insert into {0}: {1} documents rejected, first: {2}".format(self.collection.name, len(errors), errors[0]['errmsg']))
+            return [documents[error['index']]['_id'] for error in errors]
+
+    def p1(self, document):
+        """
+        The original telegram of an archive document
+        """
+        base = None
+        if document['base'] != None:
+            base = self._bases.get(document['base'])
+            if base == None:
+                keyframe = self.collection.find_one({'_id': document['base']})
+                base = self._decompress(keyframe['codec'], keyframe['z'], None)
+                self._bases[document['base']] = base
+                if len(self._bases) > self._bases_size:
+                    self._bases.popitem(last=False)
+            else:
+                self._bases.move_to_end(document['base'])
+        return self._decompress(document['codec'], document['z'], base).decode()
+
+    def read(self, signature, start, end):
+        """
+        Telegrams of one meter with start <= createdAt < end, oldest first
+        """
+        for document in self.collection.find({'signature': signature, 'createdAt': {'$gte': start, '$lt': end}}).sort('createdAt', ASCENDING):
+            yield {
+                '_id': document['_id'],
+                'signature': document['signature'],
+                'createdAt': document['createdAt'],
+                'p1': self.p1(document)
+            }
+
+    def stats(self):
+        return {
+            'archive_bytes_in': self.bytes_in,
+            'archive_bytes_out': self.bytes_out,
+            'archive_ratio': self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+        }
@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+"""
+Benchmarks of the ingest pipeline
+
+    python3 benchmark.py parser                   run and compare with the baseline
+    python3 benchmark.py parser --save            run and store as the new baseline
+    python3 benchmark.py parser --engine obis --repeat 10
+    python3 benchmark.py query --meters 200 --readings 500
+    python3 benchmark.py codecs
+    python3 benchmark.py columnar --telegrams 20000 --workers 4
+    python3 benchmark.py detect
+
+Throughput is stored relative to a fixed pure Python calibration loop that runs
+alongside every benchmark, so a baseline made on one machine still means
+something on another. A benchmark that is more than --tolerance slower than
+its baseline makes the run exit 1.
+"""
+import argparse, json, os, random, sys, time, tracemalloc
+from datetime import datetime, timedelta
+
+from dsmr import DSMR_Parser, Reading
+from telegram_generator import TelegramGenerator, VERSIONS
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+BASELINE_FILE = os.path.join(ROOT_DIR, 'benchmark_baseline.json')
+
+def CalibrationRun():
+    # Fixed pure Python workload, the unit the baselines are stored in
+    started = time.perf_counter()
+    total = 0
+    for value in range(50000):
+        total += len(str(value))
+    return time.perf_counter() - started
+
+def Measure(function, items, repeat):
+    """
+    Items per second and the same relative to the calibration workload, best of
+    repeat rounds. Every round runs the calibration right before the benchmark so
+    both see the same machine load.
+    """
+    best = None
+    best_calibration = None
+    for i in range(repeat):
+        calibration = CalibrationRun()
+        started = time.perf_counter()
+        for item in items:
+            function(item)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best == None or elapsed < best else best
+        best_calibration = calibration if best_calibration == None or calibration < best_calibration else best_calibration
+    rate = len(items) / best
+    return rate, rate / (50000 / best_calibration)
+
+def PeakBytes(function, items):
+    # Average peak of traced memory per call
+    tracemalloc.start()
+    total = 0
+    for item in items:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function(item)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / len(items)
+
+def SafeParse(engine):
+    def parse(telegram):
+        try:
+            return DSMR_Parser(telegram, engine).parse()
+        except Exception:
+            return None
+    return parse
+
+def Outcomes(engine, telegrams):
+    outcomes = {'decoded': 0, 'empty': 0, 'error': 0}
+    for telegram in telegrams:
+        try:
+            outcomes['decoded' if DSMR_Parser(telegram, engine).parse() else 'empty'] += 1
+        except Exception:
+            outcomes['error'] += 1
+    return outcomes
+
+def BenchParser(args):
+    generator = TelegramGenerator(seed = args.seed)
+    sets = {version: generator.mix(args.telegrams, versions = (version,)) for version in VERSIONS}
+    sets['corrupt'] = generator.mix(args.telegrams, corrupt_ratio = 1.0)
+    engines = ['regex', 'obis'] if args.engine == 'all' else [args.engine]
+
+    results = {}
+    for engine in engines:
+        parse = SafeParse(engine)
+        for name, telegrams in sets.items():
+            rate, relative = Measure(parse, telegrams, args.repeat)
+            results['parse.{0}.{1}'.format(engine, name)] = {
+                'rate': rate,
+                'relative': relative,
+                'peak_bytes': PeakBytes(parse, telegrams[:50]),
+                'outcomes': Outcomes(engine, telegrams)
+            }
+
+    # Serialization on its own, on telegrams every engine decodes
+    for name in ('30', '42', '50'):
+        data = [DSMR_Parser(telegram, 'obis').strategy.decode(telegram) for telegram in sets[name]]
+        readings = [Reading.FromData(item) for item in data]
+        for label, function, items in (('data_tojson', lambda item: item.ToJSON(), data),
+                                       ('reading_tojson', lambda item: item.ToJSON(), readings)):
+            rate, relative = Measure(function, items, args.repeat)
+            results['{0}.{1}'.format(label, name)] = {
+                'rate': rate,
+                'relative': relative,
+                'peak_bytes': PeakBytes(function, items[:50])
+            }
+    return results
+
+def BenchQuery(args):
+    """
+    Time range queries of one meter on the raw and decoded collections, without
+    and with the indexes of EnsureIndexes(), on a generated dataset in the
+    emon_benchmark database of the mongodb section (or mongomock, where indexes
+    change nothing)
+    """
+    from appconfig import AppConfig
+    from layouts import CreateLayout
+    import mongo
+
+    config = AppConfig()
+    config['mongodb']['database'] = 'emon_benchmark'
+    config['mongodb']['layout'] = 'document'
+    config['mongodb']['raw'] = 'document'
+    config['mongodb']['raw_ttl_days'] = 0
+    options = {}
+    if args.mongomock:
+        import mongomock
+        options['mongo_client_class'] = mongomock.MongoClient
+    mongo.connect(db = config['mongodb']['database'], host = config['mongodb']['host'], port = config['mongodb']['port'], **options)
+    db = mongo.get_db()
+    raw = db[mongo.SmartMeterDataRaw._get_collection_name()]
+    layout = CreateLayout(db, config)
+    raw.drop()
+    layout.collection.drop()
+
+    generator = TelegramGenerator(seed = args.seed)
+    start = datetime(2020, 2, 13)
+    for meter in range(args.meters):
+        batch = []
+        for index in range(args.readings):
+            telegram = generator.telegram('50')
+            envelope = mongo.Envelope(telegram, DSMR_Parser(telegram, 'obis').reading().ToCompact(), 'meter-{0:05d}'.format(meter), {}, {},
+                                      createdAt = start + timedelta(seconds = 10 * index))
+            batch.append(envelope)
+        raw.insert_many([mongo.RawFields(envelope) for envelope in batch])
+        layout.insert(batch)
+
+    rng = random.Random(args.seed)
+    span = timedelta(seconds = 10 * args.readings)
+    queries = []
+    for i in range(args.queries):
+        begin = start + rng.random() * (span - timedelta(hours = 1))
+        queries.append(('meter-{0:05d}'.format(rng.randrange(args.meters)), begin, begin + timedelta(hours = 1)))
+
+    def raw_query(query):
+        return sum(1 for document in mongo.RawReadings(db, query[0], query[1], query[2], fields = ['p1']))
+    def decoded_query(query):
+        return sum(1 for document in layout.read(query[0], query[1], query[2], fields = ['p1_decoded.pd']))
+
+    results = {}
+    for indexed in (False, True):
+        if indexed:
+            mongo.EnsureIndexes(db, config)
+        for name, function in (('raw', raw_query), ('decoded', decoded_query)):
+            rate, relative = Measure(function, queries, args.repeat)
+            results['query.{0}.{1}'.format(name, 'indexed' if indexed else 'scan')] = {
+                'rate': rate,
+                'relative': relative,
+                'peak_bytes': PeakBytes(function, queries[:20]),
+                'outcomes': {'documents': sum(function(query) for query in queries[:20]) // 20}
+            }
+    return results
+
+def BenchCodecs(args):
+    """
+    Decode cost per MQTT message for every installed payload codec
+    """
+    from payloads import CODECS
+
+    generator = TelegramGenerator(seed = args.seed)
+    messages = [{'datagram': {'p1': telegram, 'signature': 'gw-{0:04d}'.format(index % 100),
+                              's0': {'unit': 'W', 'value': 0}, 's1': {'unit': 'W', 'value': 0}}}
+                for index, telegram in enumerate(generator.mix(args.messages, versions = ('42', '50')))]
+
+    results = {}
+    for name, (decode, encode) in sorted(CODECS.items()):
+        payloads = [encode(message) for message in messages]
+        rate, relative = Measure(decode, payloads, args.repeat)
+        results['decode.{0}'.format(name)] = {
+            'rate': rate,
+            'relative': relative,
+            'peak_bytes': PeakBytes(decode, payloads[:50]),
+            'outcomes': {'bytes': sum(len(payload) for payload in payloads) // len(payloads)}
+        }
+    return results
+
+def BenchColumnar(args):
+    """
+    ParseMany into columns against DSMR_Parser(...).parse() per telegram, on the same telegrams
+    """
+    from columnar import ParseMany
+
+    generator = TelegramGenerator(seed = args.seed)
+    telegrams = generator.mix(args.telegrams, versions = ('42', '50'), corrupt_ratio = 0.05)
+    sample = telegrams[:50]
+
+    results = {}
+    for engine in ('regex', 'obis'):
+        parse = SafeParse(engine)
+        rate, relative = Measure(parse, telegrams, args.repeat)
+        results['loop.{0}'.format(engine)] = {
+            'rate': rate,
+            'relative': relative,
+            'peak_bytes': PeakBytes(parse, sample),
+            'outcomes': Outcomes(engine, telegrams)
+        }
+
+    for workers in sorted(set([1, args.workers])):
+        parse_many = lambda batch: ParseMany(batch, workers = workers, chunk_size = max(1, len(batch) // workers))
+        # Measure() counts calls, one call parses the whole batch
+        rate, relative = Measure(parse_many, [telegrams], args.repeat)
+        ok = int(parse_many(telegrams).ok.sum())
+        results['columnar.workers{0}'.format(workers)] = {
+            'rate': rate * len(telegrams),
+            'relative': relative * len(telegrams),
+            'peak_bytes': PeakBytes(parse_many, [sample]) / len(sample),
+            'outcomes': {'decoded': ok, 'rejected': len(telegrams) - ok}
+        }
+    return results
+
+def BenchDetect(args):
+    """
+    Strategy selection of DSMR_Parser per DSMR version, detected for every telegram and cached per meter
+    """
+    from dsmr import StrategyCache
+    import dsmr
+
+    generator = TelegramGenerator(seed = args.seed)
+    results = {}
+    for version in VERSIONS:
+        # A meter sends the same header line every time, the generator picks one per telegram
+        headers = {}
+        items = []
+        for index, telegram in enumerate(generator.mix(args.telegrams, versions = (version,))):
+            signature = 'meter-{0:04d}'.format(index % args.meters)
+            header, body = telegram.split('\n', 1)
+            items.append((headers.setdefault(signature, header) + '\n' + body, signature))
+        dsmr.STRATEGY_CACHE = StrategyCache()
+        # Meters are cached once a telegram of theirs decoded
+        for telegram, signature in items[:args.meters]:
+            DSMR_Parser(telegram, signature = signature).reading()
+
+        detect = lambda item: DSMR_Parser(item[0])
+        cached = lambda item: DSMR_Parser(item[0], signature = item[1])
+        for label, function in (('detect', detect), ('cached', cached)):
+            rate, relative = Measure(function, items, args.repeat)
+            results['{0}.{1}'.format(label, version)] = {
+                'rate': rate,
+                'relative': relative,
+                'peak_bytes': PeakBytes(function, items[:50])
+            }
+        results['cached.{0}'.format(version)]['outcomes'] = dict((key[len('parser_cache_'):], value) for key, value in dsmr.STRATEGY_CACHE.stats().items())
+    return results
+
+def Compare(results, baseline, tolerance):
+    """
+    Print the results against the baseline, returns the names that regressed
+    """
+    regressed = []
+    print('{0:<28} {1:>12} {2:>10} {3:>10}  {4}'.format('benchmark', 'per second', 'peak B', 'vs base', 'outcomes'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        change = ''
+        if base != None:
+            ratio = result['relative'] / base['relative']
+            change = '{0:+.1%}'.format(ratio - 1.0)
+            if ratio < 1.0 - tolerance:
+                regressed.append(name)
+                change += ' !'
+        outcomes = ' '.join('{0}={1}'.format(key, value) for key, value in result.get('outcomes', {}).items())
+        print('{0:<28} {1:>12.0f} {2:>10.0f} {3:>10}  {4}'.format(name, result['rate'], result['peak_bytes'], change, outcomes))
+    return regressed
+
+def LoadBaseline():
+    try:
+        with open(BASELINE_FILE) as baseline:
+            return json.load(baseline)
+    except FileNotFoundError:
+        return {}
+
+def SaveBaseline(section, results):
+    baselines = LoadBaseline()
+    baselines[section] = results
+    with open(BASELINE_FILE, 'w') as baseline:
+        json.dump(baselines, baseline, indent=2, sort_keys=True)
+        baseline.write('\n')
+
+BENCHMARKS = {
+    'parser': BenchParser,
+    'query': BenchQuery,
+    'codecs': BenchCodecs,
+    'columnar': BenchColumnar,
+    'detect': BenchDetect
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ingest pipeline benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('parser', help="DSMR_Parser throughput and memory per DSMR version")
+    command.add_argument('--engine', choices=['regex', 'obis', 'all'], default='all')
+    command.add_argument('--telegrams', type=int, default=500, help="telegrams per version")
+    command.add_argument('--repeat', type=int, default=10)
+    command.add_argument('--seed', type=int, default=1)
+
+    command = commands.add_parser('query', help="time range query latency without and with the indexes")
+    command.add_argument('--meters', type=int, default=200)
+    command.add_argument('--readings', type=int, default=500, help="readings per meter, 10 s apart")
+    command.add_argument('--queries', type=int, default=200, help="one hour ranges of random meters")
+    command.add_argument('--repeat', type=int, default=3)
+    command.add_argument('--seed', type=int, default=1)
+    command.add_argument('--mongomock', action='store_true', help="in-memory mongomock instead of mongod")
+
+    command = commands.add_parser('codecs', help="MQTT payload decode cost per installed codec")
+    command.add_argument('--messages', type=int, default=2000)
+    command.add_argument('--repeat', type=int, default=10)
+    command.add_argument('--seed', type=int, default=1)
+
+    command = commands.add_parser('columnar', help="batch parsing into NumPy columns against the parser per telegram")
+    command.add_argument('--telegrams', type=int, default=5000)
+    command.add_argument('--repeat', type=int, default=5)
+    command.add_argument('--seed', type=int, default=1)
+    command.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="processes of the ParseMany run with workers")
+
+    command = commands.add_parser('detect', help="DSMR version detection against the per meter strategy cache")
+    command.add_argument('--telegrams', type=int, default=2000, help="telegrams per version")
+    command.add_argument('--meters', type=int, default=100, help="meters the telegrams are spread over")
+    command.add_argument('--repeat', type=int, default=10)
+    command.add_argument('--seed', type=int, default=1)
+
+    for command in commands.choices.values():
+        command.add_argument('--save', action='store_true', help="store the results as the new baseline")
+        command.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = BENCHMARKS[args.command](args)
+    baseline = LoadBaseline().get(args.command, {})
+    regressed = Compare(results, baseline, args.tolerance)
+    if args.save:
+        SaveBaseline(args.command, results)
+        print('Baseline saved to {0}'.format(BASELINE_FILE))
+    elif regressed:
+        print('Slower than the baseline: {0}'.format(', '.join(regressed)))
+        sys.exit(1)
@@ -0,0 +1,180 @@
+"""
+Batch parsing of P1 telegrams into columns
+
+    columns = ParseMany(telegrams, workers = 4)
+    columns.values['power_delivered'][columns.valid['power_delivered']]
+
+One column per attribute of the OBIS_TABLES, the same field definitions the
+'obis' engine uses, typed by their pattern: float64 for values with a unit,
+int64 for counters and object for ids and versions. valid holds a bool per
+value, ok a bool per telegram: False where DSMR_OBIS would fail or finds no
+DSMR version, all values of such a row are invalid.
+
+Telegrams are tokenized one by one, values are matched per version and column
+with one regular expression and converted by numpy, there is no Data, Reading or dict per telegram.
+"""
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dsmr import OBIS_TABLES, OBIS_INT, MANUFACTURER, TokenizeDatagram, DetectVersion
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _columns():
+    # Union of the tables in table order, with the dtype of its pattern
+    columns = [('manufacturer', 'O')]
+    seen = set(['manufacturer'])
+    for table in OBIS_TABLES.values():
+        for field in table:
+            if field.attribute in seen:
+                continue
+            seen.add(field.attribute)
+            if field.unit:
+                columns.append((field.attribute, 'f8'))
+            elif field.pattern is OBIS_INT:
+                columns.append((field.attribute, 'i8'))
+            else:
+                columns.append((field.attribute, 'O'))
+    return columns
+
+COLUMNS = _columns()
+NUMERIC = set(name for name, dtype in COLUMNS if dtype != 'O')
+
+class Columns(object):
+    """
+    values and valid are structured arrays with a field per column, ok a bool per telegram
+    """
+    __slots__ = ('values', 'valid', 'ok')
+
+    def __init__(self, values, valid, ok):
+        self.values = values
+        self.valid = valid
+        self.ok = ok
+
+    def __len__(self):
+        return len(self.ok)
+
+    def masked(self, name):
+        """
+        One column as a numpy masked array, invalid values masked
+        """
+        return numpy.ma.MaskedArray(self.values[name], ~self.valid[name])
+
+    def ToDict(self):
+        """
+        {column: typed array} with {column + '_valid': bool array}, as pandas or pyarrow take it
+        """
+        columns = {}
+        for name, dtype in COLUMNS:
+            columns[name] = self.values[name]
+            columns[name + '_valid'] = self.valid[name]
+        return columns
+
+_COLUMN_PATTERNS = {}
+
+def _column_pattern(pattern):
+    # pattern.fullmatch() per line of a column joined by newlines, values hold no newlines
+    column_pattern = _COLUMN_PATTERNS.get(pattern)
+    if column_pattern == None:
+        column_pattern = _COLUMN_PATTERNS[pattern] = re.compile(r'^(?:{0})$|^.*$'.format(pattern.pattern), re.MULTILINE)
+    return column_pattern
+
+def _convert(strings, kind, present):
+    convert = float if kind == numpy.float64 else int
+    values = numpy.zeros(len(strings), dtype=kind)
+    present = present.copy()
+    for row, value in enumerate(strings):
+        try:
+            values[row] = convert(value)
+        except ValueError:
+            present[row] = False
+    return values, present
+
+def ParseChunk(telegrams):
+    """
+    Columns of a list of telegrams, runs in the worker processes of ParseMany()
+    """
+    count = len(telegrams)
+    values = numpy.zeros(count, dtype=numpy.dtype(COLUMNS))
+    valid = numpy.zeros(count, dtype=numpy.dtype([(name, bool) for name, kind in COLUMNS]))
+    ok = numpy.zeros(count, dtype=bool)
+
+    # Tokenize per telegram, then match and convert per version and column
+    groups = {}
+    for row, datagram in enumerate(telegrams):
+        if not isinstance(datagram, str):
+            continue
+        tokens = TokenizeDatagram(datagram)
+        version = DetectVersion(tokens)
+        if version == None:
+            continue
+        header_end = datagram.find('\n')
+        result = MANUFACTURER.search(datagram, 0, header_end if header_end >= 0 else len(datagram))
+        if result == None:
+            result = MANUFACTURER.search(datagram)
+        if result == None:
+            continue
+        group = groups.get(version)
+        if group == None:
+            group = groups[version] = ([], [], [], [field.obis for field in OBIS_TABLES[version]])
+        group[0].append(row)
+        group[1].append(result.group(1))
+        # The values of a telegram while its tokens are at hand, a row per telegram
+        group[2].append([tokens.get(obis, '') for obis in group[3]])
+
+    for version, (rows, manufacturers, table, codes) in groups.items():
+        rows = numpy.array(rows)
+        matched = {}
+        good = numpy.ones(len(rows), dtype=bool)
+        for field, column in zip(OBIS_TABLES[version], zip(*table)):
+            # One search over the whole column: the value of each line where it matches, '' where not
+            column = '\n'.join(column)
+            # findall() gives tuples for patterns with more groups, the value is the first
+            strings = numpy.array(_column_pattern(field.pattern).findall(column), dtype=str).reshape(len(rows), -1)[:, 0]
+            present = strings != ''
+            if field.required:
+                good &= present
+            matched[field.attribute] = (strings, present)
+
+        ok[rows] = good
+        valid['manufacturer'][rows] = good
+        values['manufacturer'][rows] = numpy.array(manufacturers, dtype=object)
+        if 'version' not in matched:
+            valid['version'][rows] = good
+            values['version'][rows] = version
+        for name, (strings, present) in matched.items():
+            kind = values.dtype[name]
+            if name in NUMERIC:
+                # One vectorised conversion per column, missing values become 0
+                strings[~present] = '0'
+                try:
+                    converted = strings.astype(kind)
+                except ValueError:
+                    # A value like '.' matches the pattern but is no number
+                    converted, present = _convert(strings, kind, present)
+                values[name][rows] = converted
+            else:
+                values[name][rows] = strings.astype(object)
+            valid[name][rows] = present & good
+    return values, valid, ok
+
+def ParseMany(telegrams, workers = 1, chunk_size = 20000):
+    """
+    Columns of many telegrams, chunks of chunk_size parsed in workers processes
+    """
+    if numpy == None:
+        raise RuntimeError("ParseMany needs numpy")
+    telegrams = list(telegrams)
+    chunks = [telegrams[start:start + chunk_size] for start in range(0, len(telegrams), chunk_size)] or [[]]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            parts = list(executor.map(ParseChunk, chunks))
+    else:
+        parts = [ParseChunk(chunk) for chunk in chunks]
+    if len(parts) == 1:
+        return Columns(*parts[0])
+    return Columns(numpy.concatenate([part[0] for part in parts]),
+                   numpy.concatenate([part[1] for part in parts]),
+                   numpy.concatenate([part[2] for part in parts]))
@@ -0,0 +1,98 @@
+"""
+CRC16 check of P1 telegrams
+
+DSMR 4.0 and later end a telegram with '!' and the CRC16/ARC of everything from
+the '/' up to and including the '!', as four hex digits. DSMR 2.2 and 3.0 have
+no CRC, their telegrams are only checked for a header and a footer.
+"""
+import struct
+
+try:
+    # C implementation when it is installed
+    import crcmod.predefined
+    _crc_arc = crcmod.predefined.mkCrcFun('arc')
+except ImportError:
+    _crc_arc = None
+
+# Reason codes, also stored with quarantined telegrams
+NO_HEADER = 'no_header'
+NO_FOOTER = 'no_footer'
+CRC_MISSING = 'crc_missing'
+BAD_CRC = 'bad_crc'
+NOT_TEXT = 'not_text'
+
+def _table():
+    # CRC16/ARC: polynomial 0x8005 reflected (0xA001), initial value 0
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _table()
+
+# Two bytes per lookup: with a 16 bit register the next value only depends on
+# crc ^ word. 64K entries, built on first use.
+_table16 = None
+
+def _build_table16():
+    global _table16
+    table = CRC16_TABLE
+    table16 = [0] * 65536
+    for value in range(65536):
+        crc = (value >> 8) ^ table[value & 0xFF]
+        table16[value] = (crc >> 8) ^ table[crc & 0xFF]
+    _table16 = table16
+
+def Crc16(data: bytes, crc = 0):
+    """
+    CRC16/ARC of data, crc continues an earlier call
+    """
+    if _crc_arc != None and crc == 0:
+        return _crc_arc(data)
+    if _table16 == None:
+        _build_table16()
+    table16 = _table16
+    for word in struct.unpack_from('<{0}H'.format(len(data) // 2), data):
+        crc = table16[crc ^ word]
+    if len(data) & 1:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ data[-1]) & 0xFF]
+    return crc
+
+def CheckTelegram(p1):
+    """
+    None for a telegram that can be parsed, else the reason code
+    """
+    if not isinstance(p1, str):
+        return NOT_TEXT
+    start = p1.find('/')
+    if start < 0 or p1[:start].strip():
+        return NO_HEADER
+    end = p1.rfind('!')
+    if end < start:
+        return NO_FOOTER
+    crc = p1[end + 1:end + 5]
+    if len(crc) < 4 or not all(c in '0123456789ABCDEFabcdef' for c in crc):
+        if '1-3:0.2.8(' in p1:
+            # DSMR 4.x/5.0 always send the CRC, the frame was cut off
+            return CRC_MISSING
+        return None
+    try:
+        frame = p1[start:end + 1].encode('ascii')
+    except UnicodeEncodeError:
+        return BAD_CRC
+    expected = int(crc, 16)
+    if Crc16(frame) == expected:
+        return None
+    if b'\r' not in frame and Crc16(frame.replace(b'\n', b'\r\n')) == expected:
+        # Gateway that stripped the carriage returns, the content is intact
+        return None
+    return BAD_CRC
+
+def CheckBatch(telegrams):
+    """
+    CheckTelegram for a list of telegrams, for backfills
+    """
+    return [CheckTelegram(p1) for p1 in telegrams]
@@ -1,23 +1,34 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
 import re
 import json
+import threading
 
 class DSMR_Parser(object):
     """
     P1 datagram parser for Dutch Smart Meter Readings
+
+    engine 'regex' selects a strategy per DSMR version, engine 'obis' uses the
+    single pass OBIS tokenizer for every version.
     """
-    def __init__(self, datagram) -> None:
-        self._strategy = DSMR_UNKNOWN()
+    def __init__(self, datagram, engine = 'regex', signature = None) -> None:
         self._datagram = datagram
-        if re.search(r'1-3:0\.2\.8\(42\)', self._datagram) != None:
-            self._strategy = DSMR_41()
-        elif re.search(r'1-3:0\.2\.8\(50\)', self._datagram) != None:
-            self._strategy = DSMR_50()
-        elif re.search(r'0-0:96\.1\.1(\(([a-zA-Z0-9]{1,96})\))', self._datagram).group(2) != "":
-            self._strategy = DSMR_3()
-        elif re.search(r'0-0:42\.0\.0(\(([a-zA-Z0-9]{1,96})\))', self._datagram).group(2) != "":
-            self._strategy = DSMR_22()
+        self._cached = False
+        # Meter of a detected version, cached once the telegram decodes
+        self._signature = None
+        self._version = None
+        if engine == 'obis':
+            self._strategy = STRATEGIES['obis']
+            return
+        if signature != None:
+            # Known meters skip the version detection
+            self._version = STRATEGY_CACHE.lookup(signature, datagram)
+            self._cached = self._version != None
+            self._signature = signature
+        if not self._cached:
+            self._version = DetectStrategy(datagram)
+        self._strategy = STRATEGIES[self._version]
 
     @property
     def strategy(self) -> Strategy:
@@ -36,7 +47,37 @@ class DSMR_Parser(object):
     #     self._datagram = datagram
 
     def parse(self) -> ():
-        return self._strategy.parse(self._datagram)
+        data = self._decode()
+        return data.ToJSON() if data != None else {}
+
+    def reading(self) -> Reading:
+        # Typed reading, None for an unknown DSMR version
+        data = self._decode()
+        return Reading.FromData(data) if data != None else None
+
+    def _decode(self):
+        try:
+            data = self._strategy.decode(self._datagram)
+        except Exception:
+            if not self._cached:
+                raise
+            # A broken telegram of a known meter, fails the same way as without the cache
+            self._cached = False
+            self._version = DetectStrategy(self._datagram)
+            self._strategy = STRATEGIES[self._version]
+            data = self._strategy.decode(self._datagram)
+        if data != None and self._signature != None and not self._cached:
+            STRATEGY_CACHE.store(self._signature, self._datagram, self._version)
+        return data
+
+def DecodeDatagram(datagram, engine = 'regex', encoding = 'nested', signature = None):
+    """
+    p1_decoded of a telegram in the 'nested' or 'compact' shape
+    """
+    reading = DSMR_Parser(datagram, engine, signature).reading()
+    if reading == None:
+        return {}
+    return reading.ToCompact() if encoding == 'compact' else reading.ToJSON()
 
 def SafeSearch(pattern, datagram):
     result = re.search(pattern, datagram)
@@ -66,15 +107,19 @@ def SafeConversionFloat(value):
 
 class Strategy(ABC):
     @abstractmethod
-    def parse(self, datagram):
+    def decode(self, datagram) -> Data:
         pass
 
-class DSMR_UNKNOWN(Strategy):
     def parse(self, datagram):
-        return {}
+        data = self.decode(datagram)
+        return data.ToJSON() if data != None else {}
+
+class DSMR_UNKNOWN(Strategy):
+    def decode(self, datagram):
+        return None
 
 class DSMR_22(Strategy):
-    def parse(self, datagram):
+    def decode(self, datagram):
         #print("entered dsmr 22")
         data = Data()
         # info
@@ -84,7 +129,7 @@ class DSMR_22(Strategy):
         data.manufacturer = re.search(r'([a-zA-Z]{3}[0-9]([\\]*)([0-9a-zA-Z .-]+))', datagram).group(1)
 
         # Power DELIVERED by client
-        data.power_delivered = "NAN"
+        data.power_delivered = ("NAN", "NAN")
 
         # Power RECEIVED by client
         data.power_received = re.search(r'1-0:1\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram).group(1,2)
@@ -103,11 +148,10 @@ class DSMR_22(Strategy):
         # Equipment ID
         data.equipment_id = re.search(r'0-0:42\.0\.0(\(([a-zA-Z0-9]{1,96})\))', datagram).group(2)
 
-        # Bundle all in dictionary
-        return data.ToJSON()
+        return data
 
 class DSMR_3(Strategy):
-    def parse(self, datagram):
+    def decode(self, datagram):
         #print("entered dsmr 3")
         data = Data()
         # info
@@ -136,11 +180,10 @@ class DSMR_3(Strategy):
         # Equipment ID
         data.equipment_id = re.search(r'0-0:96\.1\.1(\(([a-zA-Z0-9]{1,96})\))', datagram).group(2)
 
-        # Bundle all in dictionary
-        return data.ToJSON()
+        return data
 
 class DSMR_41(Strategy):
-    def parse(self, datagram):
+    def decode(self, datagram):
         #print("entered dsmr 42")
         data = Data()
         # info
@@ -193,6 +236,15 @@ class DSMR_41(Strategy):
         # Number of voltage swells in phase L3
         data.voltage_swells_L3 = SafeSearch(r'1-0:72\.36\.0\(([0-9]*)\)', datagram)
 
+        # Instantaneous voltage L1
+        data.instantaneous_voltage_L1 = SafeUnitSearch(r'1-0:32\.7\.0\(([0-9]*\.[0-9]*)\*(V)\)', datagram)
+
+        # Instantaneous voltage L2
+        data.instantaneous_voltage_L2 = SafeUnitSearch(r'1-0:52\.7\.0\(([0-9]*\.[0-9]*)\*(V)\)', datagram)
+
+        # Instantaneous voltage L3
+        data.instantaneous_voltage_L3 = SafeUnitSearch(r'1-0:72\.7\.0\(([0-9]*\.[0-9]*)\*(V)\)', datagram)
+
         # Instantaneous current L1
         data.instantaneous_current_L1 = SafeUnitSearch(r'1-0:31\.7\.0\(([0-9]*)\*(A)\)', datagram)
 
@@ -209,7 +261,7 @@ class DSMR_41(Strategy):
         data.instantaneous_active_power_L2_positive = SafeUnitSearch(r'1-0:41\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)
 
         # Instantaneous active power L3 +P
-        data.instantaneous_active_power_L3_positive = SafeUnitSearch(r'1-0:41\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)
+        data.instantaneous_active_power_L3_positive = SafeUnitSearch(r'1-0:61\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)
 
         # Instantaneous active power L1 -P
         data.instantaneous_active_power_L1_negative = SafeUnitSearch(r'1-0:22\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)  
@@ -219,11 +271,10 @@ class DSMR_41(Strategy):
 
         # Instantaneous active power L3 -P
         data.instantaneous_active_power_L3_negative = SafeUnitSearch(r'1-0:62\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)
-        # Bundle all in dictionary
-        return data.ToJSON()
+        return data
 
 class DSMR_50(Strategy):
-    def parse(self, datagram):
+    def decode(self, datagram):
         #print("entered dsmr 5")
         data = Data()
         # info
@@ -301,7 +352,7 @@ class DSMR_50(Strategy):
         data.instantaneous_active_power_L2_positive = SafeUnitSearch(r'1-0:41\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)
 
         # Instantaneous active power L3 +P
-        data.instantaneous_active_power_L3_positive = SafeUnitSearch(r'1-0:41\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)
+        data.instantaneous_active_power_L3_positive = SafeUnitSearch(r'1-0:61\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)
 
         # Instantaneous active power L1 -P
         data.instantaneous_active_power_L1_negative = SafeUnitSearch(r'1-0:22\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)  
@@ -312,8 +363,264 @@ class DSMR_50(Strategy):
         # Instantaneous active power L3 -P
         data.instantaneous_active_power_L3_negative = SafeUnitSearch(r'1-0:62\.7\.0\(([0-9]*\.[0-9]*)\*(kW)\)', datagram)  
 
-        # Bundle all in dictionary
-        return data.ToJSON()
+        return data
+
+#
+# Single pass OBIS engine
+#
+# The regex strategies above scan the complete telegram once per field. The
+# OBIS engine splits the telegram into 'OBIS code -> value' tokens in one walk
+# and fills the Data fields from a table keyed by OBIS code. The value formats
+# are the same as the ones used by the regex strategies, so the ToJSON() output
+# of both engines is identical.
+#
+MANUFACTURER = re.compile(r'([a-zA-Z]{3}[0-9]([\\]*)([0-9a-zA-Z .-]+))')
+
+OBIS_INT = re.compile(r'([0-9]*)')
+OBIS_ID = re.compile(r'([a-zA-Z0-9]{1,96})')
+OBIS_VERSION = re.compile(r'([0-9]+)')
+OBIS_KW = re.compile(r'([0-9]*\.[0-9]*)\*(kW)')
+OBIS_KWH = re.compile(r'0*([0-9]*\.[0-9]*)\*(kWh)')
+OBIS_V = re.compile(r'([0-9]*\.[0-9]*)\*(V)')
+OBIS_A = re.compile(r'([0-9]*)\*(A)')
+
+class ObisField(object):
+    """
+    Table entry: which Data attribute an OBIS code fills and how its value is matched
+    """
+    __slots__ = ('obis', 'attribute', 'pattern', 'unit', 'required')
+
+    def __init__(self, obis, attribute, pattern, required = False):
+        self.obis = obis
+        self.attribute = attribute
+        self.pattern = pattern
+        self.unit = pattern.groups == 2
+        self.required = required
+
+OBIS_ENERGY = [
+    ObisField('1-0:1.8.1', 'energy_to_t1', OBIS_KWH, True),
+    ObisField('1-0:1.8.2', 'energy_to_t2', OBIS_KWH, True),
+    ObisField('1-0:2.8.1', 'energy_by_t1', OBIS_KWH, True),
+    ObisField('1-0:2.8.2', 'energy_by_t2', OBIS_KWH, True),
+    ObisField('0-0:96.14.0', 'tariff', OBIS_INT, True),
+]
+
+OBIS_PHASES = [
+    ObisField('0-0:96.7.21', 'power_failures', OBIS_INT),
+    ObisField('0-0:96.7.9', 'long_power_failures', OBIS_INT),
+    ObisField('1-0:32.32.0', 'voltage_sags_L1', OBIS_INT),
+    ObisField('1-0:52.32.0', 'voltage_sags_L2', OBIS_INT),
+    ObisField('1-0:72.32.0', 'voltage_sags_L3', OBIS_INT),
+    ObisField('1-0:32.36.0', 'voltage_swells_L1', OBIS_INT),
+    ObisField('1-0:52.36.0', 'voltage_swells_L2', OBIS_INT),
+    ObisField('1-0:72.36.0', 'voltage_swells_L3', OBIS_INT),
+    ObisField('1-0:31.7.0', 'instantaneous_current_L1', OBIS_A),
+    ObisField('1-0:51.7.0', 'instantaneous_current_L2', OBIS_A),
+    ObisField('1-0:71.7.0', 'instantaneous_current_L3', OBIS_A),
+    ObisField('1-0:21.7.0', 'instantaneous_active_power_L1_positive', OBIS_KW),
+    ObisField('1-0:41.7.0', 'instantaneous_active_power_L2_positive', OBIS_KW),
+    ObisField('1-0:61.7.0', 'instantaneous_active_power_L3_positive', OBIS_KW),
+    ObisField('1-0:22.7.0', 'instantaneous_active_power_L1_negative', OBIS_KW),
+    ObisField('1-0:42.7.0', 'instantaneous_active_power_L2_negative', OBIS_KW),
+    ObisField('1-0:62.7.0', 'instantaneous_active_power_L3_negative', OBIS_KW),
+]
+
+OBIS_VOLTAGES = [
+    ObisField('1-0:32.7.0', 'instantaneous_voltage_L1', OBIS_V),
+    ObisField('1-0:52.7.0', 'instantaneous_voltage_L2', OBIS_V),
+    ObisField('1-0:72.7.0', 'instantaneous_voltage_L3', OBIS_V),
+]
+
+# Field tables per DSMR version, mirroring DSMR_22, DSMR_3, DSMR_41 and DSMR_50
+OBIS_TABLES = {
+    '22': [
+        ObisField('1-0:1.7.0', 'power_received', OBIS_KW, True),
+    ] + OBIS_ENERGY + [
+        ObisField('0-0:42.0.0', 'equipment_id', OBIS_ID, True),
+    ],
+    '30': [
+        ObisField('1-0:1.7.0', 'power_delivered', OBIS_KW, True),
+        ObisField('1-0:2.7.0', 'power_received', OBIS_KW, True),
+    ] + OBIS_ENERGY + [
+        ObisField('0-0:96.1.1', 'equipment_id', OBIS_ID, True),
+    ],
+    '41': [
+        ObisField('1-3:0.2.8', 'version', OBIS_VERSION, True),
+        ObisField('1-0:1.7.0', 'power_delivered', OBIS_KW, True),
+        ObisField('1-0:2.7.0', 'power_received', OBIS_KW, True),
+    ] + OBIS_ENERGY + [
+        ObisField('0-0:96.1.1', 'equipment_id', OBIS_ID, True),
+    ] + OBIS_PHASES + OBIS_VOLTAGES,
+}
+# DSMR 5.0 has the same registers as 4.x, only the version differs
+OBIS_TABLES['50'] = OBIS_TABLES['41']
+
+# Not anchored at line starts: the strategies search codes anywhere, a stray
+# control character in a line end must not hide a value from one engine only
+OBIS_LINE = re.compile(r'([0-9]-[0-9]+:[0-9.]+)\(([^)\r\n]*)\)')
+
+def TokenizeDatagram(datagram):
+    """
+    Split a telegram into {OBIS code: value of its first pair of parentheses} in a single pass
+    """
+    # Reversed so the first occurrence of a code wins, like re.search does
+    return dict(reversed(OBIS_LINE.findall(datagram)))
+
+def DetectVersion(tokens):
+    """
+    Resolve the OBIS table for a tokenized telegram, same order as DSMR_Parser
+    """
+    version = tokens.get('1-3:0.2.8')
+    if version == '42':
+        return '41'
+    if version == '50':
+        return '50'
+    if OBIS_ID.fullmatch(tokens.get('0-0:96.1.1', '')) != None:
+        return '30'
+    if OBIS_ID.fullmatch(tokens.get('0-0:42.0.0', '')) != None:
+        return '22'
+    return None
+
+TIMESTAMP = re.compile(r'0-0:1\.0\.0\(([0-9]{12})([SW])\)')
+
+def TelegramTimestamp(datagram):
+    """
+    0-0:1.0.0 of a DSMR 4.x/5.0 telegram as a naive UTC datetime, None when absent
+
+    The meter writes Dutch local time, W is CET (UTC+1) and S is CEST (UTC+2).
+    """
+    result = TIMESTAMP.search(datagram)
+    if result == None:
+        return None
+    try:
+        local = datetime.strptime(result.group(1), '%y%m%d%H%M%S')
+    except ValueError:
+        return None
+    return local - timedelta(hours = 2 if result.group(2) == 'S' else 1)
+
+class DSMR_OBIS(Strategy):
+    def decode(self, datagram):
+        tokens = TokenizeDatagram(datagram)
+        version = DetectVersion(tokens)
+        if version == None:
+            return None
+
+        data = Data()
+        # info, DSMR 4.x and 5.0 overwrite this from 1-3:0.2.8
+        data.version = version
+
+        # Manufacturer, the header line comes first so limit the search to it
+        header_end = datagram.find('\n')
+        result = MANUFACTURER.search(datagram, 0, header_end if header_end >= 0 else len(datagram))
+        if result == None:
+            result = MANUFACTURER.search(datagram)
+        if result == None:
+            raise ValueError('DSMR {0}: no manufacturer in header'.format(version))
+        data.manufacturer = result.group(1)
+
+        values = data.__dict__
+        for field in OBIS_TABLES[version]:
+            value = tokens.get(field.obis)
+            result = field.pattern.fullmatch(value) if value != None else None
+            if result == None:
+                if field.required:
+                    raise ValueError('DSMR {0}: missing or malformed OBIS {1}'.format(version, field.obis))
+                continue
+            values[field.attribute] = result.groups() if field.unit else result.group(1)
+
+        return data
+
+# Strategy per version key of DetectStrategy(), None for an unknown version.
+# Strategies keep no state, one instance of each serves every parser.
+STRATEGIES = {
+    '41': DSMR_41(),
+    '50': DSMR_50(),
+    '30': DSMR_3(),
+    '22': DSMR_22(),
+    'obis': DSMR_OBIS(),
+    None: DSMR_UNKNOWN()
+}
+
+EQUIPMENT_ID_30 = re.compile(r'0-0:96\.1\.1\(([a-zA-Z0-9]{1,96})\)')
+EQUIPMENT_ID_22 = re.compile(r'0-0:42\.0\.0\(([a-zA-Z0-9]{1,96})\)')
+# Version line of the strategies that have one, DSMR 2.2 and 3.0 have none
+VERSION_LINES = {'41': '1-3:0.2.8(42)', '50': '1-3:0.2.8(50)'}
+
+def DetectStrategy(datagram):
+    """
+    Version key of the 'regex' strategy for a telegram, None when it is none of them
+    """
+    if '1-3:0.2.8(42)' in datagram:
+        return '41'
+    if '1-3:0.2.8(50)' in datagram:
+        return '50'
+    if EQUIPMENT_ID_30.search(datagram) != None:
+        return '30'
+    if EQUIPMENT_ID_22.search(datagram) != None:
+        return '22'
+    return None
+
+class StrategyCache(object):
+    """
+    Version key of the strategy per meter signature
+
+    A meter does not change its DSMR version between telegrams. Only its first
+    telegram goes through DetectStrategy(), later ones are checked against the
+    header line of that telegram, with the meter model and firmware, and the
+    version line of the cached version, and detected again when either differs.
+    A telegram that lost its version line can not make a 4.x or 5.0 meter a 3.0
+    one for good: the next intact telegram has a version line a 3.0 meter does
+    not send. Only telegrams that decode are stored. Bounded to max_meters, the
+    meters added first are evicted first. Lookups take no lock, hit counts are
+    approximate with several writer threads.
+    """
+    def __init__(self, max_meters = 100000):
+        self.max_meters = max_meters
+        # signature -> (header line, version key)
+        self._meters = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.changes = 0
+
+    def lookup(self, signature, datagram):
+        """
+        Cached version key of the meter when the telegram matches it, else None
+        """
+        entry = self._meters.get(signature)
+        if entry == None:
+            self.misses += 1
+            return None
+        line = VERSION_LINES.get(entry[1])
+        if datagram.startswith(entry[0]) and (line in datagram if line != None else '1-3:0.2.8(' not in datagram):
+            self.hits += 1
+            return entry[1]
+        self.changes += 1
+        return None
+
+    def store(self, signature, datagram, version):
+        """
+        Version key of a meter, after a telegram decoded with it
+        """
+        header_end = datagram.find('\n')
+        if version == None or header_end < 0:
+            return
+        with self._lock:
+            self._meters.pop(signature, None)
+            self._meters[signature] = (datagram[:header_end + 1], version)
+            while len(self._meters) > self.max_meters:
+                del self._meters[next(iter(self._meters))]
+
+    def stats(self):
+        return {
+            'parser_cache_meters': len(self._meters),
+            'parser_cache_hits': self.hits,
+            'parser_cache_misses': self.misses,
+            'parser_cache_changes': self.changes
+        }
+
+STRATEGY_CACHE = StrategyCache()
 
 class Data(object):
     version = 'NAN'
@@ -400,6 +707,197 @@ class Data(object):
         }
     
 
+#
+# Compact typed reading
+#
+# Data keeps the parsed strings with 'NAN' sentinels and ToJSON() repeats the
+# unit on every field. Reading holds int/float values with None for what the
+# meter did not send. ToCompact() is a flat dict with short keys that leaves
+# out missing values, the units are in READING_UNITS per DSMR version.
+#
+READING_INTEGERS = (
+    'tariff', 'power_failures', 'long_power_failures',
+    'voltage_sags_L1', 'voltage_sags_L2', 'voltage_sags_L3',
+    'voltage_swells_L1', 'voltage_swells_L2', 'voltage_swells_L3'
+)
+
+# Attribute, compact key and unit of the fields Data stores as (value, unit)
+READING_MEASUREMENTS = (
+    ('power_delivered', 'pd', 'kW'),
+    ('power_received', 'pr', 'kW'),
+    ('energy_by_t1', 'ed1', 'kWh'),
+    ('energy_by_t2', 'ed2', 'kWh'),
+    ('energy_to_t1', 'er1', 'kWh'),
+    ('energy_to_t2', 'er2', 'kWh'),
+    ('instantaneous_voltage_L1', 'u1', 'V'),
+    ('instantaneous_voltage_L2', 'u2', 'V'),
+    ('instantaneous_voltage_L3', 'u3', 'V'),
+    ('instantaneous_current_L1', 'i1', 'A'),
+    ('instantaneous_current_L2', 'i2', 'A'),
+    ('instantaneous_current_L3', 'i3', 'A'),
+    ('instantaneous_active_power_L1_positive', 'pp1', 'kW'),
+    ('instantaneous_active_power_L2_positive', 'pp2', 'kW'),
+    ('instantaneous_active_power_L3_positive', 'pp3', 'kW'),
+    ('instantaneous_active_power_L1_negative', 'pn1', 'kW'),
+    ('instantaneous_active_power_L2_negative', 'pn2', 'kW'),
+    ('instantaneous_active_power_L3_negative', 'pn3', 'kW'),
+)
+
+COMPACT_KEYS = {
+    'manufacturer': 'mf',
+    'version': 'v',
+    'equipment_id': 'id',
+    'tariff': 't',
+    'power_failures': 'pf',
+    'long_power_failures': 'lpf',
+    'voltage_sags_L1': 'sg1',
+    'voltage_sags_L2': 'sg2',
+    'voltage_sags_L3': 'sg3',
+    'voltage_swells_L1': 'sw1',
+    'voltage_swells_L2': 'sw2',
+    'voltage_swells_L3': 'sw3'
+}
+COMPACT_KEYS.update((attribute, key) for attribute, key, unit in READING_MEASUREMENTS)
+COMPACT_ATTRIBUTES = dict((key, attribute) for attribute, key in COMPACT_KEYS.items())
+
+# Units per DSMR version (the 'v' key), by compact key
+READING_UNITS = {}
+for version, table in (('22', '22'), ('30', '30'), ('42', '41'), ('50', '50')):
+    attributes = set(field.attribute for field in OBIS_TABLES[table])
+    READING_UNITS[version] = dict((key, unit) for attribute, key, unit in READING_MEASUREMENTS if attribute in attributes)
+
+class Reading(object):
+    __slots__ = tuple(COMPACT_KEYS)
+
+    def __init__(self):
+        for attribute in self.__slots__:
+            setattr(self, attribute, None)
+
+    @staticmethod
+    def FromData(data: Data) -> Reading:
+        reading = Reading()
+        reading.manufacturer = None if data.manufacturer == 'NAN' else data.manufacturer
+        reading.version = None if data.version == 'NAN' else data.version
+        reading.equipment_id = None if data.equipment_id == 'NAN' else data.equipment_id
+        for attribute in READING_INTEGERS:
+            value = getattr(data, attribute)
+            setattr(reading, attribute, None if value == 'NAN' else int(value))
+        for attribute, key, unit in READING_MEASUREMENTS:
+            value = getattr(data, attribute)[0]
+            setattr(reading, attribute, None if value == 'NAN' else float(value))
+        return reading
+
+    @staticmethod
+    def FromCompact(compact) -> Reading:
+        reading = Reading()
+        for key, value in compact.items():
+            setattr(reading, COMPACT_ATTRIBUTES[key], value)
+        return reading
+
+    @staticmethod
+    def FromJSON(decoded) -> Reading:
+        """
+        Reading from the nested ToJSON() shape, as stored by older versions
+        """
+        reading = Reading()
+        if not decoded:
+            return reading
+        def value(field):
+            return None if field['value'] == 'NAN' else field['value']
+        def integer(field):
+            return None if field == 'NAN' else field
+        reading.manufacturer = integer(decoded['manufacturer'])
+        reading.version = integer(decoded['version'])
+        reading.equipment_id = integer(decoded['equipment_id'])
+        reading.tariff = integer(decoded['tariff'])
+        reading.power_delivered = value(decoded['power'][0]['delivered'])
+        reading.power_received = value(decoded['power'][1]['received'])
+        for energy in decoded['energy']:
+            setattr(reading, 'energy_by_t{0}'.format(energy['tariff']), value(energy['delivered']))
+            setattr(reading, 'energy_to_t{0}'.format(energy['tariff']), value(energy['received']))
+        reading.power_failures = integer(decoded['phases']['failures'])
+        reading.long_power_failures = integer(decoded['phases']['long failures'])
+        for phase in decoded['phases']['phases']:
+            name = phase['phase']
+            setattr(reading, 'voltage_sags_' + name, integer(phase['sags']))
+            setattr(reading, 'voltage_swells_' + name, integer(phase['swells']))
+            setattr(reading, 'instantaneous_voltage_' + name, value(phase['instantaneous voltage']))
+            setattr(reading, 'instantaneous_current_' + name, value(phase['instantaneous current']))
+            setattr(reading, 'instantaneous_active_power_{0}_positive'.format(name), value(phase['instantaneous power +P']))
+            setattr(reading, 'instantaneous_active_power_{0}_negative'.format(name), value(phase['instantaneous power -P']))
+        return reading
+
+    def ToCompact(self):
+        compact = {}
+        for attribute in self.__slots__:
+            value = getattr(self, attribute)
+            if value != None:
+                compact[COMPACT_KEYS[attribute]] = value
+        return compact
+
+    def ToJSON(self):
+        """
+        Same nested shape as Data.ToJSON()
+        """
+        return {
+            'manufacturer': NanText(self.manufacturer),
+            'version' : NanText(self.version),
+            'equipment_id': NanText(self.equipment_id),
+            'tariff': NanText(self.tariff),
+            'power' : [
+                {'delivered' : NanMeasurement(self.power_delivered, 'kW')},
+                {'received': NanMeasurement(self.power_received, 'kW')}
+            ],
+            'energy': [
+                {'tariff' : 1,
+                    'delivered': NanMeasurement(self.energy_by_t1, 'kWh'),
+                    'received': NanMeasurement(self.energy_to_t1, 'kWh')
+                },
+                {'tariff' : 2,
+                    'delivered': NanMeasurement(self.energy_by_t2, 'kWh'),
+                    'received': NanMeasurement(self.energy_to_t2, 'kWh')
+                },
+            ],
+            'phases':{
+                'failures' : NanText(self.power_failures),
+                'long failures' : NanText(self.long_power_failures),
+                'phases' : [
+                    {'phase' : 'L1',
+                        'sags': NanText(self.voltage_sags_L1),
+                        'swells': NanText(self.voltage_swells_L1),
+                        'instantaneous voltage': NanMeasurement(self.instantaneous_voltage_L1, 'V'),
+                        'instantaneous current': NanMeasurement(self.instantaneous_current_L1, 'A'),
+                        'instantaneous power +P': NanMeasurement(self.instantaneous_active_power_L1_positive, 'kW'),
+                        'instantaneous power -P': NanMeasurement(self.instantaneous_active_power_L1_negative, 'kW')
+                    },
+                    {'phase' : 'L2',
+                        'sags': NanText(self.voltage_sags_L2),
+                        'swells': NanText(self.voltage_swells_L2),
+                        'instantaneous voltage': NanMeasurement(self.instantaneous_voltage_L2, 'V'),
+                        'instantaneous current': NanMeasurement(self.instantaneous_current_L2, 'A'),
+                        'instantaneous power +P': NanMeasurement(self.instantaneous_active_power_L2_positive, 'kW'),
+                        'instantaneous power -P': NanMeasurement(self.instantaneous_active_power_L2_negative, 'kW')
+                    },
+                    {'phase' : 'L3',
+                        'sags': NanText(self.voltage_sags_L3),
+                        'swells': NanText(self.voltage_swells_L3),
+                        'instantaneous voltage': NanMeasurement(self.instantaneous_voltage_L3, 'V'),
+                        'instantaneous current': NanMeasurement(self.instantaneous_current_L3, 'A'),
+                        'instantaneous power +P': NanMeasurement(self.instantaneous_active_power_L3_positive, 'kW'),
+                        'instantaneous power -P': NanMeasurement(self.instantaneous_active_power_L3_negative, 'kW')
+                    }
+                ]
+            }
+        }
+
+def NanText(value):
+    return 'NAN' if value == None else value
+
+def NanMeasurement(value, unit):
+    if value == None:
+        return {'value': 'NAN', 'unit': 'NAN'}
+    return {'value': value, 'unit': unit}
+
 # if __name__ == '__main__':
 #     datagram = "/KFM5KAIFA-METER\r\n\r\n1-3:0.2.8(42)\r\n0-0:1.0.0(200213170457W)\r\n0-0:96.1.1(4530303236303030303333333338343136)\r\n1-0:1.8.1(015001.164*kWh)\r\n1-0:1.8.2(012236.435*kWh)\r\n1-0:2.8.1(000942.859*kWh)\r\n1-0:2.8.2(002395.253*kWh)\r\n0-0:96.14.0(0002)\r\n1-0:1.7.0(00.299*kW)\r\n1-0:2.7.0(00.000*kW)\r\n0-0:96.7.21(00001)\r\n0-0:96.7.9(00001)\r\n1-0:99.97.0(2)(0-0:96.7.19)(180712201124S)(0000004179*s)(000101000006W)(2147483647*s)\r\n1-0:32.32.0(00000)\r\n1-0:52.32.0(00000)\r\n1-0:72.32.0(00000)\r\n1-0:32.36.0(00000)\r\n1-0:52.36.0(00000)\r\n1-0:72.36.0(00000)\r\n0-0:96.13.1()\r\n0-0:96.13.0()\r\n1-0:31.7.0(000*A)\r\n1-0:51.7.0(000*A)\r\n1-0:71.7.0(001*A)\r\n1-0:21.7.0(00.101*kW)\r\n1-0:41.7.0(00.038*kW)\r\n1-0:61.7.0(00.158*kW)\r\n1-0:22.7.0(00.000*kW)\r\n1-0:42.7.0(00.000*kW)\r\n1-0:62.7.0(00.000*kW)\r\n0-1:24.1.0(003)\r\n0-1:96.1.0(4730303332353631323831363736343136)\r\n0-1:24.2.1(200213170000W)(06136.485*m3)\r\n!2236\r\n"
 #     for x in range(1):
@@ -31,6 +31,7 @@ def run_program():
 def keyboardInterruptHandler(signal, frame):
     logging.info(msg = "KeyboardInterrupt (ID: {}) has been caught. Cleaning up...".format(signal))
     mqtt.stop()
+    mongo.stop()
     exit(0)
 
 if __name__ == '__main__':
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+"""
+asyncio entry point, an alternative to emon2mongo.py
+
+MQTT messages are consumed with aiomqtt, parsed in a process pool and written
+with motor in pipelined batches: while one batch is being inserted the next
+one is already collected and parsed. Broker reconnects back off exponentially.
+
+Needs the aiomqtt and motor packages. Writes the document layout with the raw
+telegrams in SmartMeterDataRaw, like the pymongo backend. parser.crc checks and
+quarantines telegrams like emon2mongo.py does. ratelimit admits messages per
+meter after parsing, rejected messages are not written.
+"""
+import asyncio, random, signal, time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import aiomqtt
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+from appconfig import AppConfig
+from crc16 import CheckTelegram
+from dsmr import DecodeDatagram
+from layouts import ReadingFields, DUPLICATE_KEY
+from mongo import Envelope, RawFields
+from payloads import CODECS, Decoder
+from quarantine import Quarantine
+from ratelimit import RateLimiter
+from logger import logger
+
+def DecodeChunk(payloads, engine, encoding, codec = 'json', check = False):
+    """
+    Runs in the process pool: MQTT payloads -> (datagram, p1_decoded, CRC reason),
+    None for a bad payload
+    """
+    decode = CODECS.get(codec, CODECS['json'])[0]
+    decoded = []
+    for payload in payloads:
+        try:
+            datagram = decode(payload)['datagram']
+            reason = CheckTelegram(datagram['p1']) if check else None
+            if reason != None:
+                decoded.append((datagram, None, reason))
+                continue
+            decoded.append((datagram, DecodeDatagram(datagram['p1'], engine, encoding, datagram['signature']), None))
+        except Exception:
+            decoded.append(None)
+    return decoded
+
+class AsyncIngest(object):
+    def __init__(self, config: AppConfig):
+        self.config = config
+        self.batch_size = config.get('mongodb', 'batch_size', 500)
+        self.linger = config.get('mongodb', 'linger_ms', 250) / 1000.0
+        self.queue = asyncio.Queue(maxsize = config.get('mongodb', 'queue_size', 10000))
+        self.engine = config.get('parser', 'engine', 'regex')
+        self.encoding = config.get('mongodb', 'encoding', 'nested')
+        # One topic, payloads.default decodes all of it
+        self.codec = config.get('payloads', 'default', 'json')
+        Decoder(self.codec)
+        self.executor = ProcessPoolExecutor(config.get('async', 'parse_workers', 2))
+        # Batches being inserted at the same time
+        self.inflight = asyncio.Semaphore(config.get('async', 'inflight_batches', 4))
+        self.writes = set()
+
+        client = AsyncIOMotorClient(config['mongodb']['host'], config['mongodb']['port'], maxPoolSize = config.get('mongodb', 'pool_size', 10))
+        db = client[config['mongodb']['database']]
+        self.raw = db['smart_meter_data_raw']
+        self.decoded = db['smart_meter_data_decoded']
+        # Per meter admission, once the payloads are decoded and the signature is known
+        self.ratelimit = RateLimiter(config) if config.get('ratelimit', 'enabled', False) else None
+        # Quarantine writes with pymongo, from the default thread pool
+        self.quarantine = None
+        if config.get('parser', 'crc', 'off') != 'off':
+            self.quarantine = Quarantine(MongoClient(config['mongodb']['host'], config['mongodb']['port'])[config['mongodb']['database']], config)
+
+        self.received = 0
+        self.written = 0
+        self.failed = 0
+        self.corrupt = 0
+        self.reconnects = 0
+
+    async def mqtt_loop(self):
+        backoff = 1.0
+        max_backoff = self.config.get('async', 'max_backoff', 60.0)
+        while True:
+            try:
+                async with aiomqtt.Client(
+                    hostname = self.config['mqtt']['host'],
+                    port = self.config['mqtt']['port'],
+                    username = self.config['mqtt']['username'],
+                    password = self.config['mqtt']['password'],
+                    keepalive = 10
+                ) as client:
+                    await client.subscribe(self.config['mqtt']['topic'], qos = self.config.get('mqtt', 'qos', 0))
+                    logger.info(msg="MQTT Succesfully connect to broker")
+                    backoff = 1.0
+                    async for message in client.messages:
+                        # Waits while the queue is full, the broker connection then stops being read
+                        await self.queue.put((time.time(), message.payload))
+                        self.received += 1
+            except aiomqtt.MqttError as e:
+                self.reconnects += 1
+                delay = backoff * (0.5 + random.random() / 2)
+                logger.info(msg="MQTT disconnect from broker ({0}), retry in {1:.1f} seconds".format(str(e), delay))
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, max_backoff)
+
+    async def batch_loop(self):
+        # Runs until it takes the None put in the queue by run()
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item == None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.linger
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item == None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            decoded = await loop.run_in_executor(self.executor, DecodeChunk, [payload for received, payload in batch], self.engine, self.encoding, self.codec, self.quarantine != None)
+            envelopes = []
+            rejected = []
+            # An unbounded queue (queue_size 0) has no high water
+            fill = self.queue.qsize() / float(self.queue.maxsize) if self.queue.maxsize > 0 else 0.0
+            for (received, payload), result in zip(batch, decoded):
+                if result == None:
+                    logger.error(msg="Emon.save() exception: bad payload")
+                    self.failed += 1
+                    continue
+                datagram, p1_decoded, reason = result
+                if self.ratelimit != None and self.ratelimit.admit(datagram['signature'], fill) != None:
+                    continue
+                if reason != None:
+                    rejected.append((datagram['signature'], datagram['p1'], reason, datetime.utcfromtimestamp(received)))
+                    continue
+                envelopes.append(Envelope(
+                    p1 = datagram['p1'],
+                    p1_decoded = p1_decoded,
+                    signature = datagram['signature'],
+                    s0 = datagram['s0'],
+                    s1 = datagram['s1'],
+                    createdAt = datetime.utcfromtimestamp(received)
+                ))
+
+            if rejected:
+                self.corrupt += len(rejected)
+                await loop.run_in_executor(None, self._quarantine, rejected)
+
+            # Pipelined: start the insert and go on collecting the next batch
+            await self.inflight.acquire()
+            task = asyncio.create_task(self.write(envelopes))
+            self.writes.add(task)
+            task.add_done_callback(self.writes.discard)
+
+    def _quarantine(self, rejected):
+        for signature, p1, reason, createdAt in rejected:
+            self.quarantine.add(signature, p1, reason, createdAt)
+
+    async def write(self, envelopes):
+        try:
+            for attempt in range(5):
+                try:
+                    rejected = await asyncio.gather(
+                        self._insert(self.raw, [RawFields(e) for e in envelopes]),
+                        self._insert(self.decoded, [ReadingFields(e) for e in envelopes])
+                    )
+                    self.written += len(envelopes) - max(rejected)
+                    self.failed += max(rejected)
+                    return
+                except Exception as e:
+                    logger.error(msg="Emon.save() exception, retry {0}: {1}".format(attempt + 1, str(e)))
+                    await asyncio.sleep(2 ** attempt)
+            self.failed += len(envelopes)
+        finally:
+            self.inflight.release()
+
+    async def _insert(self, collection, documents):
+        # Returns the number of rejected documents, duplicates are from an earlier attempt
+        if not documents:
+            return 0
+        try:
+            await collection.insert_many(documents, ordered=False)
+            return 0
+        except BulkWriteError as e:
+            errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY]
+            if errors:
+                logger.error(msg="Insert into {0}: {1} documents rejected, first: {2}".format(collection.name, len(errors), errors[0]['errmsg']))
+            return len(errors)
+
+    async def report_loop(self):
+        interval = self.config.get('logger', 'update_rate', 10)
+        last = 0
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(msg="Async ingest: {0:.0f} messages/s, queue {1}, written {2}, failed {3}, corrupt {4}, reconnects {5}".format(
+                (self.received - last) / interval, self.queue.qsize(), self.written, self.failed, self.corrupt, self.reconnects))
+            last = self.received
+
+    async def run(self):
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, stopping.set)
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+
+        mqtt = asyncio.create_task(self.mqtt_loop())
+        batches = asyncio.create_task(self.batch_loop())
+        reporter = asyncio.create_task(self.report_loop())
+        await stopping.wait()
+
+        logger.info(msg="Stopping, draining {0} queued messages".format(self.queue.qsize()))
+        mqtt.cancel()
+        await self.queue.put(None)
+        await batches
+        reporter.cancel()
+        if self.writes:
+            await asyncio.wait(self.writes)
+        self.executor.shutdown()
+
+if __name__ == '__main__':
+    asyncio.run(AsyncIngest(AppConfig()).run())
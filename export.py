@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+"""
+Export decoded readings to Parquet files, a directory per day and meter
+
+    python3 export.py --out export --since 2021-01-01 --until 2021-02-01
+    python3 export.py --out export --meters E0001,E0002 --job daily
+
+Readings are streamed per meter from the configured layout, oldest first, with
+only the fields the columns need and --batch documents per cursor batch. The
+nested or compact p1_decoded is flattened into one typed column per Reading
+attribute and written in row groups of --rows readings:
+
+    <out>/date=2021-01-05/meter=E0001/part-20210206T101500.parquet
+
+One file is open at a time and at most --rows readings are held, memory does
+not grow with the range. Per --job and meter the createdAt of the last exported
+reading is kept in smart_meter_exports, the next run of the job continues after
+it. Readings stored later with an older createdAt are not picked up.
+
+Needs the pyarrow package.
+"""
+import argparse, os, sys
+from datetime import datetime
+from mongoengine import connect
+from mongoengine.connection import get_db
+
+from appconfig import AppConfig
+from dsmr import Reading, READING_INTEGERS, READING_MEASUREMENTS
+from layouts import CreateLayout, HourBucketLayout
+from suppress import Reconstruct
+from replay import ParseTime
+from logger import logger
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# What the columns need of a decoded document, base completes delta documents
+FIELDS = ['p1_decoded', 'base', 's0', 's1']
+
+def Schema():
+    """
+    Column per Reading attribute, measurements carry their unit in the field metadata
+    """
+    units = dict((attribute, unit) for attribute, key, unit in READING_MEASUREMENTS)
+    fields = [
+        pyarrow.field('signature', pyarrow.string()),
+        pyarrow.field('createdAt', pyarrow.timestamp('ms')),
+        pyarrow.field('s0', pyarrow.float64()),
+        pyarrow.field('s0_unit', pyarrow.string()),
+        pyarrow.field('s1', pyarrow.float64()),
+        pyarrow.field('s1_unit', pyarrow.string())
+    ]
+    for attribute in Reading.__slots__:
+        if attribute in units:
+            fields.append(pyarrow.field(attribute, pyarrow.float64(), metadata={'unit': units[attribute]}))
+        elif attribute in READING_INTEGERS:
+            fields.append(pyarrow.field(attribute, pyarrow.int64()))
+        else:
+            fields.append(pyarrow.field(attribute, pyarrow.string()))
+    return pyarrow.schema(fields)
+
+def _typed(value, convert):
+    # Readings stored by Data.ToJSON() can hold text like '0002' or 'NAN'
+    if value == None:
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return None
+
+class PartFile(object):
+    """
+    Readings of one meter on one day, written to a Parquet file rows readings at a time
+    """
+    def __init__(self, path, schema, rows, compression):
+        self.path = path
+        self.schema = schema
+        self.rows = rows
+        self.compression = compression
+        self.columns = dict((name, []) for name in schema.names)
+        self.converters = dict((field.name, float if pyarrow.types.is_floating(field.type) else int if pyarrow.types.is_integer(field.type) else str)
+                               for field in schema if field.name in Reading.__slots__)
+        self.buffered = 0
+        self.written = 0
+        self.writer = None
+
+    def add(self, signature, document):
+        decoded = document.get('p1_decoded') or {}
+        reading = Reading.FromJSON(decoded) if 'power' in decoded else Reading.FromCompact(decoded)
+        columns = self.columns
+        columns['signature'].append(signature)
+        columns['createdAt'].append(document['createdAt'])
+        for sensor in ('s0', 's1'):
+            value = document.get(sensor) or {}
+            columns[sensor].append(_typed(value.get('value'), float))
+            columns[sensor + '_unit'].append(value.get('unit'))
+        for attribute, convert in self.converters.items():
+            columns[attribute].append(_typed(getattr(reading, attribute), convert))
+        self.buffered += 1
+        if self.buffered >= self.rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        table = pyarrow.Table.from_pydict(self.columns, schema=self.schema)
+        if self.writer == None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema, compression=self.compression)
+        self.writer.write_table(table)
+        for column in self.columns.values():
+            column.clear()
+        self.written += self.buffered
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        if self.writer != None:
+            self.writer.close()
+
+class Export(object):
+    def __init__(self, config: AppConfig, out, job, rows = 50000, batch_size = 1000, compression = 'snappy'):
+        db = get_db()
+        self.layout = CreateLayout(db, config)
+        self.checkpoints = db['smart_meter_exports']
+        self.schema = Schema()
+        self.out = out
+        self.job = job
+        self.rows = rows
+        self.batch_size = batch_size
+        self.compression = compression
+        # Every run writes new files next to those of earlier runs
+        self.part = 'part-{0:%Y%m%dT%H%M%S}.parquet'.format(datetime.utcnow())
+
+        self.exported = 0
+        self.files = 0
+        self.meters = 0
+
+    def signatures(self, since, until):
+        """
+        Meters with readings in the range, bucket documents are found by their start
+        """
+        if isinstance(self.layout, HourBucketLayout):
+            query = {'start': {'$gte': self.layout.bucket(since), '$lt': until}}
+        else:
+            query = {'createdAt': {'$gte': since, '$lt': until}}
+        return sorted(self.layout.collection.distinct('signature', query))
+
+    def path(self, signature, day):
+        return os.path.join(self.out, 'date={0}'.format(day.isoformat()), 'meter={0}'.format(signature), self.part)
+
+    def run(self, since, until, meters = None):
+        for signature in meters or self.signatures(since, until):
+            exported = self.export(signature, since, until)
+            if exported:
+                self.meters += 1
+                logger.info(msg="Export {0}: {1} readings of {2}, {3} in total".format(self.job, exported, signature, self.exported))
+
+    def export(self, signature, since, until):
+        key = '{0}/{1}'.format(self.job, signature)
+        checkpoint = self.checkpoints.find_one({'_id': key})
+        last = checkpoint['last'] if checkpoint != None else None
+        start = max(since, last) if last != None else since
+
+        readings = Reconstruct(self.layout.read(signature, start, until, FIELDS, self.batch_size), self.layout.collection, 'compact')
+        part = None
+        exported = 0
+        for reading in readings:
+            createdAt = reading['createdAt']
+            if last != None and createdAt <= last:
+                continue
+            if part == None or createdAt.date() != day:
+                if part != None:
+                    part.close()
+                day = createdAt.date()
+                part = PartFile(self.path(signature, day), self.schema, self.rows, self.compression)
+                self.files += 1
+            part.add(signature, reading)
+            last = createdAt
+            exported += 1
+        if part != None:
+            part.close()
+
+        if exported:
+            # Only after the files are complete, an interrupted meter is exported again
+            self.checkpoints.replace_one({'_id': key}, {'_id': key, 'job': self.job, 'signature': signature, 'last': last}, upsert=True)
+            self.exported += exported
+        return exported
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export decoded readings to Parquet files per day and meter")
+    parser.add_argument('--out', default='export', help="directory of the date=/meter= partitions")
+    parser.add_argument('--job', default='export', help="checkpoint name, a new name starts from --since")
+    parser.add_argument('--since', help="createdAt from, ISO 8601")
+    parser.add_argument('--until', help="createdAt before, ISO 8601, default now")
+    parser.add_argument('--meters', help="comma separated signatures, default all meters with readings in the range")
+    parser.add_argument('--rows', type=int, default=50000, help="readings per row group")
+    parser.add_argument('--batch', type=int, default=1000, help="documents per cursor batch")
+    parser.add_argument('--compression', default='snappy')
+    args = parser.parse_args()
+
+    if pyarrow == None:
+        logger.error(msg="Export needs the pyarrow package")
+        sys.exit(1)
+
+    appconfig = AppConfig()
+    connect(db = appconfig['mongodb']['database'], host = appconfig['mongodb']['host'], port = appconfig['mongodb']['port'])
+    export = Export(appconfig, args.out, args.job, args.rows, args.batch, args.compression)
+    export.run(ParseTime(args.since) if args.since else datetime(1970, 1, 1),
+               ParseTime(args.until) if args.until else datetime.utcnow(),
+               args.meters.split(',') if args.meters else None)
+    logger.info(msg="Export {0}: {1} readings of {2} meters in {3} files".format(args.job, export.exported, export.meters, export.files))
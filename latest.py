@@ -0,0 +1,137 @@
+import json, threading, time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+from appconfig import AppConfig
+from logger import logger
+
+def LatestDocument(signature, createdAt, p1_decoded):
+    return {
+        'signature': signature,
+        'createdAt': createdAt.isoformat() + 'Z',
+        'p1_decoded': p1_decoded
+    }
+
+class LatestCache(object):
+    """
+    Latest decoded reading per meter, as the ingest sees them
+
+    Bounded to max_meters, the meter that was not heard from longest is evicted
+    first. Readings older than max_age_seconds are not served. With a publisher
+    every update is also handed to it, at most once per publish_interval per meter.
+    With the spool enabled the telegrams are parsed on intake for the cache too,
+    so it does not lag behind with the replay, at the cost of parsing twice.
+    """
+    def __init__(self, config: AppConfig):
+        self.max_meters = config.get('latest', 'max_meters', 100000)
+        self.max_age = timedelta(seconds=config.get('latest', 'max_age_seconds', 900))
+        self.publish_interval = config.get('latest', 'publish_interval', 10)
+        # signature -> (createdAt, p1_decoded, time.monotonic() of the last publish)
+        self._meters = OrderedDict()
+        self._lock = threading.Lock()
+        # publisher(signature, document)
+        self.publisher = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, envelope):
+        if not envelope.p1_decoded:
+            return
+        with self._lock:
+            entry = self._meters.get(envelope.signature)
+            if entry != None and entry[0] > envelope.createdAt:
+                # Out of order, the cached reading is newer
+                return
+            published = entry[2] if entry != None else None
+            publish = self.publisher != None and (published == None or time.monotonic() - published >= self.publish_interval)
+            if publish:
+                published = time.monotonic()
+            self._meters[envelope.signature] = (envelope.createdAt, envelope.p1_decoded, published)
+            self._meters.move_to_end(envelope.signature)
+            while len(self._meters) > self.max_meters:
+                self._meters.popitem(last=False)
+        if publish:
+            try:
+                self.publisher(envelope.signature, LatestDocument(envelope.signature, envelope.createdAt, envelope.p1_decoded))
+            except Exception as e:
+                logger.error(msg="Publish of the latest reading of {0} failed: {1}".format(envelope.signature, str(e)))
+
+    def get(self, signature):
+        """
+        {signature, createdAt, p1_decoded} or None when unknown or too old
+        """
+        with self._lock:
+            entry = self._meters.get(signature)
+        if entry == None or datetime.utcnow() - entry[0] > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return LatestDocument(signature, entry[0], entry[1])
+
+    def meters(self):
+        """
+        signature -> createdAt of the readings that are not too old
+        """
+        horizon = datetime.utcnow() - self.max_age
+        with self._lock:
+            entries = list(self._meters.items())
+        return dict((signature, entry[0].isoformat() + 'Z') for signature, entry in entries if entry[0] >= horizon)
+
+    def stats(self):
+        with self._lock:
+            meters = len(self._meters)
+        return {
+            'latest_meters': meters,
+            'latest_hits': self.hits,
+            'latest_misses': self.misses
+        }
+
+class LatestHandler(BaseHTTPRequestHandler):
+    """
+    GET /latest/<signature> the latest reading of a meter, GET /latest the meters with their last createdAt
+    """
+    cache = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/latest':
+            document = self.cache.meters()
+        elif path.startswith('/latest/'):
+            document = self.cache.get(unquote(path[len('/latest/'):]))
+            if document == None:
+                self.send_error(404)
+                return
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(document).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def StartLatestServer(config: AppConfig, cache: LatestCache):
+    """
+    Serve the cache over HTTP when latest.port is set, returns the server or None
+    """
+    if not config.get('latest', 'port', 0):
+        return None
+    address = (config.get('latest', 'host', '127.0.0.1'), config.get('latest', 'port', 0))
+    handler = type('LatestCacheHandler', (LatestHandler,), {'cache': cache})
+    try:
+        server = ThreadingHTTPServer(address, handler)
+    except OSError as e:
+        logger.error(msg="Latest reading endpoint on {0}:{1} not started: {2}".format(address[0], address[1], str(e)))
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="latest-http")
+    thread.daemon = True
+    thread.start()
+    logger.info(msg="Latest readings on http://{0}:{1}/latest".format(address[0], address[1]))
+    return server
@@ -0,0 +1,169 @@
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid
+from appconfig import AppConfig
+from logger import logger
+
+DUPLICATE_KEY = 11000
+
+def ReadingFields(envelope):
+    if envelope.base != None:
+        # Changed fields only, suppress.Reconstruct() completes them from the keyframe
+        return {
+            '_id': envelope._id,
+            'signature': envelope.signature,
+            'p1_decoded': envelope.delta,
+            'base': envelope.base,
+            's0': envelope.s0,
+            's1': envelope.s1,
+            'createdAt': envelope.createdAt
+        }
+    return {
+        '_id': envelope._id,
+        'signature': envelope.signature,
+        'p1_decoded': envelope.p1_decoded,
+        's0': envelope.s0,
+        's1': envelope.s1,
+        'createdAt': envelope.createdAt
+    }
+
+def Projection(fields, prefix = ''):
+    # _id and createdAt always, the readers sort and deduplicate on them
+    if fields == None:
+        return None
+    projection = {prefix + '_id': 1, prefix + 'createdAt': 1}
+    for field in fields:
+        projection[prefix + field] = 1
+    return projection
+
+class DocumentLayout(object):
+    """
+    One document per reading, the SmartMeterDataDecoded collection
+    """
+    def __init__(self, db, config: AppConfig, name = 'smart_meter_data_decoded'):
+        self.collection = db[name]
+
+    def insert(self, batch):
+        """
+        Returns the number of readings that could not be stored
+        """
+        try:
+            self.collection.insert_many([ReadingFields(e) for e in batch], ordered=False)
+            return 0
+        except BulkWriteError as e:
+            # Duplicates are documents stored by an earlier attempt of a retried batch
+            errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY]
+            if errors:
+                logger.error(msg="Insert into {0}: {1} documents rejected, first: {2}".format(self.collection.name, len(errors), errors[0]['errmsg']))
+            return len(errors)
+
+    def read(self, signature, start, end, fields = None, batch_size = 1000):
+        """
+        Readings of one meter with start <= createdAt < end, oldest first, streamed
+        batch_size documents at a time, with only fields (like 'p1_decoded.pd') when given
+        """
+        return self.collection.find({'signature': signature, 'createdAt': {'$gte': start, '$lt': end}},
+                                    Projection(fields)).sort('createdAt', ASCENDING).batch_size(batch_size)
+
+class TimeSeriesLayout(object):
+    """
+    MongoDB (5.0+) time-series collection, signature is the metaField and createdAt the timeField
+    """
+    def __init__(self, db, config: AppConfig, name = 'smart_meter_data_ts'):
+        try:
+            db.create_collection(name, timeseries={
+                'timeField': 'createdAt',
+                'metaField': 'signature',
+                'granularity': config.get('mongodb', 'timeseries_granularity', 'seconds')
+            })
+        except CollectionInvalid:
+            pass
+        self.collection = db[name]
+
+    def insert(self, batch):
+        try:
+            self.collection.insert_many([ReadingFields(e) for e in batch], ordered=False)
+            return 0
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            logger.error(msg="Insert into {0}: {1} documents rejected, first: {2}".format(self.collection.name, len(errors), errors[0]['errmsg']))
+            return len(errors)
+
+    def read(self, signature, start, end, fields = None, batch_size = 1000):
+        # _id is not unique in a time-series collection, skip readings stored twice by a retried batch
+        seen = set()
+        at = None
+        query = {'signature': signature, 'createdAt': {'$gte': start, '$lt': end}}
+        for reading in self.collection.find(query, Projection(fields)).sort('createdAt', ASCENDING).batch_size(batch_size):
+            if reading['createdAt'] != at:
+                at = reading['createdAt']
+                seen.clear()
+            if reading['_id'] in seen:
+                continue
+            seen.add(reading['_id'])
+            yield reading
+
+class HourBucketLayout(object):
+    """
+    One document per meter per bucket_minutes (default an hour), readings are pushed into it
+
+    {signature, start, count, first, last, readings: [{_id, createdAt, p1_decoded, s0, s1}]}
+    """
+    def __init__(self, db, config: AppConfig, name = 'smart_meter_data_buckets'):
+        self.span = timedelta(minutes = config.get('mongodb', 'bucket_minutes', 60))
+        self.collection = db[name]
+        self.collection.create_index([('signature', ASCENDING), ('start', ASCENDING)], unique=True)
+
+    def bucket(self, createdAt):
+        epoch = datetime(1970, 1, 1)
+        return epoch + ((createdAt - epoch) // self.span) * self.span
+
+    def insert(self, batch):
+        # One update per bucket in the batch
+        buckets = {}
+        for e in batch:
+            reading = ReadingFields(e)
+            del reading['signature']
+            buckets.setdefault((e.signature, self.bucket(e.createdAt)), []).append(reading)
+
+        counts = [len(readings) for readings in buckets.values()]
+        updates = [UpdateOne(
+            {'signature': signature, 'start': start},
+            {
+                '$push': {'readings': {'$each': readings}},
+                '$inc': {'count': len(readings)},
+                '$min': {'first': min(reading['createdAt'] for reading in readings)},
+                '$max': {'last': max(reading['createdAt'] for reading in readings)}
+            },
+            upsert=True
+        ) for (signature, start), readings in buckets.items()]
+
+        try:
+            self.collection.bulk_write(updates, ordered=False)
+            return 0
+        except BulkWriteError as e:
+            failed = sum(counts[error['index']] for error in e.details['writeErrors'])
+            logger.error(msg="Update of {0}: {1} buckets rejected, first: {2}".format(self.collection.name, len(e.details['writeErrors']), e.details['writeErrors'][0]['errmsg']))
+            return failed
+
+    def read(self, signature, start, end, fields = None, batch_size = 10):
+        # A retried batch can push a reading twice, every reading keeps its _id
+        seen = set()
+        query = {'signature': signature, 'start': {'$gte': self.bucket(start), '$lt': end}}
+        for bucket in self.collection.find(query, Projection(fields, 'readings.')).sort('start', ASCENDING).batch_size(batch_size):
+            readings = sorted(bucket['readings'], key=lambda reading: reading['createdAt'])
+            for reading in readings:
+                if reading['createdAt'] < start or reading['createdAt'] >= end or reading['_id'] in seen:
+                    continue
+                seen.add(reading['_id'])
+                reading['signature'] = signature
+                yield reading
+
+LAYOUTS = {
+    'document': DocumentLayout,
+    'timeseries': TimeSeriesLayout,
+    'bucket': HourBucketLayout
+}
+
+def CreateLayout(db, config: AppConfig, layout = None):
+    return LAYOUTS[layout or config.get('mongodb', 'layout', 'document')](db, config)
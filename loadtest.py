@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+"""
+Capacity test of one emon2mongo instance, without the production broker or database
+
+    python3 loadtest.py --meters 100,1000,5000 --interval 10 --duration 30 --mongomock
+    python3 loadtest.py --meters 1000,10000 --broker 127.0.0.1:1883
+
+Simulated gateways publish {"datagram": {"p1", "signature", "s0", "s1"}} for
+every meter once per interval. Without --broker the messages are handed to
+MQTT.on_message in-process, with --broker they go through a local broker.
+--mongomock stores in memory, otherwise the mongodb section of config.json is
+used (point it at a local mongod).
+
+For every meter count the run reports the sustained stored rate, p50/p99 latency
+from publish to stored, RSS growth and messages that never got stored. The
+capacity is the largest meter count that kept up.
+"""
+import argparse, functools, json, os, resource, threading, time
+
+from appconfig import AppConfig
+from telegram_generator import TelegramGenerator, VERSIONS
+from logger import logger
+
+class Message(object):
+    # What paho hands to on_message, for the in-process mode
+    __slots__ = ('topic', 'payload', 'qos')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+
+def Rss():
+    """
+    Resident set size in bytes, from /proc on Linux and the peak elsewhere
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def Percentile(values, percentile):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+class LatencyProbe(object):
+    """
+    Wraps the storage backend, the publish time travels in s0.sent
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.archive = backend.archive
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.stored = 0
+
+    def insert(self, batch, decoded = None):
+        failed = self.backend.insert(batch, decoded)
+        now = time.time()
+        with self.lock:
+            self.stored += len(batch) - failed
+            self.latencies.extend(now - envelope.s0['sent'] for envelope in batch)
+        return failed
+
+    def take(self):
+        with self.lock:
+            latencies = self.latencies
+            stored = self.stored
+            self.latencies = []
+            self.stored = 0
+        return latencies, stored
+
+class Gateway(threading.Thread):
+    """
+    Publishes for a share of the meters, spread evenly over the interval
+    """
+    def __init__(self, index, meters, interval, duration, telegrams, publish):
+        threading.Thread.__init__(self, name="gateway-{0}".format(index))
+        self.daemon = True
+        self.meters = meters
+        self.interval = interval
+        self.duration = duration
+        self.telegrams = telegrams
+        self.publish = publish
+        self.published = 0
+        self.late = 0
+
+    def run(self):
+        if not self.meters:
+            return
+        started = time.monotonic()
+        spacing = self.interval / len(self.meters)
+        sequence = 0
+        while True:
+            for offset, signature in enumerate(self.meters):
+                due = started + sequence * self.interval + offset * spacing
+                if due - started >= self.duration:
+                    return
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -self.interval:
+                    # The publisher itself can not keep up, the result is not valid
+                    self.late += 1
+                payload = json.dumps({'datagram': {
+                    'p1': self.telegrams[(sequence + offset) % len(self.telegrams)],
+                    'signature': signature,
+                    's0': {'sent': time.time()},
+                    's1': {}
+                }})
+                self.publish(payload)
+                self.published += 1
+            sequence += 1
+
+def RunStep(args, config, mongo, mqtt, meters, telegrams, probe):
+    signatures = ['loadtest-{0:06d}'.format(index) for index in range(meters)]
+    publishers = []
+    if args.broker:
+        import paho.mqtt.client as paho
+        host, port = args.broker.split(':')
+        for index in range(args.gateways):
+            client = paho.Client("", clean_session=True)
+            client.connect(host, int(port), 10)
+            client.loop_start()
+            publishers.append(client)
+        publish = [functools.partial(client.publish, config.get('mqtt', 'topic', 'smartmeter/raw'), qos=args.qos) for client in publishers]
+    else:
+        topic = config.get('mqtt', 'topic', 'smartmeter/raw')
+        deliver = lambda payload: mqtt.on_message(None, None, Message(topic, payload.encode()))
+        publish = [deliver] * args.gateways
+
+    gateways = [Gateway(index, signatures[index::args.gateways], args.interval, args.duration, telegrams, publish[index])
+                for index in range(args.gateways)]
+    probe.take()
+    blocked_before = mongo.stats.snapshot()['blocked']
+    rss_before = Rss()
+    started = time.monotonic()
+    for gateway in gateways:
+        gateway.start()
+    for gateway in gateways:
+        gateway.join()
+    published = sum(gateway.published for gateway in gateways)
+    late = sum(gateway.late for gateway in gateways)
+
+    # Whatever is stored within the drain time counts, the rest is dropped
+    deadline = time.monotonic() + args.drain
+    latencies, stored = probe.take()
+    while stored < published and time.monotonic() < deadline:
+        time.sleep(0.1)
+        more, count = probe.take()
+        latencies.extend(more)
+        stored += count
+    elapsed = time.monotonic() - started
+    for client in publishers:
+        client.loop_stop()
+        client.disconnect()
+
+    return {
+        'meters': meters,
+        'offered_per_s': meters / args.interval,
+        'published': published,
+        'stored': stored,
+        'stored_per_s': stored / elapsed,
+        'dropped': published - stored,
+        'p50_ms': Percentile(latencies, 50) * 1000.0,
+        'p99_ms': Percentile(latencies, 99) * 1000.0,
+        'rss_growth_mb': (Rss() - rss_before) / 1048576.0,
+        'blocked': mongo.stats.snapshot()['blocked'] - blocked_before,
+        'publisher_late': late
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the MQTT to MongoDB pipeline")
+    parser.add_argument('--meters', default='100,1000,5000', help="comma separated meter counts, one step each")
+    parser.add_argument('--interval', type=float, default=10.0, help="seconds between telegrams of a meter")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of publishing per step")
+    parser.add_argument('--drain', type=float, default=30.0, help="seconds to wait for the backlog after a step")
+    parser.add_argument('--gateways', type=int, default=4, help="publishing threads")
+    parser.add_argument('--versions', default='30,42,50', help="DSMR versions of the telegrams, from {0}".format(','.join(VERSIONS)))
+    parser.add_argument('--broker', help="host:port of a local broker, in-process delivery without it")
+    parser.add_argument('--qos', type=int, default=0)
+    parser.add_argument('--mongomock', action='store_true', help="in-memory mongomock instead of mongod")
+    parser.add_argument('--max-p99-ms', type=float, default=5000.0, help="p99 latency a step may have to count as kept up")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    config = AppConfig()
+    config['mongodb']['database'] = 'emon_loadtest'
+    if args.mongomock:
+        import mongo as mongo_module
+        import mongomock
+        # mongomock has no collection validators and no capped collection for the quarantine
+        config['mongodb']['validation'] = 'off'
+        if config.get('parser', 'crc', 'off') == 'quarantine':
+            config['parser']['crc'] = 'reject'
+        mongo_module.connect = functools.partial(mongo_module.connect, mongo_client_class=mongomock.MongoClient)
+    if args.broker:
+        host, port = args.broker.split(':')
+        config['mqtt']['host'] = host
+        config['mqtt']['port'] = int(port)
+        config['mqtt']['qos'] = args.qos
+
+    from mongo import MongoEngine
+    from mqtt import MQTT
+    mongo = MongoEngine(config = config)
+    probe = LatencyProbe(mongo.backend)
+    mongo.backend = probe
+    mqtt = MQTT(config = config, mongo = mongo)
+    if args.broker:
+        mqtt.run()
+        while not mqtt.isConnected():
+            time.sleep(0.1)
+
+    generator = TelegramGenerator(seed = 1)
+    telegrams = generator.mix(500, versions = tuple(args.versions.split(',')))
+
+    results = []
+    for meters in [int(count) for count in args.meters.split(',')]:
+        logger.info(msg="Load test: {0} meters, {1:.0f} messages/s".format(meters, meters / args.interval))
+        results.append(RunStep(args, config, mongo, mqtt, meters, telegrams, probe))
+
+    if args.broker:
+        mqtt.stop()
+    mongo.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{0:>8} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10} {6:>9} {7:>8}'.format(
+        'meters', 'offered/s', 'stored/s', 'dropped', 'p50 ms', 'p99 ms', 'rss MB', 'blocked'))
+    capacity = 0
+    for result in results:
+        print('{meters:>8} {offered_per_s:>10.0f} {stored_per_s:>10.0f} {dropped:>8} {p50_ms:>10.1f} {p99_ms:>10.1f} '
+              '{rss_growth_mb:>+9.1f} {blocked:>8}'.format(**result))
+        if result['publisher_late']:
+            print('         publisher fell behind {0} times, use more --gateways'.format(result['publisher_late']))
+        if result['dropped'] == 0 and result['p99_ms'] <= args.max_p99_ms:
+            capacity = max(capacity, result['meters'])
+    print('Capacity: {0} meters at one telegram per {1:g} s'.format(capacity, args.interval))
+
+if __name__ == '__main__':
+    main()
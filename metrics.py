@@ -0,0 +1,232 @@
+import bisect, re, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo import monitoring
+from appconfig import AppConfig
+from dsmr import DetectStrategy
+from logger import logger
+
+# Seconds, from a fast parse up to a slow insert of a large batch
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+VERSION = re.compile(r'1-3:0\.2\.8\((\d+)\)')
+
+def LabelText(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values)) + '}'
+
+class Counter(object):
+    """
+    Monotonic counter, labels() returns the counter of one label combination
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._children = {}
+        self.value = 0.0
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child == None:
+            with self._lock:
+                child = self._children.setdefault(values, Counter(self.name, self.help))
+        return child
+
+    def inc(self, amount = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        if not self.label_names:
+            return [(self.name, '', self.value)]
+        return [(self.name, LabelText(self.label_names, values), child.value) for values, child in list(self._children.items())]
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed buckets, as Prometheus expects it
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets = LATENCY_BUCKETS, labels = ()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._children = {}
+        # One count per bucket, the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child == None:
+            with self._lock:
+                child = self._children.setdefault(values, Histogram(self.name, self.help, self.buckets))
+        return child
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def _samples(self, names, values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket
+            samples.append((self.name + '_bucket', LabelText(names + ('le',), values + (bound,)), cumulative))
+        samples.append((self.name + '_sum', LabelText(names, values), total))
+        samples.append((self.name + '_count', LabelText(names, values), count))
+        return samples
+
+    def samples(self):
+        if not self.label_names:
+            return self._samples((), ())
+        samples = []
+        for values, child in list(self._children.items()):
+            samples.extend(child._samples(self.label_names, values))
+        return samples
+
+class Gauge(object):
+    """
+    Value read from a function at scrape time, nothing is done between scrapes.
+    type 'counter' for totals that are kept elsewhere, like the WriterStats.
+    """
+    def __init__(self, name, help, function, type = 'gauge'):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type = type
+
+    def samples(self):
+        try:
+            return [(self.name, '', float(self.function()))]
+        except Exception:
+            return []
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            # A second MongoEngine in the same process replaces the gauges of the first
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels = ()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets = LATENCY_BUCKETS, labels = ()):
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def gauge(self, name, help, function, type = 'gauge'):
+        return self.register(Gauge(name, help, function, type))
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, labels, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# Pipeline instrumentation, recorded always and only formatted when scraped
+MESSAGES = REGISTRY.counter('emon_messages_total', 'MQTT messages received')
+PARSE_FAILURES = REGISTRY.counter('emon_parse_failures_total', 'Telegrams that could not be decoded', labels=('version',))
+CORRUPT_TELEGRAMS = REGISTRY.counter('emon_corrupt_telegrams_total', 'Telegrams rejected by the CRC16 check', labels=('reason',))
+STAGE_SECONDS = REGISTRY.histogram('emon_stage_seconds', 'Time spent per pipeline stage', labels=('stage',))
+STAGE_JSON = STAGE_SECONDS.labels('json')
+STAGE_PARSE = STAGE_SECONDS.labels('parse')
+STAGE_QUEUE = STAGE_SECONDS.labels('queue')
+STAGE_PERSIST = STAGE_SECONDS.labels('persist')
+STAGE_TOTAL = STAGE_SECONDS.labels('receive_to_persist')
+BATCH_SIZE = REGISTRY.histogram('emon_batch_size', 'Readings per insert batch', SIZE_BUCKETS)
+MONGO_COMMAND_SECONDS = REGISTRY.histogram('emon_mongo_command_seconds', 'MongoDB command durations', labels=('command', 'outcome'))
+ROLLUP_WINDOWS = REGISTRY.counter('emon_rollup_windows_total', 'Rollup windows written', labels=('window',))
+ROLLUP_LATE = REGISTRY.counter('emon_rollup_late_total', 'Readings for a rollup window that was already written')
+ADMISSION_REJECTED = REGISTRY.counter('emon_admission_rejected_total', 'Messages not admitted by the per meter rate limits', labels=('reason',))
+
+def TelegramVersion(p1):
+    """
+    DSMR version of a telegram for the failure counter, only called for failures.
+    DSMR 2.2 and 3.0 have no version line, they are told apart by the equipment id
+    """
+    if not isinstance(p1, str):
+        return 'unknown'
+    match = VERSION.search(p1)
+    if match != None:
+        return match.group(1)
+    return DetectStrategy(p1) or 'unknown'
+
+class MetricsCommandListener(monitoring.CommandListener):
+    """
+    MongoDB command durations from the driver's command monitoring
+    """
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name, 'succeeded').observe(event.duration_micros / 1000000.0)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name, 'failed').observe(event.duration_micros / 1000000.0)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+def StartMetricsServer(config: AppConfig):
+    """
+    Serve /metrics when metrics.enabled, returns the server or None
+    """
+    if not config.get('metrics', 'enabled', False):
+        return None
+    address = (config.get('metrics', 'host', '0.0.0.0'), config.get('metrics', 'port', 9108))
+    try:
+        server = ThreadingHTTPServer(address, MetricsHandler)
+    except OSError as e:
+        logger.error(msg="Metrics endpoint on {0}:{1} not started: {2}".format(address[0], address[1], str(e)))
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+    thread.daemon = True
+    thread.start()
+    logger.info(msg="Metrics on http://{0}:{1}/metrics".format(address[0], address[1]))
+    return server
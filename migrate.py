@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+"""
+Copy the SmartMeterDataDecoded collection into another storage layout
+
+    python3 migrate.py --layout bucket
+    python3 migrate.py --layout timeseries --batch 10000
+
+Progress is checkpointed per layout in the smart_meter_migrations collection,
+an interrupted migration continues after the last copied _id.
+"""
+import argparse, time
+from mongoengine import connect
+from mongoengine.connection import get_db
+
+from appconfig import AppConfig
+from layouts import CreateLayout, LAYOUTS
+from mongo import Envelope, SmartMeterDataDecoded
+from logger import logger
+
+def migrate(config: AppConfig, layout_name, batch_size):
+    db = get_db()
+    layout = CreateLayout(db, config, layout_name)
+    source = db[SmartMeterDataDecoded._get_collection_name()]
+    checkpoints = db['smart_meter_migrations']
+
+    checkpoint = checkpoints.find_one({'_id': layout_name}) or {}
+    query = {'_id': {'$gt': checkpoint['last_id']}} if 'last_id' in checkpoint else {}
+    copied = checkpoint.get('copied', 0)
+    started = time.monotonic()
+
+    batch = []
+    for document in source.find(query).sort('_id', 1).batch_size(batch_size):
+        envelope = Envelope(
+            p1 = None,
+            p1_decoded = document.get('p1_decoded'),
+            signature = document['signature'],
+            s0 = document.get('s0'),
+            s1 = document.get('s1'),
+            createdAt = document['createdAt']
+        )
+        envelope._id = document['_id']
+        if document.get('base') != None:
+            # Delta reading of suppress.mode 'delta', the keyframe keeps its _id in the new layout
+            envelope.base = document['base']
+            envelope.delta = document.get('p1_decoded')
+        batch.append(envelope)
+        if len(batch) >= batch_size:
+            copied += flush(layout, checkpoints, layout_name, batch, copied)
+            logger.info(msg="Migrated {0} readings, {1:.0f} readings/s".format(copied, copied / (time.monotonic() - started)))
+            batch = []
+    if batch:
+        copied += flush(layout, checkpoints, layout_name, batch, copied)
+    logger.info(msg="Migration to '{0}' done, {1} readings".format(layout_name, copied))
+
+def flush(layout, checkpoints, layout_name, batch, copied):
+    failed = layout.insert(batch)
+    if failed:
+        logger.error(msg="{0} readings not migrated in batch ending at {1}".format(failed, batch[-1]._id))
+    checkpoints.replace_one({'_id': layout_name}, {'_id': layout_name, 'last_id': batch[-1]._id, 'copied': copied + len(batch)}, upsert=True)
+    return len(batch)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Copy decoded readings into another storage layout")
+    parser.add_argument('--layout', required=True, choices=[name for name in LAYOUTS if name != 'document'])
+    parser.add_argument('--batch', type=int, default=5000)
+    args = parser.parse_args()
+
+    appconfig = AppConfig()
+    connect(db = appconfig['mongodb']['database'], host = appconfig['mongodb']['host'], port = appconfig['mongodb']['port'])
+    migrate(appconfig, args.layout, args.batch)
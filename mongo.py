@@ -1,25 +1,50 @@
 from datetime import datetime
-from pymongo import monitoring
+from pymongo import monitoring, ASCENDING
+from pymongo.errors import CollectionInvalid, OperationFailure
+from bson import ObjectId
 from mongoengine import *
+from mongoengine.connection import get_db
+import pymongo.errors
 from dsmr import *
 from appconfig import AppConfig
 from logger import logger
-from typing import List
+from spool import Spool, SpoolReplayer
+from layouts import CreateLayout, Projection, DUPLICATE_KEY
+from archive import RawArchive
+from crc16 import CheckTelegram
+from quarantine import Quarantine
+from rollup import Rollup
+from suppress import Suppressor
+from latest import LatestCache, StartLatestServer
+from ratelimit import RateLimiter
+from metrics import REGISTRY, MetricsCommandListener, StartMetricsServer, TelegramVersion, PARSE_FAILURES, STAGE_PARSE, STAGE_QUEUE, STAGE_PERSIST, STAGE_TOTAL, BATCH_SIZE
+import logging
+import os
+import json
 import threading
+import queue
+import time
 
 class CommandLogger(monitoring.CommandListener):
     def started(self, event):
+        # Formatting for every command is not free, only do it when it is logged
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         logger.debug("Command {0.command_name} with request id "
                  "{0.request_id} started on server "
                  "{0.connection_id}".format(event))
 
     def succeeded(self, event):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         logger.debug("Command {0.command_name} with request id "
                  "{0.request_id} on server {0.connection_id} "
                  "succeeded in {0.duration_micros} "
                  "microseconds".format(event))
 
     def failed(self, event):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         logger.debug("Command {0.command_name} with request id "
                  "{0.request_id} on server {0.connection_id} "
                  "failed in {0.duration_micros} "
@@ -34,70 +59,692 @@ class SmartMeterDataRaw(Document):
     s1 = DictField(required = False, max_length=1024)
     createdAt = DateTimeField(required = True, default = datetime.utcnow)
 
+    # Created by EnsureIndexes() at startup, not on the first save
+    meta = {'indexes': [('signature', 'createdAt')], 'auto_create_index': False}
+
 class SmartMeterDataDecoded(Document):
     signature = StringField(required = True, max_length = 128)
     p1_decoded = DictField(required = False, max_length = 2048)
+    # Keyframe of a reading stored as the changed fields only
+    base = ObjectIdField(required = False)
     s0 = DictField(required = False, max_length=1024)
     s1 = DictField(required = False, max_length=1024)
     createdAt = DateTimeField(required = True, default = datetime.utcnow)
 
+    meta = {'indexes': [('signature', 'createdAt')], 'auto_create_index': False}
+
+class Envelope(object):
+    """
+    One received reading on its way to the writer
+    """
+    __slots__ = ('_id', 'p1', 'p1_decoded', 'reading', 'delta', 'base', 'suppressed', 'signature', 's0', 's1', 'createdAt', 'received', 'queued')
+
+    def __init__(self, p1, p1_decoded, signature, s0, s1, createdAt = None):
+        # Raw and decoded documents share _id and createdAt so they can be matched
+        self._id = ObjectId()
+        self.p1 = p1
+        self.p1_decoded = p1_decoded
+        self.reading = None
+        # Set by the Suppressor: decoded reading stored as delta against base, or not at all
+        self.delta = None
+        self.base = None
+        self.suppressed = False
+        self.signature = signature
+        self.s0 = s0
+        self.s1 = s1
+        self.createdAt = createdAt if createdAt != None else datetime.utcnow()
+        # time.perf_counter() at receive and enqueue, for the stage latencies
+        self.received = None
+        self.queued = None
+
+def RawFields(envelope):
+    return {
+        '_id': envelope._id,
+        'p1': envelope.p1,
+        'p1_decoded': envelope.p1_decoded,
+        'signature': envelope.signature,
+        's0': envelope.s0,
+        's1': envelope.s1,
+        'createdAt': envelope.createdAt
+    }
+
+class MongoEngineBackend(object):
+    """
+    Stores a batch through the mongoengine Documents, decoded readings go to
+    the configured layout when that is not the document layout
+    """
+    def __init__(self, config: AppConfig):
+        self.layout = None
+        if config.get('mongodb', 'layout', 'document') != 'document':
+            self.layout = CreateLayout(get_db(), config)
+        self.raw_mode = config.get('mongodb', 'raw', 'document')
+        self.archive = RawArchive(get_db(), config) if self.raw_mode == 'archive' else None
+
+    def insert(self, batch, decoded = None):
+        """
+        Returns the number of readings that could not be stored, decoded is the
+        part of the batch stored in the decoded layout, default all of it
+        """
+        decoded = batch if decoded == None else decoded
+        if self.archive != None:
+            failed = self.archive.insert(batch)
+        elif self.raw_mode == 'none':
+            failed = 0
+        else:
+            raw = [SmartMeterDataRaw(
+                id = e._id,
+                p1 = e.p1,
+                p1_decoded = e.p1_decoded,
+                signature = e.signature,
+                s0 = e.s0,
+                s1 = e.s1,
+                createdAt = e.createdAt
+            ) for e in batch]
+            failed = self._insert(SmartMeterDataRaw, raw)
+        if not decoded:
+            return failed
+        if self.layout != None:
+            return max(failed, self.layout.insert(decoded))
+        documents = [SmartMeterDataDecoded(
+            id = e._id,
+            p1_decoded = e.p1_decoded if e.base == None else e.delta,
+            base = e.base,
+            signature = e.signature,
+            s0 = e.s0,
+            s1 = e.s1,
+            createdAt = e.createdAt
+        ) for e in decoded]
+        return max(failed, self._insert(SmartMeterDataDecoded, documents))
+
+    def _insert(self, document, documents):
+        try:
+            document.objects.insert(documents, load_bulk=False)
+            return 0
+        except (NotUniqueError, BulkWriteError):
+            # Batch retried after a partial write, the insert is ordered so
+            # store the remaining documents one by one
+            failed = 0
+            for item in documents:
+                try:
+                    document.objects.insert(item, load_bulk=False)
+                except NotUniqueError:
+                    pass
+                except OperationError:
+                    failed += 1
+            return failed
+
+# Collection validators, the server side replacement of the Document field checks
+RAW_VALIDATOR = {'$jsonSchema': {
+    'bsonType': 'object',
+    'required': ['p1', 'signature', 'createdAt'],
+    'properties': {
+        'p1': {'bsonType': 'string', 'maxLength': 2048},
+        'p1_decoded': {'bsonType': 'object'},
+        'signature': {'bsonType': 'string', 'maxLength': 128},
+        's0': {'bsonType': 'object'},
+        's1': {'bsonType': 'object'},
+        'createdAt': {'bsonType': 'date'}
+    }
+}}
+
+DECODED_VALIDATOR = {'$jsonSchema': {
+    'bsonType': 'object',
+    'required': ['signature', 'createdAt'],
+    'properties': {
+        'p1_decoded': {'bsonType': 'object'},
+        'base': {'bsonType': 'objectId'},
+        'signature': {'bsonType': 'string', 'maxLength': 128},
+        's0': {'bsonType': 'object'},
+        's1': {'bsonType': 'object'},
+        'createdAt': {'bsonType': 'date'}
+    }
+}}
+
+def ApplyValidator(db, name, validator, action = 'error'):
+    """
+    Create the collection with a validator, or attach it to an existing collection
+    """
+    try:
+        try:
+            db.create_collection(name, validator=validator, validationLevel='moderate', validationAction=action)
+        except CollectionInvalid:
+            db.command('collMod', name, validator=validator, validationLevel='moderate', validationAction=action)
+    except OperationFailure as e:
+        logger.warning(msg="Validator for {0} not applied: {1}".format(name, str(e)))
+
+# Code of createIndex for an index that exists with other options
+INDEX_OPTIONS_CONFLICT = 85
+
+def EnsureTTL(collection, days, name = 'createdAt_ttl'):
+    """
+    Expire documents days after createdAt, days 0 removes the expiry
+    """
+    if not days:
+        if name in collection.index_information():
+            collection.drop_index(name)
+            logger.info(msg="TTL of {0} removed".format(collection.name))
+        return
+    seconds = int(days * 86400)
+    try:
+        collection.create_index([('createdAt', ASCENDING)], name=name, expireAfterSeconds=seconds)
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        # Same index with another expiry, change it in place
+        collection.database.command('collMod', collection.name, index={'name': name, 'expireAfterSeconds': seconds})
+        logger.info(msg="TTL of {0} changed to {1} days".format(collection.name, days))
+
+def EnsureIndexes(db, config: AppConfig):
+    """
+    Indexes declared on the Documents, the TTL of the raw telegrams and the
+    extra mongodb.indexes: [{collection, keys: [[field, 1 or -1]], partial: {filter}}]
+    """
+    try:
+        if config.get('mongodb', 'raw', 'document') == 'document':
+            SmartMeterDataRaw.ensure_indexes()
+            EnsureTTL(db[SmartMeterDataRaw._get_collection_name()], config.get('mongodb', 'raw_ttl_days', 0))
+        if config.get('mongodb', 'layout', 'document') == 'document':
+            SmartMeterDataDecoded.ensure_indexes()
+        for index in config.get('mongodb', 'indexes', []):
+            options = {}
+            if index.get('partial'):
+                options['partialFilterExpression'] = index['partial']
+            if index.get('name'):
+                options['name'] = index['name']
+            db[index['collection']].create_index([(field, direction) for field, direction in index['keys']], **options)
+    except OperationFailure as e:
+        logger.warning(msg="Indexes not created: {0}".format(str(e)))
+
+def RawReadings(db, signature, start, end, fields = None, batch_size = 1000):
+    """
+    Raw documents of one meter with start <= createdAt < end, oldest first, as a
+    cursor that fetches batch_size documents at a time. fields limits the
+    returned fields, _id and createdAt are always there.
+    """
+    return db[SmartMeterDataRaw._get_collection_name()].find(
+        {'signature': signature, 'createdAt': {'$gte': start, '$lt': end}}, Projection(fields)
+    ).sort('createdAt', ASCENDING).batch_size(batch_size)
+
+class PyMongoBackend(object):
+    """
+    Stores a batch as plain dicts with unordered insert_many on the pooled
+    mongoengine connection, same collections and field layout as the Documents
+    """
+    def __init__(self, config: AppConfig):
+        db = get_db()
+        self.raw = db[SmartMeterDataRaw._get_collection_name()]
+        self.layout = CreateLayout(db, config)
+        self.raw_mode = config.get('mongodb', 'raw', 'document')
+        self.archive = RawArchive(db, config) if self.raw_mode == 'archive' else None
+
+        action = config.get('mongodb', 'validation', 'error')
+        if action != 'off':
+            ApplyValidator(db, self.raw.name, RAW_VALIDATOR, action)
+            if config.get('mongodb', 'layout', 'document') == 'document':
+                ApplyValidator(db, SmartMeterDataDecoded._get_collection_name(), DECODED_VALIDATOR, action)
+
+    def insert(self, batch, decoded = None):
+        """
+        Returns the number of readings that could not be stored, decoded is the
+        part of the batch stored in the decoded layout, default all of it
+        """
+        decoded = batch if decoded == None else decoded
+        if self.archive != None:
+            failed = self.archive.insert(batch)
+        elif self.raw_mode == 'none':
+            failed = 0
+        else:
+            failed = self._insert(self.raw, [RawFields(e) for e in batch])
+        if not decoded:
+            return failed
+        return max(failed, self.layout.insert(decoded))
+
+    def _insert(self, collection, documents):
+        try:
+            collection.insert_many(documents, ordered=False)
+            return 0
+        except pymongo.errors.BulkWriteError as e:
+            # Duplicates are documents stored by an earlier attempt of a retried batch
+            errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY]
+            if errors:
+                logger.error(msg="Insert into {0}: {1} documents rejected, first: {2}".format(collection.name, len(errors), errors[0]['errmsg']))
+            return len(errors)
+
+BACKENDS = {
+    'mongoengine': MongoEngineBackend,
+    'pymongo': PyMongoBackend
+}
+
+class WriterStats(object):
+    """
+    Counters of the Mongo writer, shared by the writer threads
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.blocked = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def flushed(self, size, duration_ms, failed = 0):
+        with self.lock:
+            self.batches += 1
+            self.written += size - failed
+            self.failed += failed
+            self.last_batch_size = size
+            self.max_batch_size = max(self.max_batch_size, size)
+            self.last_flush_ms = duration_ms
+            self.max_flush_ms = max(self.max_flush_ms, duration_ms)
+            self.total_flush_ms += duration_ms
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'blocked': self.blocked,
+                'written': self.written,
+                'failed': self.failed,
+                'batches': self.batches,
+                'last_batch_size': self.last_batch_size,
+                'max_batch_size': self.max_batch_size,
+                'avg_batch_size': self.written / self.batches if self.batches else 0.0,
+                'last_flush_ms': self.last_flush_ms,
+                'max_flush_ms': self.max_flush_ms,
+                'avg_flush_ms': self.total_flush_ms / self.batches if self.batches else 0.0
+            }
+
 class MongoEngine(object):
     def __init__(self, config: AppConfig):
 
         monitoring.register(CommandLogger())
+        monitoring.register(MetricsCommandListener())
 
         database = config['mongodb']['database']
         host = config['mongodb']['host']
         port = config['mongodb']['port']
-        connect(db = database, host = host, port = port )
+        connect(db = database, host = host, port = port, maxPoolSize = config.get('mongodb', 'pool_size', 10))
+        self.backend = BACKENDS[config.get('mongodb', 'backend', 'mongoengine')](config)
+        EnsureIndexes(get_db(), config)
+
+        # 'regex' or 'obis', verify also runs the regex engine and logs differences
+        self.parser_engine = config.get('parser', 'engine', 'regex')
+        self.parser_verify = config.get('parser', 'verify', False)
+        # Meters whose 'regex' strategy is known, their telegrams skip the version detection
+        STRATEGY_CACHE.max_meters = config.get('parser', 'cache_meters', 100000)
+
+        # p1_decoded as the 'nested' ToJSON() shape or the flat 'compact' shape,
+        # compact readings find their units in smart_meter_units by version
+        self.encoding = config.get('mongodb', 'encoding', 'nested')
+        if self.encoding == 'compact':
+            units = get_db()['smart_meter_units']
+            for version, version_units in READING_UNITS.items():
+                units.replace_one({'_id': version}, {'_id': version, 'units': version_units}, upsert=True)
+
+        # Per meter admission before anything else, a noisy gateway can not take
+        # the throughput of the other meters
+        self.ratelimit = None
+        if config.get('ratelimit', 'enabled', False):
+            self.ratelimit = RateLimiter(config)
+        # With the spool the backlog on disk is what fills up, not the queue.
+        # Listing the segments is not free, the fill is refreshed once a second
+        self.spool_full = config.get('ratelimit', 'spool_backlog_mb', 0) * 1024 * 1024
+        self._spool_fill = (0.0, 0.0)
 
-        self.queue: List[SmartMeterDataRaw] = list()
-        self.decodedqueue: List[SmartMeterDataDecoded] = list()
+        # CRC16 check before parsing, 'off', 'reject' or 'quarantine'
+        self.quarantine = None
+        if config.get('parser', 'crc', 'off') != 'off':
+            self.quarantine = Quarantine(get_db(), config)
 
-    def _store_thread(self, emon: SmartMeterDataRaw, emon2: SmartMeterDataDecoded):
+        # Decoded readings that did not change: 'off', 'drop' or 'delta'
+        self.suppressor = None
+        if config.get('suppress', 'mode', 'off') != 'off':
+            self.suppressor = Suppressor(config)
+
+        # Per meter aggregates, optionally instead of every decoded reading
+        self.rollup = None
+        if config.get('rollup', 'enabled', False):
+            self.rollup = Rollup(get_db(), config)
+
+        # Latest reading per meter for the apps, served without a query
+        self.latest = None
+        self.latest_server = None
+        if config.get('latest', 'enabled', False):
+            self.latest = LatestCache(config)
+            self.latest_server = StartLatestServer(config, self.latest)
+
+        # Writer: a batch is flushed when it is full or when the oldest reading
+        # waited linger_ms. A full queue blocks save(), and with it the MQTT
+        # network thread, instead of buffering without limit.
+        self.batch_size = config.get('mongodb', 'batch_size', 500)
+        self.linger = config.get('mongodb', 'linger_ms', 250) / 1000.0
+        self.queue = queue.Queue(maxsize = config.get('mongodb', 'queue_size', 10000))
+        self.stats = WriterStats()
+        self.update_rate = config.get('logger', 'update_rate', 10)
+
+        self._stopping = threading.Event()
+        self._writers = []
+
+        # With the write-ahead spool save() appends to disk and the replayer is the
+        # only writer, readings survive database outages and restarts
+        self.spool = None
+        self.replayer = None
+        if config.get('spool', 'enabled', False):
+            root = os.path.dirname(os.path.realpath(__file__))
+            self.spool = Spool(
+                directory = os.path.join(root, config.get('spool', 'directory', 'spool')),
+                segment_size = config.get('spool', 'segment_mb', 64) * 1024 * 1024,
+                fsync = config.get('spool', 'fsync', 'interval'),
+                fsync_interval = config.get('spool', 'fsync_interval_ms', 1000) / 1000.0,
+                use_mmap = config.get('spool', 'mmap', True),
+                retain_segments = config.get('spool', 'retain_segments', 0),
+                max_segments = config.get('spool', 'max_segments', 256)
+            )
+            self.replayer = SpoolReplayer(self.spool, self._store_spooled, batch_size = config.get('spool', 'batch_size', 5000))
+            self.replayer.start()
+        else:
+            for index in range(config.get('mongodb', 'writers', 1)):
+                writer = threading.Thread(target=self._writer_thread, name="mongo-writer-{0}".format(index))
+                writer.daemon = True
+                writer.start()
+                self._writers.append(writer)
+
+        REGISTRY.gauge('emon_queue_depth', 'Readings waiting for the writer', self.queue.qsize)
+        REGISTRY.gauge('emon_written_total', 'Readings stored', lambda: self.stats.written, 'counter')
+        REGISTRY.gauge('emon_failed_total', 'Readings that could not be stored', lambda: self.stats.failed, 'counter')
+        REGISTRY.gauge('emon_blocked_total', 'save() calls that waited for a full queue', lambda: self.stats.blocked, 'counter')
+        if self.parser_engine == 'regex':
+            REGISTRY.gauge('emon_parser_cache_hits_total', 'Telegrams parsed with the cached strategy of their meter', lambda: STRATEGY_CACHE.hits, 'counter')
+            REGISTRY.gauge('emon_parser_cache_misses_total', 'Telegrams that needed the DSMR version detection', lambda: STRATEGY_CACHE.misses + STRATEGY_CACHE.changes, 'counter')
+        if self.latest != None:
+            REGISTRY.gauge('emon_latest_meters', 'Meters in the latest reading cache', lambda: self.latest.stats()['latest_meters'])
+        if self.rollup != None:
+            REGISTRY.gauge('emon_rollup_open_windows', 'Rollup windows kept in memory', lambda: self.rollup.stats()['rollup_open'])
+        if self.replayer != None:
+            REGISTRY.gauge('emon_spool_backlog_bytes', 'Spooled bytes not replayed yet', self.spool.backlog)
+        self.metrics_server = StartMetricsServer(config)
+
+        self._reporter = threading.Thread(target=self._reporter_thread, name="mongo-stats")
+        self._reporter.daemon = True
+        self._reporter.start()
+
+    def _writer_thread(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self.linger)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        for envelope in batch:
+            if envelope.queued != None:
+                STAGE_QUEUE.observe(started - envelope.queued)
         try:
-            SmartMeterDataRaw.objects.insert(self.queue, load_bulk=False)
-            self.queue.clear()
-            SmartMeterDataDecoded.objects.insert(self.decodedqueue, load_bulk=False)
-            self.decodedqueue.clear()
+            decoded, suppressed = self._decoded(batch)
+            failed = self.backend.insert(batch, decoded)
+            if suppressed != None and not failed:
+                self.suppressor.commit(suppressed)
+            if self.rollup != None:
+                self.rollup.add(batch)
             logger.debug(msg="Emon.save() succesfull")
         except Exception as e:
-            logger.error(msg=("Emon.save() exception: {0}", str(e)))
+            failed = len(batch)
+            logger.error(msg="Emon.save() exception, {0} readings lost: {1}".format(len(batch), str(e)))
+        done = time.perf_counter()
+        self.stats.flushed(len(batch), (done - started) * 1000.0, failed)
+        STAGE_PERSIST.observe(done - started)
+        BATCH_SIZE.observe(len(batch))
+        for envelope in batch:
+            if envelope.received != None:
+                STAGE_TOTAL.observe(done - envelope.received)
 
-    def save(self, json_payload):
+    def _decoded(self, batch):
+        # The part of a batch stored in the decoded layout, and the suppressor
+        # states to commit once it is stored. Suppression comes after the
+        # downsample, so that its keyframes are readings that are stored
+        if self.rollup != None:
+            batch = self.rollup.decoded(batch)
+        if self.suppressor == None:
+            return batch, None
+        suppressed = self.suppressor.apply(batch)
+        return [envelope for envelope in batch if not envelope.suppressed], suppressed
 
-        try:
-            self.emon = SmartMeterDataRaw(
-                p1 = json_payload['datagram']['p1'],
-                signature = json_payload['datagram']['signature'],
-                s0 = json_payload['datagram']['s0'],
-                s1 = json_payload['datagram']['s1']
-            )
-            #print(self.emon.p1)
-            # Parse P1 message
-            self.emon.p1_decoded = DSMR_Parser(self.emon.p1).parse()
-            #print(self.emon.p1_decoded)
-            # Save to db
-            # self.emon.save()
-
-            
-            self.decoded = SmartMeterDataDecoded(
-                p1_decoded = self.emon.p1_decoded,
-                signature = json_payload['datagram']['signature'],
-                s0 = json_payload['datagram']['s0'],
-                s1 = json_payload['datagram']['s1']
+    def _store_spooled(self, payloads):
+        # Called by the replayer, raising makes it retry the same payloads later
+        batch = []
+        for payload in payloads:
+            record = json.loads(payload)
+            datagram = record['datagram']
+            envelope = Envelope(
+                p1 = datagram['p1'],
+                p1_decoded = None,
+                signature = datagram['signature'],
+                s0 = datagram['s0'],
+                s1 = datagram['s1'],
+                createdAt = datetime.utcfromtimestamp(record['createdAt'])
             )
-            self.decodedqueue.append(self.decoded)
+            envelope._id = ObjectId(record['_id'])
+            try:
+                self._decode(envelope)
+            except Exception as e:
+                logger.error(msg=("Emon.save() exception: {0}", e))
+                continue
+            if self.latest != None:
+                self.latest.update(envelope)
+            batch.append(envelope)
 
-            # Queue multiple documents and try to save
-            self.queue.append(self.emon)
-            thread = threading.Thread(target=self._store_thread, args=(self.queue, self.decodedqueue, ))
-            thread.daemon = True
-            thread.start()
+        if batch:
+            started = time.perf_counter()
+            decoded, suppressed = self._decoded(batch)
+            failed = self.backend.insert(batch, decoded)
+            if suppressed != None and not failed:
+                self.suppressor.commit(suppressed)
+            if self.rollup != None:
+                # Only once the batch is stored, a failed batch is replayed again
+                self.rollup.add(batch)
+            duration = time.perf_counter() - started
+            self.stats.flushed(len(batch), duration * 1000.0, failed)
+            STAGE_PERSIST.observe(duration)
+            BATCH_SIZE.observe(len(batch))
 
+    def _reporter_thread(self):
+        while not self._stopping.wait(self.update_rate):
+            stats = self.stats_snapshot()
+            logger.info(msg="Mongo writer: queue {queue_depth}, written {written}, failed {failed}, "
+                            "batch avg {avg_batch_size:.1f} max {max_batch_size}, "
+                            "flush avg {avg_flush_ms:.1f} ms max {max_flush_ms:.1f} ms, "
+                            "blocked {blocked}".format(**stats))
+            if self.backend.archive != None:
+                logger.info(msg="Raw archive: {archive_bytes_in} bytes compressed to {archive_bytes_out}, "
+                                "ratio {archive_ratio:.1f}".format(**stats))
+            if self.quarantine != None and stats['corrupt_total']:
+                logger.info(msg="Corrupt telegrams: {0}, most from {1}".format(stats['corrupt_total'],
+                    ', '.join('{0} ({1})'.format(signature, count) for signature, count in stats['corrupt_worst'])))
+            if self.suppressor != None:
+                logger.info(msg="Suppressed: {suppress_dropped} dropped, {suppress_deltas} changes, "
+                                "{suppress_keyframes} keyframes".format(**stats))
+            if self.rollup != None:
+                logger.info(msg="Rollup: {rollup_open} windows open, {rollup_flushed} written, "
+                                "{rollup_late} late readings".format(**stats))
+            if self.ratelimit != None and (stats['ratelimit_throttled'] or stats['ratelimit_interval'] or stats['ratelimit_shed']):
+                logger.info(msg="Rate limits: {0} throttled, {1} too soon, {2} shed, most from {3}".format(
+                    stats['ratelimit_throttled'], stats['ratelimit_interval'], stats['ratelimit_shed'],
+                    ', '.join('{0} ({1}/{2})'.format(signature, throttled, shed) for signature, throttled, shed in stats['ratelimit_worst'])))
+            if self.parser_engine == 'regex':
+                logger.info(msg="Parser cache: {parser_cache_meters} meters, {parser_cache_hits} hits, "
+                                "{parser_cache_misses} misses, {parser_cache_changes} changed".format(**stats))
+            if self.replayer != None:
+                logger.info(msg="Spool: appended {spool_appended}, replayed {spool_replayed}, "
+                                "{spool_replay_rate:.0f} readings/s, backlog {spool_backlog_bytes} bytes".format(**stats))
 
-            
+    def stats_snapshot(self):
+        stats = self.stats.snapshot()
+        stats['queue_depth'] = self.queue.qsize()
+        if self.replayer != None:
+            stats.update(self.replayer.stats())
+        if self.backend.archive != None:
+            stats.update(self.backend.archive.stats())
+        if self.quarantine != None:
+            stats.update(self.quarantine.stats())
+        if self.suppressor != None:
+            stats.update(self.suppressor.stats())
+        if self.rollup != None:
+            stats.update(self.rollup.stats())
+        if self.latest != None:
+            stats.update(self.latest.stats())
+        if self.ratelimit != None:
+            stats.update(self.ratelimit.stats())
+        if self.parser_engine == 'regex':
+            stats.update(STRATEGY_CACHE.stats())
+        return stats
 
-        except Exception as str:
-            logger.error(msg=("Emon.save() exception: {0}", str))
+    def _verify_parser(self, p1, decoded):
+        # decoded in the nested shape
+        try:
+            expected = DSMR_Parser(p1).parse()
+        except Exception as e:
+            expected = str(e)
+        if expected != decoded:
+            logger.warning(msg="Parser engine '{0}' differs from regex engine for: {1}".format(self.parser_engine, p1[0:40]))
+
+    def _decode(self, envelope: Envelope):
+        # Parse P1 message
+        started = time.perf_counter()
+        try:
+            envelope.reading = DSMR_Parser(envelope.p1, self.parser_engine, envelope.signature).reading()
+        except Exception:
+            PARSE_FAILURES.labels(TelegramVersion(envelope.p1)).inc()
+            raise
+        STAGE_PARSE.observe(time.perf_counter() - started)
+        if envelope.reading == None:
+            PARSE_FAILURES.labels(TelegramVersion(envelope.p1)).inc()
+            envelope.p1_decoded = {}
+        elif self.encoding == 'compact':
+            envelope.p1_decoded = envelope.reading.ToCompact()
+        else:
+            envelope.p1_decoded = envelope.reading.ToJSON()
+        if self.parser_verify and self.parser_engine != 'regex':
+            self._verify_parser(envelope.p1, envelope.reading.ToJSON() if envelope.reading != None else {})
+
+    def _fill(self):
+        # 0.0 to 1.0, how full the spool backlog or else the writer queue is
+        if self.spool != None:
+            now = time.monotonic()
+            if now - self._spool_fill[0] >= 1.0:
+                full = self.spool_full or self.spool.max_segments * self.spool.segment_size
+                self._spool_fill = (now, self.spool.backlog() / float(full))
+            return self._spool_fill[1]
+        if self.queue.maxsize <= 0:
+            # Unbounded queue, no high water
+            return 0.0
+        return self.queue.qsize() / float(self.queue.maxsize)
+
+    def _update_latest(self, datagram, createdAt):
+        # Spool mode: the latest cache follows the intake, not the replayer that
+        # may lag behind. The telegram is parsed again on replay
+        try:
+            reading = DSMR_Parser(datagram['p1'], self.parser_engine, datagram['signature']).reading()
+        except Exception:
+            return
+        if reading == None:
+            return
+        self.latest.update(Envelope(
+            p1 = datagram['p1'],
+            p1_decoded = reading.ToCompact() if self.encoding == 'compact' else reading.ToJSON(),
+            signature = datagram['signature'],
+            s0 = datagram['s0'],
+            s1 = datagram['s1'],
+            createdAt = createdAt
+        ))
+
+    def save(self, json_payload, received = None):
+        # received: time.perf_counter() when the MQTT message arrived
+
+        try:
+            datagram = json_payload['datagram']
+            if self.ratelimit != None:
+                if self.ratelimit.admit(datagram['signature'], self._fill()) != None:
+                    return
+
+            if self.quarantine != None:
+                reason = CheckTelegram(datagram['p1'])
+                if reason != None:
+                    self.quarantine.add(datagram['signature'], datagram['p1'], reason)
+                    return
+
+            if self.spool != None:
+                # Durable on disk before the message is acknowledged, parsed on replay
+                now = time.time()
+                if self.latest != None:
+                    self._update_latest(datagram, datetime.utcfromtimestamp(now))
+                self.spool.append(json.dumps({
+                    '_id': str(ObjectId()),
+                    'createdAt': now,
+                    'datagram': {
+                        'p1': datagram['p1'],
+                        'signature': datagram['signature'],
+                        's0': datagram['s0'],
+                        's1': datagram['s1']
+                    }
+                }).encode())
+                with self.stats.lock:
+                    self.stats.queued += 1
+                return
+
+            envelope = Envelope(
+                p1 = datagram['p1'],
+                p1_decoded = None,
+                signature = datagram['signature'],
+                s0 = datagram['s0'],
+                s1 = datagram['s1']
+            )
+            envelope.received = received if received != None else time.perf_counter()
+            self._decode(envelope)
+            if self.latest != None:
+                self.latest.update(envelope)
+
+            # Hand over to the writer, block while the queue is full
+            envelope.queued = time.perf_counter()
+            try:
+                self.queue.put_nowait(envelope)
+            except queue.Full:
+                with self.stats.lock:
+                    self.stats.blocked += 1
+                self.queue.put(envelope)
+            with self.stats.lock:
+                self.stats.queued += 1
+
+        except Exception as e:
+            logger.error(msg=("Emon.save() exception: {0}", e))
 
+    def stop(self):
+        # Let the writers drain the queue before returning, the spool keeps
+        # whatever is not replayed yet for the next start
+        self._stopping.set()
+        for writer in self._writers:
+            writer.join()
+        if self.replayer != None:
+            self.replayer.stop()
+        if self.rollup != None:
+            self.rollup.stop()
@@ -2,20 +2,34 @@ import paho.mqtt.client as mqtt
 from appconfig import AppConfig
 from mongo import MongoEngine
 from logger import logger
-import json
+from metrics import MESSAGES, STAGE_JSON
+from payloads import PayloadDecoder
+import json, logging, time
 
 class MQTT(object):
 
-    def __init__(self, config: AppConfig, mongo: MongoEngine):
+    def __init__(self, config: AppConfig, mongo: MongoEngine, share = None):
         self.mqttClient = mqtt.Client("", clean_session=True)
         self.appConfig = config
         self.mongo = mongo
+        self.payloads = PayloadDecoder(config)
+        # The main topic and the topics of the binary payload codecs, a worker
+        # of the supervisor subscribes to $share/<group>/<topic>
+        self.topics = [config.get('mqtt', 'topic', 'smartmeter/raw')] + self.payloads.subscriptions()
+        if share != None:
+            self.topics = ['$share/{0}/{1}'.format(share, topic) for topic in self.topics]
+        # Latest reading per meter as a retained message on <latest.topic>/<signature>
+        self.latest_topic = config.get('latest', 'topic', '')
+        if mongo.latest != None and self.latest_topic:
+            mongo.latest.publisher = self.publish_latest
 
     #
     # Mqtt events
     #
     def on_connect(self, mqttc, obj, flags, rc):
-        self.mqttClient.subscribe("smartmeter/raw", 0)
+        # QoS 1 lets the broker redeliver what was not acknowledged, use it with the spool
+        qos = self.appConfig.get('mqtt', 'qos', 0)
+        self.mqttClient.subscribe([(topic, qos) for topic in self.topics])
         if rc==0:
             logger.info(msg="MQTT Succesfully connect to broker")
         else:
@@ -23,12 +37,21 @@ class MQTT(object):
 
     def on_message(self, mqttc, obj, msg):
         try:
-            json_payload = json.loads(msg.payload)
-            self.mongo.save(json_payload)
-            logger.debug(msg = json.dumps(json_payload)[0:15])
+            received = time.perf_counter()
+            MESSAGES.inc()
+            json_payload = self.payloads.decode(msg.topic, msg.payload)
+            STAGE_JSON.observe(time.perf_counter() - received)
+            self.mongo.save(json_payload, received)
+            if logger.isEnabledFor(logging.DEBUG):
+                # The start of the payload as received, nothing is serialised again for the log
+                logger.debug(msg = repr(msg.payload[0:15]))
 
-        except Exception as str:
-            logger.error(msg= ("Emon.save() exception: {0}", str) )
+        except Exception as e:
+            logger.error(msg="Emon.save() exception: {0}".format(e))
+
+    def publish_latest(self, signature, document):
+        if self.mqttClient.is_connected():
+            self.mqttClient.publish('{0}/{1}'.format(self.latest_topic, signature), json.dumps(document), qos=0, retain=True)
 
     def on_publish(self, mqttc, obj, mid):
         pass
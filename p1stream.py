@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+"""
+Read telegrams straight from P1 ports, without gateway and MQTT broker
+
+    "p1stream": {"sources": [
+        {"signature": "meter-0001", "tcp": "ser2net.local:2001"},
+        {"signature": "meter-0002", "serial": "/dev/ttyUSB0", "baudrate": 115200}
+    ]}
+
+Every source is read in one asyncio event loop. P1Framer cuts the byte stream
+into telegrams from the '/' header to the '!' and CRC trailer, whatever the
+chunks the reads return. Complete telegrams go through MongoEngine.save() like
+MQTT messages, CRC check and quarantine included. save() runs in the default
+executor, a slow write only holds up the stream of its own telegram. Serial
+ports need the pyserial-asyncio package, TCP streams (ser2net) nothing more.
+"""
+import asyncio, random, signal, time
+
+from appconfig import AppConfig
+from metrics import REGISTRY
+from mongo import MongoEngine
+from logger import logger
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+HEX = b'0123456789ABCDEFabcdef'
+
+class P1Framer(object):
+    """
+    Complete telegrams out of arbitrary chunks of a P1 byte stream
+
+    The bytes are kept in one bytearray that consumed bytes are deleted from
+    the front of. Every search continues where the previous one stopped, not at
+    the start of the frame. Bytes before a '/' are garbage. A '/' before the
+    '!' means the frame was cut off, the framer resyncs on the new header. A
+    frame longer than max_size is dropped the same way.
+    """
+    def __init__(self, max_size = 16384):
+        self.max_size = max_size
+        self.buffer = bytearray()
+        # buffer starts with a '/' when in_frame, searches continue from scan
+        self.in_frame = False
+        self.scan = 0
+
+        self.frames = 0
+        self.partial = 0
+        self.oversized = 0
+        self.garbage = 0
+
+    def feed(self, data):
+        """
+        The telegrams completed by data, as text
+        """
+        buffer = self.buffer
+        buffer += data
+        telegrams = []
+        while True:
+            if not self.in_frame:
+                start = buffer.find(b'/', self.scan)
+                if start < 0:
+                    self.garbage += len(buffer)
+                    del buffer[:]
+                    self.scan = 0
+                    return telegrams
+                self.garbage += start
+                del buffer[:start]
+                self.in_frame = True
+                self.scan = 1
+
+            end = buffer.find(b'!', self.scan)
+            restart = buffer.find(b'/', self.scan, end if end >= 0 else len(buffer))
+            if restart >= 0:
+                # A new header before the footer, the frame was cut off
+                self.partial += 1
+                self._resync(restart)
+                continue
+            if end < 0:
+                self.scan = len(buffer)
+                if len(buffer) > self.max_size:
+                    self.oversized += 1
+                    self._resync(len(buffer))
+                return telegrams
+
+            # The trailer: up to four hex digits of the CRC and the line end
+            stop = end + 1
+            while stop < len(buffer) and stop < end + 5 and buffer[stop] in HEX:
+                stop += 1
+            if stop == len(buffer):
+                # The rest of the trailer is in the next chunk
+                self.scan = end
+                return telegrams
+            if buffer[stop] == 13:
+                stop += 1
+                if stop == len(buffer):
+                    self.scan = end
+                    return telegrams
+            if buffer[stop] == 10:
+                stop += 1
+            telegrams.append(buffer[:stop].decode('ascii', errors='replace'))
+            self.frames += 1
+            del buffer[:stop]
+            self.in_frame = False
+            self.scan = 0
+
+    def close(self):
+        """
+        At the end of the stream: the last telegram when only its line end is missing
+        """
+        telegrams = []
+        if self.in_frame and self.buffer.find(b'!') >= 0:
+            telegrams.append(self.buffer.decode('ascii', errors='replace'))
+            self.frames += 1
+        elif self.in_frame:
+            self.partial += 1
+        else:
+            self.garbage += len(self.buffer)
+        del self.buffer[:]
+        self.in_frame = False
+        self.scan = 0
+        return telegrams
+
+    def _resync(self, position):
+        # Drop the frame in progress, search the next header from position on
+        del self.buffer[:position]
+        self.in_frame = False
+        self.scan = 0
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'partial': self.partial,
+            'oversized': self.oversized,
+            'garbage_bytes': self.garbage
+        }
+
+class P1Stream(object):
+    def __init__(self, config: AppConfig, mongo: MongoEngine):
+        self.config = config
+        self.mongo = mongo
+        self.sources = config.get('p1stream', 'sources', [])
+        self.max_frame = config.get('p1stream', 'max_frame', 16384)
+        self.read_size = config.get('p1stream', 'read_size', 4096)
+        self.max_backoff = config.get('p1stream', 'max_backoff', 60.0)
+        # signature -> P1Framer of its source, kept over reconnects
+        self.framers = {}
+        self.reconnects = 0
+        REGISTRY.gauge('emon_p1_frames_total', 'Telegrams read from P1 streams',
+                       lambda: sum(framer.frames for framer in self.framers.values()), type='counter')
+        REGISTRY.gauge('emon_p1_dropped_frames_total', 'Cut off and oversized frames of P1 streams',
+                       lambda: sum(framer.partial + framer.oversized for framer in self.framers.values()), type='counter')
+        REGISTRY.gauge('emon_p1_garbage_bytes_total', 'Bytes of P1 streams outside any telegram',
+                       lambda: sum(framer.garbage for framer in self.framers.values()), type='counter')
+
+    async def open(self, source):
+        if 'tcp' in source:
+            host, port = source['tcp'].rsplit(':', 1)
+            return await asyncio.open_connection(host, int(port))
+        if serial_asyncio == None:
+            raise RuntimeError("serial port {0} needs the pyserial-asyncio package".format(source['serial']))
+        return await serial_asyncio.open_serial_connection(url = source['serial'], baudrate = source.get('baudrate', 115200))
+
+    async def read(self, source):
+        signature = source['signature']
+        name = source.get('tcp') or source.get('serial')
+        framer = self.framers[signature] = P1Framer(self.max_frame)
+        loop = asyncio.get_running_loop()
+        backoff = 1.0
+        while True:
+            try:
+                reader, writer = await self.open(source)
+                logger.info(msg="P1 stream of {0} connected to {1}".format(signature, name))
+                backoff = 1.0
+                try:
+                    while True:
+                        data = await reader.read(self.read_size)
+                        if not data:
+                            raise ConnectionError("end of stream")
+                        for telegram in framer.feed(data):
+                            await loop.run_in_executor(None, self.store, signature, telegram)
+                finally:
+                    writer.close()
+            except (OSError, RuntimeError) as e:
+                # A telegram in progress does not continue on the next connection
+                for telegram in framer.close():
+                    await loop.run_in_executor(None, self.store, signature, telegram)
+                self.reconnects += 1
+                delay = backoff * (0.5 + random.random() / 2)
+                logger.info(msg="P1 stream of {0} from {1} lost ({2}), retry in {3:.1f} seconds".format(signature, name, str(e), delay))
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def store(self, signature, telegram):
+        # In a thread of the default executor: save() parses, can wait for a full
+        # writer queue or a spool fsync. Only the stream of the telegram waits for it
+        self.mongo.save({'datagram': {'p1': telegram, 'signature': signature, 's0': {}, 's1': {}}}, time.perf_counter())
+
+    async def run(self):
+        if not self.sources:
+            logger.error(msg="No P1 sources in p1stream.sources")
+            return
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, stopping.set)
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+
+        readers = [asyncio.create_task(self.read(source)) for source in self.sources]
+        await stopping.wait()
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        logger.info(msg="P1 streams stopped: {0}".format(dict((signature, framer.stats()) for signature, framer in self.framers.items())))
+
+if __name__ == '__main__':
+    appconfig = AppConfig()
+    mongo = MongoEngine(config = appconfig)
+    try:
+        asyncio.run(P1Stream(appconfig, mongo).run())
+    finally:
+        mongo.stop()
@@ -0,0 +1,78 @@
+"""
+Codecs of the MQTT payloads
+
+All carry the same message, {"datagram": {"p1", "signature", "s0", "s1"}}.
+Gateways send JSON on the main topic, or opt in to a binary encoding by
+publishing on a topic that payloads.topics maps to 'msgpack' or 'cbor'.
+'orjson' decodes the same JSON several times faster than the json module.
+Codecs whose module is not installed fall back to 'json'.
+"""
+import functools, json
+from paho.mqtt.client import topic_matches_sub
+from appconfig import AppConfig
+from logger import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# name -> (decode, encode), bytes in and out
+CODECS = {
+    'json': (json.loads, lambda message: json.dumps(message).encode())
+}
+if orjson != None:
+    CODECS['orjson'] = (orjson.loads, orjson.dumps)
+if msgpack != None:
+    CODECS['msgpack'] = (functools.partial(msgpack.unpackb, raw=False), msgpack.packb)
+if cbor2 != None:
+    CODECS['cbor'] = (cbor2.loads, cbor2.dumps)
+
+def Decoder(name):
+    """
+    Decode function of a codec, json when it is not installed
+    """
+    if name not in CODECS:
+        logger.warning(msg="Payload codec {0} is not installed, using json".format(name))
+        name = 'json'
+    return CODECS[name][0]
+
+class PayloadDecoder(object):
+    """
+    Picks the decoder by the topic a message arrived on
+    """
+    def __init__(self, config: AppConfig):
+        self.default = Decoder(config.get('payloads', 'default', 'json'))
+        # [(topic filter, decoder)], the first match wins
+        self.topics = [(topic, Decoder(name)) for topic, name in config.get('payloads', 'topics', {}).items()]
+        # topic -> decoder, matching filters for every message is not free
+        self._decoders = {}
+        self.max_topics = 10000
+
+    def subscriptions(self):
+        return [topic for topic, decoder in self.topics]
+
+    def decoder(self, topic):
+        decoder = self._decoders.get(topic)
+        if decoder == None:
+            decoder = self.default
+            for pattern, candidate in self.topics:
+                if topic_matches_sub(pattern, topic):
+                    decoder = candidate
+                    break
+            if len(self._decoders) < self.max_topics:
+                self._decoders[topic] = decoder
+        return decoder
+
+    def decode(self, topic, payload):
+        return self.decoder(topic)(payload)
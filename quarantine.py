@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pymongo import DESCENDING
+from pymongo.errors import CollectionInvalid, PyMongoError
+from appconfig import AppConfig
+from metrics import CORRUPT_TELEGRAMS
+from logger import logger
+
+class Quarantine(object):
+    """
+    Telegrams that failed the CRC16 check, with per-meter corruption counters
+
+    parser.crc 'reject' only counts, 'quarantine' also keeps the telegram in a
+    capped collection and the counters in smart_meter_corruption:
+    {_id: signature, total, reasons: {reason: count}, last}
+    """
+    def __init__(self, db, config: AppConfig, name = 'smart_meter_quarantine'):
+        self.mode = config.get('parser', 'crc', 'off')
+        self.collection = None
+        self.counters = None
+        if self.mode == 'quarantine':
+            try:
+                db.create_collection(name, capped=True, size=config.get('parser', 'quarantine_mb', 16) * 1024 * 1024)
+            except CollectionInvalid:
+                pass
+            self.collection = db[name]
+            self.counters = db['smart_meter_corruption']
+            self.counters.create_index([('total', DESCENDING)])
+
+        # signature -> count, for the meters that sent corrupt telegrams most recently
+        self.max_meters = 10000
+        self._meters = OrderedDict()
+        self._lock = threading.Lock()
+        self.total = 0
+
+    def add(self, signature, p1, reason, createdAt = None):
+        createdAt = createdAt or datetime.utcnow()
+        CORRUPT_TELEGRAMS.labels(reason).inc()
+        with self._lock:
+            self.total += 1
+            self._meters[signature] = self._meters.get(signature, 0) + 1
+            self._meters.move_to_end(signature)
+            while len(self._meters) > self.max_meters:
+                self._meters.popitem(last=False)
+        if self.collection == None:
+            return
+        try:
+            self.collection.insert_one({
+                'signature': signature,
+                'reason': reason,
+                'p1': p1[:4096] if isinstance(p1, str) else repr(p1)[:4096],
+                'createdAt': createdAt
+            })
+            self.counters.update_one({'_id': signature}, {
+                '$inc': {'total': 1, 'reasons.' + reason: 1},
+                '$max': {'last': createdAt}
+            }, upsert=True)
+        except PyMongoError as e:
+            logger.error(msg="Quarantine of a telegram from {0} failed: {1}".format(signature, str(e)))
+
+    def worst(self, count = 5):
+        """
+        Meters with the most corrupt telegrams since the start, as (signature, count)
+        """
+        with self._lock:
+            return sorted(self._meters.items(), key=lambda item: -item[1])[:count]
+
+    def stats(self):
+        return {
+            'corrupt_total': self.total,
+            'corrupt_worst': self.worst()
+        }
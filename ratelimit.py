@@ -0,0 +1,101 @@
+import threading, time
+from collections import OrderedDict
+from appconfig import AppConfig
+from metrics import ADMISSION_REJECTED
+
+# Reasons a message is not admitted, also the label of the metric
+INTERVAL = 'interval'
+THROTTLED = 'throttled'
+SHED = 'shed'
+
+class RateLimiter(object):
+    """
+    Admission per meter signature, before a message is parsed or queued
+
+    - min_interval: at most one reading per meter per min_interval seconds
+    - rate and burst: token bucket per meter, rate readings per second
+      sustained with bursts of up to burst readings
+    - high_water: above this fill of the writer queue only meters that stay
+      within their rate, with at most one token short of a full bucket, are
+      admitted. Noisy meters are shed first, the rest of the fleet keeps its
+      throughput. Needs the token bucket. With the spool the fill is the
+      backlog against spool_backlog_mb, 0 for the size of the spool, and an
+      unbounded queue (queue_size 0) never sheds.
+
+    0 disables a limit. Limits are per process, the workers of the supervisor
+    each see part of the messages of a meter.
+    """
+    def __init__(self, config: AppConfig):
+        self.min_interval = config.get('ratelimit', 'min_interval', 0.0)
+        self.rate = config.get('ratelimit', 'rate', 1.0)
+        self.burst = float(config.get('ratelimit', 'burst', 10))
+        self.high_water = config.get('ratelimit', 'high_water', 0.8)
+        self.max_meters = config.get('ratelimit', 'max_meters', 100000)
+        # signature -> [tokens, time of the refill, time of the last admitted reading, throttled, shed]
+        self._meters = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.rejected = {INTERVAL: 0, THROTTLED: 0, SHED: 0}
+
+    def admit(self, signature, fill = 0.0, now = None):
+        """
+        None when the message may be stored, else the reason it is not. fill is the writer queue or spool fill, 0.0 to 1.0
+        """
+        now = time.monotonic() if now == None else now
+        with self._lock:
+            meter = self._meters.get(signature)
+            if meter == None:
+                meter = self._meters[signature] = [self.burst, now, None, 0, 0]
+                while len(self._meters) > self.max_meters:
+                    self._meters.popitem(last=False)
+            else:
+                self._meters.move_to_end(signature)
+
+            if self.rate > 0:
+                meter[0] = min(self.burst, meter[0] + (now - meter[1]) * self.rate)
+                meter[1] = now
+
+            reason = None
+            if self.min_interval > 0 and meter[2] != None and now - meter[2] < self.min_interval:
+                reason = INTERVAL
+            elif self.rate > 0 and meter[0] < 1.0:
+                reason = THROTTLED
+            elif self.high_water > 0 and fill >= self.high_water and self.rate > 0 and meter[0] < self.burst - 1.0:
+                reason = SHED
+
+            if reason != None:
+                meter[4 if reason == SHED else 3] += 1
+                self.rejected[reason] += 1
+            else:
+                meter[0] -= 1.0
+                meter[2] = now
+                self.admitted += 1
+        if reason != None:
+            ADMISSION_REJECTED.labels(reason).inc()
+        return reason
+
+    def counts(self, signature):
+        """
+        (throttled, shed) messages of a meter, interval rejections count as throttled
+        """
+        with self._lock:
+            meter = self._meters.get(signature)
+            return (meter[3], meter[4]) if meter != None else (0, 0)
+
+    def worst(self, count = 5):
+        """
+        Meters with the most rejected messages, as (signature, throttled, shed)
+        """
+        with self._lock:
+            counts = [(signature, meter[3], meter[4]) for signature, meter in self._meters.items() if meter[3] or meter[4]]
+        return sorted(counts, key=lambda item: -(item[1] + item[2]))[:count]
+
+    def stats(self):
+        return {
+            'ratelimit_admitted': self.admitted,
+            'ratelimit_interval': self.rejected[INTERVAL],
+            'ratelimit_throttled': self.rejected[THROTTLED],
+            'ratelimit_shed': self.rejected[SHED],
+            'ratelimit_worst': self.worst()
+        }
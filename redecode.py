@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+"""
+Decode the stored raw telegrams again, after a parser fix
+
+    python3 redecode.py --dry-run                  count and show what would change
+    python3 redecode.py --workers 4 --rate 2000    rewrite, at most 2000 readings/s
+    python3 redecode.py --since 2021-01-01 --job fix-l3
+
+Streams SmartMeterDataRaw in _id order and parses the telegrams in a process
+pool with the configured engine and encoding. Changed readings get their new
+p1_decoded in both the raw documents and the decoded layout. Decoded documents
+normally share the _id of their raw document. Documents stored before that
+are found by signature and a createdAt within --legacy-window-ms.
+
+With mongodb.raw 'archive' the telegrams come from RawArchive instead, in _id
+order too, and are compared with the p1_decoded in the document or bucket
+layout. Only the layout is rewritten, the archive has no p1_decoded.
+
+Progress is checkpointed per --job in smart_meter_redecodes, an interrupted
+job continues after the last rewritten _id.
+"""
+import argparse, os, time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from mongoengine import connect
+from mongoengine.connection import get_db
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from appconfig import AppConfig
+from archive import RawArchive
+from dsmr import DecodeDatagram
+from layouts import CreateLayout, DocumentLayout, HourBucketLayout
+from mongo import SmartMeterDataRaw
+from replay import ParseTime
+from logger import logger
+
+def DecodeBatch(telegrams, engine, encoding):
+    """
+    Runs in the worker processes: (p1, signature) -> p1_decoded, None for a telegram the parser rejects
+    """
+    decoded = []
+    for p1, signature in telegrams:
+        try:
+            decoded.append(DecodeDatagram(p1, engine, encoding, signature))
+        except Exception:
+            decoded.append(None)
+    return decoded
+
+def Differences(old, new, path = ''):
+    """
+    Paths of the values that differ between two p1_decoded documents
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        paths = []
+        for key in sorted(set(old) | set(new), key=str):
+            paths.extend(Differences(old.get(key), new.get(key), '{0}.{1}'.format(path, key) if path else str(key)))
+        return paths
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        paths = []
+        for index, (a, b) in enumerate(zip(old, new)):
+            paths.extend(Differences(a, b, '{0}.{1}'.format(path, index)))
+        return paths
+    return [] if old == new else [path]
+
+class Redecode(object):
+    def __init__(self, config: AppConfig, job, workers, batch_size, rate = 0, dry_run = False,
+                 legacy_window = timedelta(milliseconds=500), examples = 5):
+        db = get_db()
+        self.raw = db[SmartMeterDataRaw._get_collection_name()]
+        self.layout = CreateLayout(db, config)
+        self.archive = None
+        if config.get('mongodb', 'raw', 'document') == 'archive':
+            if not isinstance(self.layout, (DocumentLayout, HourBucketLayout)):
+                raise ValueError("redecode of archived telegrams needs the document or bucket layout, not {0}".format(type(self.layout).__name__))
+            self.archive = RawArchive(db, config)
+        self.engine = config.get('parser', 'engine', 'regex')
+        self.encoding = config.get('mongodb', 'encoding', 'nested')
+        self.checkpoints = db['smart_meter_redecodes']
+        self.executor = ProcessPoolExecutor(workers) if workers > 1 else None
+        self.workers = workers
+        self.job = job
+        self.batch_size = batch_size
+        self.rate = rate
+        self.dry_run = dry_run
+        self.legacy_window = legacy_window
+        self.examples = examples
+
+        self.scanned = 0
+        self.changed = 0
+        self.unparsed = 0
+        self.unmatched = 0
+        self.fields = {}
+
+    def batches(self, query):
+        if self.archive != None:
+            yield from self.archived(query)
+            return
+        batch = []
+        for document in self.raw.find(query, {'p1': 1, 'p1_decoded': 1, 'signature': 1, 'createdAt': 1}).sort('_id', 1).batch_size(self.batch_size):
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def archived(self, query):
+        # Archive documents in the shape of raw documents, p1_decoded from the layout
+        batch = []
+        for document in self.archive.collection.find(query).sort('_id', 1).batch_size(self.batch_size):
+            batch.append({
+                '_id': document['_id'],
+                'signature': document['signature'],
+                'createdAt': document['createdAt'],
+                'p1': self.archive.p1(document)
+            })
+            if len(batch) >= self.batch_size:
+                yield self._stored(batch)
+                batch = []
+        if batch:
+            yield self._stored(batch)
+
+    def _stored(self, batch):
+        ids = [document['_id'] for document in batch]
+        if isinstance(self.layout, HourBucketLayout):
+            stored = {}
+            for bucket in self.layout.collection.find({'readings._id': {'$in': ids}}, {'readings._id': 1, 'readings.p1_decoded': 1}):
+                stored.update((reading['_id'], reading.get('p1_decoded')) for reading in bucket['readings'])
+        else:
+            stored = dict((document['_id'], document.get('p1_decoded')) for document in self.layout.collection.find({'_id': {'$in': ids}}, {'p1_decoded': 1}))
+        for document in batch:
+            document['p1_decoded'] = stored.get(document['_id'])
+        return batch
+
+    def _decoded(self, batches):
+        # In _id order, with up to workers batches parsing ahead
+        if self.executor == None:
+            for batch in batches:
+                yield batch, DecodeBatch([(document['p1'], document.get('signature')) for document in batch], self.engine, self.encoding)
+            return
+        pending = []
+        for batch in batches:
+            pending.append((batch, self.executor.submit(DecodeBatch, [(document['p1'], document.get('signature')) for document in batch], self.engine, self.encoding)))
+            if len(pending) > self.workers:
+                batch, future = pending.pop(0)
+                yield batch, future.result()
+        for batch, future in pending:
+            yield batch, future.result()
+
+    def run(self, since = None, until = None):
+        checkpoint = {} if self.dry_run else (self.checkpoints.find_one({'_id': self.job}) or {})
+        query = {}
+        if 'last_id' in checkpoint:
+            query['_id'] = {'$gt': checkpoint['last_id']}
+        if since != None or until != None:
+            query['createdAt'] = {}
+            if since != None:
+                query['createdAt']['$gte'] = since
+            if until != None:
+                query['createdAt']['$lt'] = until
+        self.scanned = checkpoint.get('scanned', 0)
+        self.changed = checkpoint.get('changed', 0)
+
+        started = time.monotonic()
+        window_start = started
+        window_count = 0
+        for batch, decoded in self._decoded(self.batches(query)):
+            changes = []
+            for document, p1_decoded in zip(batch, decoded):
+                if p1_decoded == None:
+                    self.unparsed += 1
+                    continue
+                if p1_decoded == document.get('p1_decoded'):
+                    continue
+                changes.append((document, p1_decoded))
+                for path in Differences(document.get('p1_decoded'), p1_decoded):
+                    self.fields[path] = self.fields.get(path, 0) + 1
+                if self.dry_run and self.examples > 0:
+                    self.examples -= 1
+                    print('{0} {1} {2}'.format(document['_id'], document['signature'], ', '.join(Differences(document.get('p1_decoded'), p1_decoded))))
+
+            if changes and not self.dry_run:
+                self.write(changes)
+            self.scanned += len(batch)
+            self.changed += len(changes)
+            if not self.dry_run:
+                self.checkpoints.replace_one({'_id': self.job}, {
+                    '_id': self.job, 'last_id': batch[-1]['_id'], 'scanned': self.scanned, 'changed': self.changed
+                }, upsert=True)
+
+            # Rate limit, next to live ingest the database is shared
+            window_count += len(batch)
+            if self.rate > 0:
+                ahead = window_count / self.rate - (time.monotonic() - window_start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            elapsed = time.monotonic() - started
+            logger.info(msg="Redecode: scanned {0}, changed {1}, {2:.0f} readings/s".format(self.scanned, self.changed, (self.scanned - checkpoint.get('scanned', 0)) / elapsed if elapsed else 0.0))
+
+    def write(self, changes):
+        if self.archive == None:
+            self._bulk(self.raw, [UpdateOne({'_id': document['_id']}, {'$set': {'p1_decoded': p1_decoded}}) for document, p1_decoded in changes])
+
+        if isinstance(self.layout, HourBucketLayout):
+            self._bulk(self.layout.collection, [UpdateOne(
+                {'signature': document['signature'], 'start': self.layout.bucket(document['createdAt'])},
+                {'$set': {'readings.$[reading].p1_decoded': p1_decoded}, '$unset': {'readings.$[reading].base': ''}},
+                array_filters=[{'reading._id': document['_id']}]
+            ) for document, p1_decoded in changes])
+            return
+        if not isinstance(self.layout, DocumentLayout):
+            # Time-series measurements can not be updated in place
+            logger.warning(msg="Redecode: layout {0} is not updated, only the raw collection".format(type(self.layout).__name__))
+            return
+
+        decoded = self.layout.collection
+        ids = [document['_id'] for document, p1_decoded in changes]
+        shared = set(document['_id'] for document in decoded.find({'_id': {'$in': ids}}, {'_id': 1}))
+        updates = []
+        for document, p1_decoded in changes:
+            if document['_id'] in shared:
+                updates.append(UpdateOne({'_id': document['_id']}, {'$set': {'p1_decoded': p1_decoded}, '$unset': {'base': ''}}))
+            else:
+                # Stored before raw and decoded shared their _id, both got their own utcnow()
+                updates.append(UpdateOne({
+                    'signature': document['signature'],
+                    'createdAt': {'$gte': document['createdAt'] - self.legacy_window, '$lte': document['createdAt'] + self.legacy_window}
+                }, {'$set': {'p1_decoded': p1_decoded}, '$unset': {'base': ''}}))
+        result = self._bulk(decoded, updates)
+        if result != None:
+            self.unmatched += len(updates) - result.matched_count
+
+    def _bulk(self, collection, updates):
+        try:
+            return collection.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            logger.error(msg="Update of {0}: {1} documents rejected, first: {2}".format(collection.name, len(errors), errors[0]['errmsg']))
+            return None
+
+    def close(self):
+        if self.executor != None:
+            self.executor.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode the raw telegrams again with the current parser")
+    parser.add_argument('--job', default='redecode', help="checkpoint name, a new name starts from the beginning")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="parser processes")
+    parser.add_argument('--batch', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=0, help="maximum readings per second, 0 is unlimited")
+    parser.add_argument('--since', help="createdAt from, ISO 8601")
+    parser.add_argument('--until', help="createdAt before, ISO 8601")
+    parser.add_argument('--dry-run', action='store_true', help="report the differences, write nothing")
+    parser.add_argument('--legacy-window-ms', type=float, default=500.0)
+    args = parser.parse_args()
+
+    appconfig = AppConfig()
+    connect(db = appconfig['mongodb']['database'], host = appconfig['mongodb']['host'], port = appconfig['mongodb']['port'])
+    redecode = Redecode(appconfig, args.job, args.workers, args.batch, args.rate, args.dry_run,
+                        timedelta(milliseconds=args.legacy_window_ms))
+    try:
+        redecode.run(ParseTime(args.since) if args.since else None, ParseTime(args.until) if args.until else None)
+    finally:
+        redecode.close()
+
+    logger.info(msg="Redecode {0}: scanned {1}, {2} {3}, not parsed {4}, legacy documents not found {5}".format(
+        args.job, redecode.scanned, 'would change' if args.dry_run else 'changed', redecode.changed, redecode.unparsed, redecode.unmatched))
+    for path, count in sorted(redecode.fields.items(), key=lambda item: -item[1]):
+        print('{0:>10}  {1}'.format(count, path))
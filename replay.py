@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+"""
+Backfill readings from files, without MQTT
+
+    python3 replay.py gateway-2020-02.jsonl.gz
+    python3 replay.py capture.p1 --signature gw-0042 --workers 4
+    python3 replay.py mqtt-dump-*.jsonl --chunk 20000 --restart
+
+jsonl: one MQTT payload per line, {"datagram": {"p1", "signature", "s0", "s1"}},
+optionally with createdAt (epoch seconds or ISO 8601) and _id:
+
+    {"datagram": {"p1": "/ISK5...!1A2B", "signature": "gw-0042", "s0": {}, "s1": {}}, "createdAt": 1612345678}
+
+p1: raw telegrams as read from the P1 port, one meter per file. Both may be
+gzip compressed (.gz). The write-ahead spool is not read by this tool, its
+binary segments are replayed by SpoolReplayer when the ingest starts.
+
+Readings keep their original time: createdAt from the record, else 0-0:1.0.0
+of the telegram, else (DSMR 2.2/3.0) the time of the replay. The _id is derived
+from time, signature and telegram, for undated readings from file name, record
+number, signature and telegram, so a file that is replayed twice does not store
+anything twice. Progress is checkpointed per file in smart_meter_replays.
+"""
+import argparse, gzip, hashlib, json, os, struct, time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from bson import ObjectId
+from mongoengine import connect
+from mongoengine.connection import get_db
+
+from appconfig import AppConfig
+from dsmr import DecodeDatagram, TelegramTimestamp
+from crc16 import CheckBatch
+from mongo import BACKENDS, Envelope
+from p1stream import P1Framer
+from quarantine import Quarantine
+from logger import logger
+
+def OpenFile(path, binary = False):
+    if binary:
+        return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='ascii', errors='replace', newline='')
+    return open(path, 'r', encoding='ascii', errors='replace', newline='')
+
+def FileFormat(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'jsonl' if name.endswith('.jsonl') or name.endswith('.json') else 'p1'
+
+def ParseTime(value):
+    """
+    Epoch seconds or milliseconds, ISO 8601 or {'$date': ...} -> naive UTC datetime
+    """
+    if isinstance(value, dict):
+        value = value.get('$date')
+    if isinstance(value, (int, float)):
+        if value > 1e11:
+            value = value / 1000.0
+        return datetime.utcfromtimestamp(value)
+    if isinstance(value, str):
+        at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if at.tzinfo != None:
+            at = at.astimezone(timezone.utc).replace(tzinfo=None)
+        return at
+    return None
+
+def ReadJsonl(stream):
+    # Yields (p1, signature, s0, s1, createdAt or None, _id or None)
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            datagram = record.get('datagram', record)
+            createdAt = None
+            for key in ('createdAt', 'timestamp', 'received'):
+                if key in record:
+                    createdAt = ParseTime(record[key])
+                    break
+            _id = record.get('_id')
+            if isinstance(_id, dict):
+                _id = _id.get('$oid')
+            yield (datagram['p1'], datagram['signature'], datagram.get('s0', {}), datagram.get('s1', {}), createdAt, _id)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(msg="Replay: skipping bad line: {0}".format(str(e)))
+            yield None
+
+def ReadCapture(stream, signature, block = 1024 * 1024):
+    # Telegrams from a raw P1 capture opened as binary, read in blocks
+    framer = P1Framer()
+    while True:
+        data = stream.read(block)
+        for telegram in framer.feed(data) if data else framer.close():
+            yield (telegram, signature, {}, {}, None, None)
+        if not data:
+            return
+
+def DecodeRecords(records, engine, encoding, check = False):
+    """
+    Runs in the worker processes: (p1_decoded, telegram time, CRC reason) for
+    each record, None when the parser fails
+    """
+    reasons = CheckBatch([record[0] for record in records]) if check else [None] * len(records)
+    decoded = []
+    for record, reason in zip(records, reasons):
+        try:
+            if reason != None:
+                decoded.append((None, TelegramTimestamp(record[0]), reason))
+                continue
+            decoded.append((DecodeDatagram(record[0], engine, encoding, record[1]), TelegramTimestamp(record[0]), None))
+        except Exception:
+            decoded.append(None)
+    return decoded
+
+def ReplayId(createdAt, signature, p1, source = None):
+    """
+    ObjectId with the reading time and a hash of meter and telegram, the same for
+    every replay. Undated readings have no time, createdAt None, and hash where
+    they are in the files instead: source, as 'file name:record number'
+    """
+    seconds = int((createdAt - datetime(1970, 1, 1)).total_seconds()) if createdAt != None else 0
+    text = signature + '\n' + p1 if source == None else source + '\n' + signature + '\n' + p1
+    digest = hashlib.blake2b(text.encode(), digest_size=8).digest()
+    return ObjectId(struct.pack('>I', seconds & 0xFFFFFFFF) + digest)
+
+class Replay(object):
+    def __init__(self, config: AppConfig, workers, chunk_size, signature = None, restart = False):
+        self.backend = BACKENDS[config.get('mongodb', 'backend', 'mongoengine')](config)
+        self.engine = config.get('parser', 'engine', 'regex')
+        self.encoding = config.get('mongodb', 'encoding', 'nested')
+        self.executor = ProcessPoolExecutor(workers) if workers > 1 else None
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.signature = signature
+        self.restart = restart
+        self.checkpoints = get_db()['smart_meter_replays']
+        self.quarantine = Quarantine(get_db(), config) if config.get('parser', 'crc', 'off') != 'off' else None
+
+        self.records = 0
+        self.stored = 0
+        self.failed = 0
+        self.undated = 0
+        self.corrupt = 0
+
+    def chunks(self, path):
+        chunk = []
+        with OpenFile(path, FileFormat(path) == 'p1') as stream:
+            if FileFormat(path) == 'jsonl':
+                records = ReadJsonl(stream)
+            else:
+                signature = self.signature or os.path.basename(path).split('.')[0]
+                records = ReadCapture(stream, signature)
+            for record in records:
+                chunk.append(record)
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def _decoded(self, chunks):
+        # In order, with up to workers chunks parsing ahead of the writer
+        if self.executor == None:
+            for chunk in chunks:
+                yield chunk, DecodeRecords([record for record in chunk if record != None], self.engine, self.encoding, self.quarantine != None)
+            return
+        pending = []
+        for chunk in chunks:
+            pending.append((chunk, self.executor.submit(DecodeRecords, [record for record in chunk if record != None], self.engine, self.encoding, self.quarantine != None)))
+            if len(pending) > self.workers:
+                chunk, future = pending.pop(0)
+                yield chunk, future.result()
+        for chunk, future in pending:
+            yield chunk, future.result()
+
+    def replay(self, path):
+        key = os.path.abspath(path)
+        checkpoint = {} if self.restart else (self.checkpoints.find_one({'_id': key}) or {})
+        done = checkpoint.get('records', 0)
+        if checkpoint.get('complete'):
+            logger.info(msg="Replay: {0} done before, --restart to replay it again".format(path))
+            return
+
+        started = time.monotonic()
+        position = 0
+        skipped = 0
+        for chunk, decoded in self._decoded(self._skip(self.chunks(path), done)):
+            batch = []
+            # Record numbers in the file, of the records that are not None
+            numbers = [done + position + index for index, record in enumerate(chunk) if record != None]
+            for number, record, result in zip(numbers, [record for record in chunk if record != None], decoded):
+                if result == None:
+                    self.failed += 1
+                    continue
+                p1, signature, s0, s1, createdAt, _id = record
+                p1_decoded, telegram_time, reason = result
+                if createdAt == None:
+                    createdAt = telegram_time
+                if reason != None:
+                    self.corrupt += 1
+                    self.quarantine.add(signature, p1, reason, createdAt)
+                    continue
+                if _id == None:
+                    _id = ReplayId(createdAt, signature, p1, None if createdAt != None else '{0}:{1}'.format(os.path.basename(path), number))
+                if createdAt == None:
+                    # DSMR 2.2/3.0 telegrams have no clock, nothing better than now
+                    self.undated += 1
+                    createdAt = datetime.utcnow()
+                envelope = Envelope(p1 = p1, p1_decoded = p1_decoded, signature = signature, s0 = s0, s1 = s1, createdAt = createdAt)
+                envelope._id = ObjectId(_id)
+                batch.append(envelope)
+
+            skipped += len(chunk) - len(batch)
+            failed = self.backend.insert(batch) if batch else 0
+            self.stored += len(batch) - failed
+            self.failed += failed
+            self.records += len(chunk)
+            position += len(chunk)
+            self.checkpoints.replace_one({'_id': key}, {'_id': key, 'records': done + position, 'complete': False}, upsert=True)
+            elapsed = time.monotonic() - started
+            logger.info(msg="Replay {0}: {1} records, {2:.0f} records/s".format(path, done + position, position / elapsed if elapsed else 0.0))
+
+        self.checkpoints.replace_one({'_id': key}, {'_id': key, 'records': done + position, 'complete': True}, upsert=True)
+        logger.info(msg="Replay {0} done: {1} records, {2} not stored".format(path, done + position, skipped))
+
+    def _skip(self, chunks, count):
+        # Resume: drop the records a previous run checkpointed
+        for chunk in chunks:
+            if count >= len(chunk):
+                count -= len(chunk)
+                continue
+            yield chunk[count:]
+            count = 0
+
+    def close(self):
+        if self.executor != None:
+            self.executor.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Store readings from JSONL or raw P1 capture files")
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--signature', help="meter signature of raw P1 captures, default the file name")
+    parser.add_argument('--chunk', type=int, default=5000, help="records parsed and written per batch")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="parser processes")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoints")
+    args = parser.parse_args()
+
+    appconfig = AppConfig()
+    connect(db = appconfig['mongodb']['database'], host = appconfig['mongodb']['host'], port = appconfig['mongodb']['port'],
+            maxPoolSize = appconfig.get('mongodb', 'pool_size', 10))
+    replay = Replay(appconfig, args.workers, args.chunk, args.signature, args.restart)
+    started = time.monotonic()
+    try:
+        for path in args.files:
+            replay.replay(path)
+    finally:
+        replay.close()
+    elapsed = time.monotonic() - started
+    logger.info(msg="Replayed {0} records in {1:.1f} s, {2:.0f} records/s: stored {3}, failed {4}, corrupt {5}, undated {6}".format(
+        replay.records, elapsed, replay.records / elapsed if elapsed else 0.0, replay.stored, replay.failed, replay.corrupt, replay.undated))
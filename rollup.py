@@ -0,0 +1,273 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from appconfig import AppConfig
+from dsmr import Reading
+from metrics import ROLLUP_WINDOWS, ROLLUP_LATE
+from logger import logger
+
+# Reading attributes with min, max and average per window
+ROLLUP_STATS = (
+    'power_delivered', 'power_received',
+    'instantaneous_voltage_L1', 'instantaneous_voltage_L2', 'instantaneous_voltage_L3',
+    'instantaneous_current_L1', 'instantaneous_current_L2', 'instantaneous_current_L3'
+)
+
+# Energy registers per tariff, they only go up so first and last are min and max
+ROLLUP_REGISTERS = ('energy_by_t1', 'energy_by_t2', 'energy_to_t1', 'energy_to_t2')
+
+def ReadingOf(envelope):
+    # Envelopes from the parser carry the Reading, replayed ones only p1_decoded
+    if envelope.reading != None:
+        return envelope.reading
+    if not envelope.p1_decoded:
+        return None
+    if 'power' in envelope.p1_decoded:
+        return Reading.FromJSON(envelope.p1_decoded)
+    return Reading.FromCompact(envelope.p1_decoded)
+
+class Window(object):
+    """
+    Aggregates of one meter over one window, merged into the stored document
+    with $inc, $min and $max so a window can be written more than once
+    """
+    __slots__ = ('count', 'first', 'last', 'stats', 'registers', 'tariffs')
+
+    def __init__(self):
+        self.count = 0
+        self.first = None
+        self.last = None
+        # attribute -> [min, max, sum, n]
+        self.stats = {}
+        # attribute -> [first, last]
+        self.registers = {}
+        # tariff -> readings
+        self.tariffs = {}
+
+    def add(self, reading, createdAt):
+        self.count += 1
+        self.first = createdAt if self.first == None else min(self.first, createdAt)
+        self.last = createdAt if self.last == None else max(self.last, createdAt)
+        for attribute in ROLLUP_STATS:
+            value = getattr(reading, attribute)
+            if value == None:
+                continue
+            stat = self.stats.get(attribute)
+            if stat == None:
+                self.stats[attribute] = [value, value, value, 1]
+            else:
+                stat[0] = min(stat[0], value)
+                stat[1] = max(stat[1], value)
+                stat[2] += value
+                stat[3] += 1
+        for attribute in ROLLUP_REGISTERS:
+            value = getattr(reading, attribute)
+            if value == None:
+                continue
+            register = self.registers.get(attribute)
+            if register == None:
+                self.registers[attribute] = [value, value]
+            else:
+                register[0] = min(register[0], value)
+                register[1] = max(register[1], value)
+        if reading.tariff != None:
+            self.tariffs[reading.tariff] = self.tariffs.get(reading.tariff, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.first = min(self.first, other.first)
+        self.last = max(self.last, other.last)
+        for attribute, (low, high, total, n) in other.stats.items():
+            stat = self.stats.get(attribute)
+            if stat == None:
+                self.stats[attribute] = [low, high, total, n]
+            else:
+                self.stats[attribute] = [min(stat[0], low), max(stat[1], high), stat[2] + total, stat[3] + n]
+        for attribute, (first, last) in other.registers.items():
+            register = self.registers.get(attribute)
+            self.registers[attribute] = [first, last] if register == None else [min(register[0], first), max(register[1], last)]
+        for tariff, count in other.tariffs.items():
+            self.tariffs[tariff] = self.tariffs.get(tariff, 0) + count
+
+    def update(self, end):
+        increments = {'count': self.count}
+        minimums = {'first': self.first}
+        maximums = {'last': self.last}
+        for attribute, (low, high, total, n) in self.stats.items():
+            minimums['stats.{0}.min'.format(attribute)] = low
+            maximums['stats.{0}.max'.format(attribute)] = high
+            increments['stats.{0}.sum'.format(attribute)] = total
+            increments['stats.{0}.n'.format(attribute)] = n
+        for attribute, (first, last) in self.registers.items():
+            minimums['energy.{0}.first'.format(attribute)] = first
+            maximums['energy.{0}.last'.format(attribute)] = last
+        for tariff, count in self.tariffs.items():
+            increments['tariffs.{0}'.format(tariff)] = count
+        return {'$inc': increments, '$min': minimums, '$max': maximums, '$setOnInsert': {'end': end}}
+
+class Rollup(object):
+    """
+    Per meter aggregates over rollup.windows (minutes), kept in memory while a
+    window is open and flushed grace_seconds after it closed, one collection
+    smart_meter_rollup_<minutes>m per window:
+
+    {signature, start, end, count, first, last,
+     stats: {attribute: {min, max, sum, n}}, energy: {register: {first, last}}, tariffs: {tariff: count}}
+
+    Windows close by the clock. A late reading for a window that was already
+    flushed opens it again, the next flush merges it into the stored document.
+    Readings replayed from the spool after a crash that were flushed before it
+    are counted again: count, sum, n and tariffs are approximate after replay,
+    min, max, first and last stay exact.
+
+    rollup.decoded 'full' stores every decoded reading, 'downsample' the first
+    reading per meter every downsample_seconds and 'none' only the rollups.
+    """
+    def __init__(self, db, config: AppConfig):
+        self.spans = OrderedDict()
+        for minutes in config.get('rollup', 'windows', [1, 15, 60]):
+            collection = db['smart_meter_rollup_{0}m'.format(minutes)]
+            collection.create_index([('signature', ASCENDING), ('start', ASCENDING)], unique=True)
+            self.spans[minutes] = (timedelta(minutes=minutes), collection)
+        self.grace = timedelta(seconds=config.get('rollup', 'grace_seconds', 120))
+        self.flush_interval = config.get('rollup', 'flush_interval', 10)
+        self.mode = config.get('rollup', 'decoded', 'full')
+        self.downsample = timedelta(seconds=config.get('rollup', 'downsample_seconds', 60))
+
+        # (minutes, signature, start) -> Window
+        self._windows = {}
+        self._lock = threading.Lock()
+        # signature -> (slot, _id) of the last decoded reading kept by downsample
+        self.max_meters = config.get('rollup', 'max_meters', 100000)
+        self._kept = OrderedDict()
+
+        self.flushed = 0
+        self.late = 0
+
+        self._stopping = threading.Event()
+        self._flusher = threading.Thread(target=self._flusher_thread, name="rollup-flush")
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    @staticmethod
+    def bucket(createdAt, span):
+        epoch = datetime(1970, 1, 1)
+        return epoch + ((createdAt - epoch) // span) * span
+
+    def add(self, batch):
+        horizon = datetime.utcnow() - self.grace
+        with self._lock:
+            for envelope in batch:
+                reading = ReadingOf(envelope)
+                if reading == None:
+                    continue
+                for minutes, (span, collection) in self.spans.items():
+                    start = self.bucket(envelope.createdAt, span)
+                    key = (minutes, envelope.signature, start)
+                    window = self._windows.get(key)
+                    if window == None:
+                        if start + span <= horizon:
+                            self.late += 1
+                            ROLLUP_LATE.inc()
+                        window = self._windows[key] = Window()
+                    window.add(reading, envelope.createdAt)
+
+    def decoded(self, batch):
+        """
+        The envelopes of a batch whose decoded reading is stored
+        """
+        if self.mode == 'full':
+            return batch
+        if self.mode == 'none':
+            return []
+        kept = []
+        with self._lock:
+            for envelope in batch:
+                slot = self.bucket(envelope.createdAt, self.downsample)
+                last = self._kept.get(envelope.signature)
+                # Late readings for an earlier slot are left to the rollups, the
+                # same _id again is a retried batch and was kept the first time
+                if last == None or last[0] < slot or last[1] == envelope._id:
+                    kept.append(envelope)
+                    self._kept[envelope.signature] = (slot, envelope._id)
+                    self._kept.move_to_end(envelope.signature)
+            while len(self._kept) > self.max_meters:
+                self._kept.popitem(last=False)
+        return kept
+
+    def flush(self, everything = False):
+        """
+        Writes the windows closed for more than the grace period, or all of them
+        """
+        horizon = datetime.utcnow() - self.grace
+        with self._lock:
+            closed = dict((key, window) for key, window in self._windows.items()
+                          if everything or key[2] + self.spans[key[0]][0] <= horizon)
+            for key in closed:
+                del self._windows[key]
+
+        for minutes, (span, collection) in self.spans.items():
+            windows = [(key, window) for key, window in closed.items() if key[0] == minutes]
+            if not windows:
+                continue
+            updates = [UpdateOne({'signature': signature, 'start': start}, window.update(start + span), upsert=True)
+                       for (minutes, signature, start), window in windows]
+            try:
+                collection.bulk_write(updates, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details['writeErrors']
+                logger.error(msg="Update of {0}: {1} windows rejected, first: {2}".format(collection.name, len(errors), errors[0]['errmsg']))
+            except PyMongoError as e:
+                # Nothing was applied, keep the windows for the next flush
+                logger.error(msg="Rollup flush to {0} failed, retried later: {1}".format(collection.name, str(e)))
+                self._restore(windows)
+                continue
+            self.flushed += len(windows)
+            ROLLUP_WINDOWS.labels('{0}m'.format(minutes)).inc(len(windows))
+
+    def _restore(self, windows):
+        with self._lock:
+            for key, window in windows:
+                current = self._windows.get(key)
+                if current != None:
+                    window.merge(current)
+                self._windows[key] = window
+
+    def _flusher_thread(self):
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(msg="Rollup flush exception: {0}".format(str(e)))
+
+    def read(self, minutes, signature, start, end):
+        """
+        Windows of one meter with start <= window start < end, with avg per stat
+        and delta per register, against the last value of the window before
+        """
+        span, collection = self.spans[minutes]
+        before = collection.find_one({'signature': signature, 'start': {'$lt': start}}, {'energy': 1}, sort=[('start', DESCENDING)])
+        last = dict((attribute, register['last']) for attribute, register in (before or {}).get('energy', {}).items())
+        for document in collection.find({'signature': signature, 'start': {'$gte': start, '$lt': end}}).sort('start', ASCENDING):
+            for stat in document.get('stats', {}).values():
+                stat['avg'] = stat['sum'] / stat['n'] if stat['n'] else None
+            for attribute, register in document.get('energy', {}).items():
+                register['delta'] = register['last'] - last.get(attribute, register['first'])
+                last[attribute] = register['last']
+            yield document
+
+    def stats(self):
+        with self._lock:
+            open_windows = len(self._windows)
+        return {
+            'rollup_open': open_windows,
+            'rollup_flushed': self.flushed,
+            'rollup_late': self.late
+        }
+
+    def stop(self):
+        self._stopping.set()
+        self._flusher.join()
+        self.flush(everything = True)
@@ -0,0 +1,268 @@
+import os, json, mmap, struct, threading, time, zlib
+from logger import logger
+
+# Record: length and crc32 of the payload, followed by the payload
+RECORD_HEADER = struct.Struct('<II')
+
+class SpoolPosition(object):
+    __slots__ = ('segment', 'offset')
+
+    def __init__(self, segment, offset):
+        self.segment = segment
+        self.offset = offset
+
+class Spool(object):
+    """
+    Append-only write-ahead log of received readings, split in numbered segment files
+
+    fsync 'always' syncs every append before it returns, 'interval' at most once per
+    fsync_interval and 'never' leaves it to the OS. Segments that are replayed are
+    deleted, apart from the last retain_segments. When more than max_segments are on
+    disk the oldest are dropped, even when they are not replayed yet.
+    """
+    def __init__(self, directory, segment_size = 64 * 1024 * 1024, fsync = 'interval', fsync_interval = 1.0,
+                 use_mmap = True, retain_segments = 0, max_segments = 256):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.use_mmap = use_mmap
+        self.retain_segments = retain_segments
+        self.max_segments = max_segments
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._checkpoint_file = os.path.join(self.directory, 'checkpoint')
+        self.position = self._load_checkpoint()
+
+        # Never append to a segment of a previous run, its tail may be torn
+        segments = self.segments()
+        self._segment = (segments[-1] + 1) if segments else max(self.position.segment, 1)
+        self._fd = None
+        self._size = 0
+        self._last_sync = time.monotonic()
+        self.appended = 0
+        self.dropped_segments = 0
+        self._open_segment()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '{0:012d}.seg'.format(segment))
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def _open_segment(self):
+        self._fd = os.open(self._path(self._segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._size = 0
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint_file) as checkpoint:
+                position = json.load(checkpoint)
+            return SpoolPosition(position['segment'], position['offset'])
+        except FileNotFoundError:
+            return SpoolPosition(0, 0)
+
+    def append(self, payload: bytes):
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._size > 0 and self._size + len(record) > self.segment_size:
+                self._roll()
+            # One write per record, a reader never sees half a header from a complete record
+            os.write(self._fd, record)
+            self._size += len(record)
+            self.appended += 1
+            if self.fsync == 'always':
+                os.fsync(self._fd)
+            elif self.fsync == 'interval' and time.monotonic() - self._last_sync >= self.fsync_interval:
+                os.fsync(self._fd)
+                self._last_sync = time.monotonic()
+
+    def _roll(self):
+        if self.fsync != 'never':
+            os.fsync(self._fd)
+        os.close(self._fd)
+        self._segment += 1
+        self._open_segment()
+        self._enforce_max_segments()
+
+    def _enforce_max_segments(self):
+        segments = self.segments()
+        for segment in segments[:max(0, len(segments) - self.max_segments)]:
+            if segment >= self.position.segment:
+                logger.error(msg="Spool full, dropping segment {0} before it was replayed".format(segment))
+                self.dropped_segments += 1
+            os.remove(self._path(segment))
+
+    def sync(self):
+        with self._lock:
+            if self.fsync != 'never':
+                os.fsync(self._fd)
+                self._last_sync = time.monotonic()
+
+    def read(self, position: SpoolPosition, max_records, max_bytes = 16 * 1024 * 1024):
+        """
+        Read up to max_records payloads from position, returns (payloads, next position)
+        """
+        with self._lock:
+            active = self._segment
+        segments = [segment for segment in self.segments() if segment >= position.segment]
+        if not segments:
+            return [], position
+        if segments[0] != position.segment:
+            # Segment replayed or dropped already, continue with the next one
+            position = SpoolPosition(segments[0], 0)
+
+        sealed = position.segment < active
+        path = self._path(position.segment)
+        payloads = []
+        with open(path, 'rb') as segment:
+            size = os.fstat(segment.fileno()).st_size
+            if size <= position.offset:
+                if sealed:
+                    return self.read(SpoolPosition(position.segment + 1, 0), max_records, max_bytes)
+                return [], position
+            if self.use_mmap and sealed:
+                mapped = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+                buffer = memoryview(mapped)[position.offset:min(size, position.offset + max_bytes)]
+            else:
+                mapped = None
+                segment.seek(position.offset)
+                buffer = memoryview(segment.read(max_bytes))
+
+            offset = 0
+            corrupt = False
+            while len(payloads) < max_records and offset + RECORD_HEADER.size <= len(buffer):
+                length, crc = RECORD_HEADER.unpack_from(buffer, offset)
+                end = offset + RECORD_HEADER.size + length
+                if end > len(buffer):
+                    break
+                payload = bytes(buffer[offset + RECORD_HEADER.size:end])
+                if zlib.crc32(payload) != crc:
+                    corrupt = True
+                    break
+                payloads.append(payload)
+                offset = end
+
+            end_of_file = position.offset + len(buffer) >= size
+            del buffer
+            if mapped != None:
+                mapped.close()
+
+        next_position = SpoolPosition(position.segment, position.offset + offset)
+        if sealed and next_position.offset >= size:
+            next_position = SpoolPosition(position.segment + 1, 0)
+        elif sealed and len(payloads) < max_records and (corrupt or end_of_file):
+            # Torn or corrupt tail of a segment from a crash, nothing more can be read from it
+            logger.error(msg="Spool segment {0} is corrupt at offset {1}, skipping {2} bytes".format(
+                position.segment, next_position.offset, size - next_position.offset))
+            next_position = SpoolPosition(position.segment + 1, 0)
+        return payloads, next_position
+
+    def commit(self, position: SpoolPosition):
+        """
+        Persist the replay position and remove the segments before it
+        """
+        temp = self._checkpoint_file + '.tmp'
+        with open(temp, 'w') as checkpoint:
+            json.dump({'segment': position.segment, 'offset': position.offset}, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temp, self._checkpoint_file)
+        self.position = position
+
+        replayed = [segment for segment in self.segments() if segment < position.segment]
+        for segment in replayed[:max(0, len(replayed) - self.retain_segments)]:
+            os.remove(self._path(segment))
+
+    def backlog(self):
+        """
+        Bytes on disk that are not replayed yet
+        """
+        total = 0
+        for segment in self.segments():
+            if segment >= self.position.segment:
+                size = os.path.getsize(self._path(segment))
+                total += size - (self.position.offset if segment == self.position.segment else 0)
+        return total
+
+    def close(self):
+        with self._lock:
+            if self.fsync != 'never':
+                os.fsync(self._fd)
+            os.close(self._fd)
+
+class SpoolReplayer(object):
+    """
+    Drains the spool into MongoDB in large batches
+
+    store(payloads) writes a batch and raises when the database is not reachable,
+    the batch is then retried with exponential backoff from the same position.
+    """
+    def __init__(self, spool: Spool, store, batch_size = 5000, idle = 0.25, max_backoff = 30.0):
+        self.spool = spool
+        self.store = store
+        self.batch_size = batch_size
+        self.idle = idle
+        self.max_backoff = max_backoff
+        self.replayed = 0
+        self.rate = 0.0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._replay_thread, name="spool-replayer")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _replay_thread(self):
+        position = self.spool.position
+        backoff = self.idle
+        window_start = time.monotonic()
+        window_count = 0
+        while not self._stopping.is_set():
+            payloads, next_position = self.spool.read(position, self.batch_size)
+            if not payloads:
+                if next_position.segment != position.segment or next_position.offset != position.offset:
+                    self.spool.commit(next_position)
+                    position = next_position
+                    continue
+                self.spool.sync()
+                self._stopping.wait(self.idle)
+                continue
+
+            try:
+                self.store(payloads)
+            except Exception as e:
+                logger.error(msg="Spool replay failed, retry in {0:.1f} s: {1}".format(backoff, str(e)))
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            backoff = self.idle
+            self.spool.commit(next_position)
+            position = next_position
+            self.replayed += len(payloads)
+
+            # Replay throughput, reported while catching up on a backlog
+            window_count += len(payloads)
+            elapsed = time.monotonic() - window_start
+            if elapsed >= 5.0:
+                self.rate = window_count / elapsed
+                if len(payloads) == self.batch_size:
+                    logger.info(msg="Spool replay: {0:.0f} readings/s, backlog {1} bytes".format(self.rate, self.spool.backlog()))
+                window_start = time.monotonic()
+                window_count = 0
+
+    def stats(self):
+        return {
+            'spool_appended': self.spool.appended,
+            'spool_replayed': self.replayed,
+            'spool_replay_rate': self.rate,
+            'spool_backlog_bytes': self.spool.backlog(),
+            'spool_dropped_segments': self.spool.dropped_segments
+        }
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self.spool.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+"""
+Run the MQTT to MongoDB pipeline in several worker processes
+
+    python3 supervisor.py
+
+mode 'shared': every worker subscribes to $share/<group>/<topic>, the broker
+spreads the messages over the workers.
+mode 'partition': the supervisor subscribes and hands every message to worker
+crc32(signature) % workers, the readings of a meter stay ordered in one worker.
+
+Every worker has its own MongoEngine writer. A worker that dies is restarted,
+SIGINT or SIGTERM drains all workers before exiting.
+"""
+import multiprocessing, os, queue, signal, time, zlib
+
+from appconfig import AppConfig
+from logger import logger
+
+# Counters that are summed over the workers in the combined stats
+COMBINED_STATS = ('queued', 'written', 'failed', 'blocked', 'queue_depth')
+
+class Partitioner(object):
+    """
+    Takes the place of MongoEngine in the supervisor's MQTT client for mode 'partition'
+    """
+    def __init__(self, queues):
+        self.queues = queues
+        self.dispatched = [0] * len(queues)
+        # The workers keep the latest readings
+        self.latest = None
+
+    def save(self, json_payload, received = None):
+        try:
+            # crc32 and not hash(), str hashes differ between processes
+            worker = zlib.crc32(json_payload['datagram']['signature'].encode()) % len(self.queues)
+            self.queues[worker].put(json_payload)
+            self.dispatched[worker] += 1
+        except Exception as e:
+            logger.error(msg="Partitioner.save() exception: {0}".format(e))
+
+def WorkerMain(index, mode, stopping, partition, stats):
+    """
+    Process entry point of a worker
+    """
+    # Ctrl-C reaches the whole process group, the supervisor decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    from mongo import MongoEngine
+    from mqtt import MQTT
+
+    appconfig = AppConfig()
+    if appconfig.get('spool', 'enabled', False):
+        # Every worker replays its own spool
+        appconfig['spool']['directory'] = os.path.join(appconfig['spool']['directory'], 'worker-{0}'.format(index))
+    if appconfig.get('metrics', 'enabled', False):
+        # Worker i serves its metrics on port + 1 + i
+        appconfig['metrics']['port'] = appconfig.get('metrics', 'port', 9108) + 1 + index
+    if appconfig.get('latest', 'enabled', False) and appconfig.get('latest', 'port', 0):
+        # And its latest readings on port + 1 + i
+        appconfig['latest']['port'] = appconfig.get('latest', 'port', 0) + 1 + index
+    update_rate = appconfig.get('logger', 'update_rate', 10)
+    mongo = MongoEngine(config = appconfig)
+    last_report = time.monotonic()
+
+    if mode == 'shared':
+        mqtt = MQTT(config = appconfig, mongo = mongo, share = appconfig.get('supervisor', 'group', 'emon2mongo'))
+        while not stopping.wait(1.0):
+            if not mqtt.isConnected():
+                try:
+                    mqtt.run()
+                except Exception:
+                    logger.info(msg="Worker {0}: can't connect to broker, retry".format(index))
+            if time.monotonic() - last_report >= update_rate:
+                stats.put((index, mongo.stats_snapshot()))
+                last_report = time.monotonic()
+        mqtt.stop()
+    else:
+        while True:
+            try:
+                json_payload = partition.get(timeout=1.0)
+            except queue.Empty:
+                json_payload = False
+            if json_payload == None:
+                # Sent by the supervisor after its MQTT client stopped
+                break
+            if json_payload:
+                mongo.save(json_payload)
+            if time.monotonic() - last_report >= update_rate:
+                stats.put((index, mongo.stats_snapshot()))
+                last_report = time.monotonic()
+
+    mongo.stop()
+    stats.put((index, mongo.stats_snapshot()))
+
+class Supervisor(object):
+    def __init__(self, config: AppConfig):
+        self.config = config
+        self.workers = config.get('supervisor', 'workers', os.cpu_count() or 1)
+        self.mode = config.get('supervisor', 'mode', 'shared')
+        self.restart_delay = config.get('supervisor', 'restart_delay', 5.0)
+        self.update_rate = config.get('logger', 'update_rate', 10)
+
+        self.stopping = multiprocessing.Event()
+        self.stats = multiprocessing.Queue()
+        self.partitions = [None] * self.workers
+        if self.mode == 'partition':
+            self.partitions = [multiprocessing.Queue(config.get('mongodb', 'queue_size', 10000)) for i in range(self.workers)]
+        self.processes = [None] * self.workers
+        self.restarts = [0] * self.workers
+        self.restart_at = [0.0] * self.workers
+
+        # Last stats per worker, and the totals of worker processes that exited
+        self.latest = [{} for i in range(self.workers)]
+        self.retired = dict.fromkeys(COMBINED_STATS, 0)
+
+        self.mqtt = None
+        self._signal = False
+
+    def _start(self, index):
+        process = multiprocessing.Process(
+            target=WorkerMain,
+            args=(index, self.mode, self.stopping, self.partitions[index], self.stats),
+            name="emon2mongo-worker-{0}".format(index)
+        )
+        process.daemon = False
+        process.start()
+        self.processes[index] = process
+        logger.info(msg="Worker {0} started, pid {1}".format(index, process.pid))
+
+    def _collect_stats(self):
+        while True:
+            try:
+                index, stats = self.stats.get_nowait()
+            except queue.Empty:
+                return
+            self.latest[index] = stats
+
+    def _retire(self, index):
+        # Counters of the exited process, its replacement starts from zero
+        for key in COMBINED_STATS:
+            if key != 'queue_depth':
+                self.retired[key] += self.latest[index].get(key, 0)
+        self.latest[index] = {}
+
+    def combined_stats(self):
+        self._collect_stats()
+        combined = dict(self.retired)
+        for stats in self.latest:
+            for key in COMBINED_STATS:
+                combined[key] += stats.get(key, 0)
+        combined['alive'] = sum(1 for process in self.processes if process != None and process.is_alive())
+        combined['restarts'] = sum(self.restarts)
+        return combined
+
+    def _check_workers(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            if self.restart_at[index] == 0.0:
+                self._collect_stats()
+                self._retire(index)
+                # Back off when a worker keeps dying, e.g. MongoDB is down
+                delay = min(self.restart_delay * 2 ** min(self.restarts[index], 6), 300.0)
+                self.restart_at[index] = time.monotonic() + delay
+                logger.error(msg="Worker {0} exited with code {1}, restart in {2:.0f} s".format(index, process.exitcode, delay))
+            elif time.monotonic() >= self.restart_at[index]:
+                self.restart_at[index] = 0.0
+                self.restarts[index] += 1
+                self._start(index)
+
+    def _stop_signal(self, signum, frame):
+        logger.info(msg="Signal {0} caught, draining workers".format(signum))
+        self._signal = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._stop_signal)
+        signal.signal(signal.SIGTERM, self._stop_signal)
+
+        for index in range(self.workers):
+            self._start(index)
+
+        if self.mode == 'partition':
+            from mqtt import MQTT
+            self.mqtt = MQTT(config = self.config, mongo = Partitioner(self.partitions))
+
+        last_report = time.monotonic()
+        while not self._signal:
+            if self.mqtt != None and not self.mqtt.isConnected():
+                try:
+                    self.mqtt.run()
+                except Exception:
+                    logger.info(msg="Cant't connect to Broker, retry")
+            self._check_workers()
+            if time.monotonic() - last_report >= self.update_rate:
+                logger.info(msg="Supervisor: {alive} workers alive, restarts {restarts}, queued {queued}, "
+                                "written {written}, failed {failed}, blocked {blocked}, "
+                                "queue depth {queue_depth}".format(**self.combined_stats()))
+                last_report = time.monotonic()
+            time.sleep(1.0)
+        self.stop()
+
+    def stop(self):
+        if self.mqtt != None:
+            # Nothing new arrives after this, the sentinels end the partitions
+            self.mqtt.stop()
+            for partition in self.partitions:
+                partition.put(None)
+        self.stopping.set()
+
+        deadline = time.monotonic() + self.config.get('supervisor', 'drain_timeout', 60.0)
+        for index, process in enumerate(self.processes):
+            # Keep reading stats, a worker does not exit before its queue is flushed
+            while process.is_alive() and time.monotonic() < deadline:
+                self._collect_stats()
+                process.join(0.5)
+            self._collect_stats()
+            if process.is_alive():
+                logger.error(msg="Worker {0} did not drain in time, terminating".format(index))
+                process.terminate()
+                process.join()
+        logger.info(msg="Supervisor stopped: queued {queued}, written {written}, failed {failed}".format(**self.combined_stats()))
+
+if __name__ == '__main__':
+    Supervisor(AppConfig()).run()
@@ -0,0 +1,160 @@
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from appconfig import AppConfig
+from dsmr import Reading, READING_MEASUREMENTS
+from logger import logger
+
+# Compact key -> unit of the measurements, for the deadband per unit
+MEASUREMENT_UNITS = dict((key, unit) for attribute, key, unit in READING_MEASUREMENTS)
+
+def Changes(old, new, deadband):
+    """
+    Compact keys of new that differ from old, measurements only when they
+    moved more than the deadband of their unit. A field that disappeared is None.
+    """
+    changes = {}
+    for key in set(old) | set(new):
+        before = old.get(key)
+        after = new.get(key)
+        if before == after:
+            continue
+        if before != None and after != None and key in MEASUREMENT_UNITS and abs(after - before) <= deadband.get(MEASUREMENT_UNITS[key], 0.0):
+            continue
+        changes[key] = after
+    return changes
+
+class Suppressor(object):
+    """
+    Per meter last state, for readings that did not change
+
+    suppress.mode 'drop' does not store a decoded reading that is the same as
+    the last stored one of its meter, apart from changes within the deadband.
+    'delta' stores the changed fields only, as compact keys against a full
+    keyframe reading: {p1_decoded: {changed}, base: keyframe _id}. Either way a
+    full reading is stored at least every keyframe_seconds. Raw documents keep
+    the full p1_decoded.
+    """
+    def __init__(self, config: AppConfig):
+        self.mode = config.get('suppress', 'mode', 'off')
+        self.keyframe = timedelta(seconds=config.get('suppress', 'keyframe_seconds', 900))
+        self.deadband = config.get('suppress', 'deadband', {})
+
+        # signature -> [keyframe _id, keyframe createdAt, compact keyframe, _id and compact of the last stored reading],
+        # for the max_meters meters seen most recently
+        self.max_meters = config.get('suppress', 'max_meters', 100000)
+        self._meters = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.keyframes = 0
+        self.deltas = 0
+        self.dropped = 0
+
+    def apply(self, batch):
+        """
+        Sets suppressed, or delta and base, of the envelopes with a Reading. The
+        meter states only move on with commit() of the returned pending states,
+        once the batch is stored: a keyframe that was not stored is never a base
+        """
+        states = {}
+        counts = [0, 0, 0]
+        with self._lock:
+            for envelope in batch:
+                if envelope.reading != None and envelope.signature not in states:
+                    state = self._meters.get(envelope.signature)
+                    states[envelope.signature] = list(state) if state != None else None
+
+        for envelope in batch:
+            if envelope.reading == None:
+                continue
+            compact = envelope.reading.ToCompact()
+            state = states[envelope.signature]
+            if state == None or state[0] == envelope._id or envelope.createdAt - state[1] >= self.keyframe or envelope.createdAt < state[1]:
+                # New or evicted meter, a retried keyframe, keyframe due or a reading from before the keyframe
+                states[envelope.signature] = [envelope._id, envelope.createdAt, compact, envelope._id, compact]
+                counts[0] += 1
+                continue
+
+            if self.mode == 'drop':
+                if state[3] != envelope._id and not Changes(state[4], compact, self.deadband):
+                    envelope.suppressed = True
+                    counts[2] += 1
+                    continue
+                state[3] = envelope._id
+                state[4] = compact
+                counts[1] += 1
+                continue
+
+            envelope.delta = Changes(state[2], compact, self.deadband)
+            envelope.base = state[0]
+            counts[1] += 1
+        return states, counts
+
+    def commit(self, pending):
+        """
+        Meter states of apply(), after the batch is stored
+        """
+        states, counts = pending
+        with self._lock:
+            for signature, state in states.items():
+                self._meters[signature] = state
+                self._meters.move_to_end(signature)
+            while len(self._meters) > self.max_meters:
+                self._meters.popitem(last=False)
+            self.keyframes += counts[0]
+            self.deltas += counts[1]
+            self.dropped += counts[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'suppress_keyframes': self.keyframes,
+                'suppress_deltas': self.deltas,
+                'suppress_dropped': self.dropped
+            }
+
+def Reconstruct(documents, collection, encoding = 'nested', cache_size = 1024):
+    """
+    Decoded documents with the full p1_decoded, delta documents are completed
+    from their keyframe, found in the same stream or else in collection. A
+    delta document whose keyframe is gone keeps its base and changed fields only
+    """
+    keyframes = OrderedDict()
+    for document in documents:
+        base = document.get('base')
+        if base == None:
+            keyframes[document['_id']] = document.get('p1_decoded') or {}
+            if len(keyframes) > cache_size:
+                keyframes.popitem(last=False)
+            yield document
+            continue
+
+        if base not in keyframes:
+            found = collection.find_one({'_id': base}, {'p1_decoded': 1})
+            if found == None:
+                # Bucket layout, the keyframe is one of the readings of a bucket
+                bucket = collection.find_one({'readings._id': base}, {'readings': {'$elemMatch': {'_id': base}}})
+                found = bucket['readings'][0] if bucket != None else None
+            if found == None:
+                logger.warning(msg="Keyframe {0} not found, readings of {1} from {2} on are incomplete".format(base, document.get('signature'), document.get('createdAt')))
+            keyframes[base] = (found.get('p1_decoded') or {}) if found != None else None
+            if len(keyframes) > cache_size:
+                keyframes.popitem(last=False)
+        keyframe = keyframes[base]
+
+        full = {}
+        if keyframe and 'power' in keyframe:
+            full = Reading.FromJSON(keyframe).ToCompact()
+        elif keyframe:
+            full = dict(keyframe)
+        for key, value in document['p1_decoded'].items():
+            if value == None:
+                full.pop(key, None)
+            else:
+                full[key] = value
+        document = dict(document)
+        if keyframe != None:
+            del document['base']
+        # else the keyframe is lost, the changed fields are all there is and base stays to tell it apart
+        document['p1_decoded'] = Reading.FromCompact(full).ToJSON() if encoding == 'nested' else full
+        yield document
@@ -0,0 +1,159 @@
+"""
+Synthetic P1 telegrams for benchmarks and load tests
+
+    generator = TelegramGenerator(seed = 1)
+    generator.telegram('50', phases = 3, gas = True, failure_log = True)
+    generator.corrupt(generator.telegram('42'))
+
+Telegrams follow the layout of real meters of each DSMR version: header line,
+blank line, OBIS lines and a '!' footer with the CRC16 (DSMR 4.0 and later).
+Register values move forward from one telegram to the next per generator.
+"""
+import random
+from datetime import datetime, timedelta
+from crc16 import Crc16
+
+VERSIONS = ('22', '30', '42', '50')
+
+# Header lines of meters seen in the field, per version
+HEADERS = {
+    '22': ['/ISk5\\2MT382-1004', '/KMP5 ZABF000000000000'],
+    '30': ['/ISk5\\2MT382-1003', '/XMX5XMXABCE000018736'],
+    '42': ['/KFM5KAIFA-METER', '/ISk5\\2MT382-1000', '/XMX5LGBBFFB231215493'],
+    '50': ['/ISK5\\2M550T-1012', '/Ene5\\T210-D ESMR5.0', '/KFM5KAIFA-METER']
+}
+
+CORRUPTIONS = ('truncate', 'bitflip', 'drop_line', 'garble_value', 'bad_crc')
+
+def HexId(rng, length = 34):
+    # Equipment ids are ASCII digits written out as hex
+    return ''.join('3{0}'.format(rng.randint(0, 9)) for i in range(length // 2))
+
+class TelegramGenerator(object):
+    def __init__(self, seed = None, start = None):
+        self.rng = random.Random(seed)
+        self.time = start or datetime(2020, 2, 13, 17, 0, 0)
+        self.registers = [self.rng.uniform(1000.0, 20000.0) for i in range(4)]
+        self.gas = self.rng.uniform(100.0, 8000.0)
+        self.power_failures = self.rng.randint(0, 20)
+
+    def _advance(self, interval):
+        self.time += timedelta(seconds=interval)
+        for index in range(4):
+            self.registers[index] += self.rng.uniform(0.0, 0.01)
+        self.gas += self.rng.uniform(0.0, 0.005)
+
+    def _timestamp(self, at = None):
+        # W for winter time, S for summer time
+        at = at or self.time
+        return at.strftime('%y%m%d%H%M%S') + ('S' if 4 <= at.month <= 9 else 'W')
+
+    def telegram(self, version = '50', phases = 3, gas = True, failure_log = True, interval = 10):
+        """
+        One telegram of a DSMR version from VERSIONS, phases 1 or 3
+        """
+        self._advance(interval)
+        rng = self.rng
+        tariff = rng.choice((1, 2))
+        delivered = rng.uniform(0.0, 3.5)
+        received = rng.uniform(0.0, 1.5) if delivered < 0.5 else 0.0
+
+        lines = [rng.choice(HEADERS[version]), '']
+        if version in ('42', '50'):
+            lines.append('1-3:0.2.8({0})'.format(version))
+            lines.append('0-0:1.0.0({0})'.format(self._timestamp()))
+        if version == '22':
+            lines.append('0-0:42.0.0({0})'.format(HexId(rng)))
+        else:
+            lines.append('0-0:96.1.1({0})'.format(HexId(rng)))
+        lines.append('1-0:1.8.1({0:010.3f}*kWh)'.format(self.registers[0]))
+        lines.append('1-0:1.8.2({0:010.3f}*kWh)'.format(self.registers[1]))
+        lines.append('1-0:2.8.1({0:010.3f}*kWh)'.format(self.registers[2]))
+        lines.append('1-0:2.8.2({0:010.3f}*kWh)'.format(self.registers[3]))
+        lines.append('0-0:96.14.0({0:04d})'.format(tariff))
+        lines.append('1-0:1.7.0({0:06.3f}*kW)'.format(delivered))
+        lines.append('1-0:2.7.0({0:06.3f}*kW)'.format(received))
+        if version == '22' or version == '30':
+            lines.append('0-0:17.0.0(999*A)')
+            lines.append('0-0:96.3.10(1)')
+            lines.append('0-0:96.13.1()')
+            lines.append('0-0:96.13.0()')
+            if gas:
+                lines.append('0-1:24.1.0(3)')
+                lines.append('0-1:96.1.0({0})'.format(HexId(rng)))
+                lines.append('0-1:24.3.0({0})(00)(60)(1)(0-1:24.2.1)(m3)'.format(self._timestamp(self.time.replace(minute=0, second=0))))
+                lines.append('({0:09.3f})'.format(self.gas))
+                lines.append('0-1:24.4.0(1)')
+            return '\r\n'.join(lines) + '\r\n!\r\n'
+
+        lines.append('0-0:96.7.21({0:05d})'.format(self.power_failures))
+        lines.append('0-0:96.7.9({0:05d})'.format(self.power_failures // 4))
+        if failure_log:
+            events = rng.randint(1, 3)
+            log = '1-0:99.97.0({0})(0-0:96.7.19)'.format(events)
+            for event in range(events):
+                at = self.time - timedelta(days=rng.randint(1, 700))
+                log += '({0})({1:010d}*s)'.format(self._timestamp(at), rng.randint(180, 100000))
+            lines.append(log)
+        else:
+            lines.append('1-0:99.97.0()(0-0:96.7.19)')
+        for phase in (range(3) if phases == 3 else range(1)):
+            lines.append('1-0:{0}.32.0({1:05d})'.format(32 + 20 * phase, rng.randint(0, 3)))
+        for phase in (range(3) if phases == 3 else range(1)):
+            lines.append('1-0:{0}.36.0({1:05d})'.format(32 + 20 * phase, rng.randint(0, 3)))
+        if version == '42':
+            lines.append('0-0:96.13.1()')
+        lines.append('0-0:96.13.0()')
+        for phase in (range(3) if phases == 3 else range(1)):
+            lines.append('1-0:{0}.7.0({1:05.1f}*V)'.format(32 + 20 * phase, rng.uniform(225.0, 240.0)))
+        share = delivered / phases
+        for phase in (range(3) if phases == 3 else range(1)):
+            lines.append('1-0:{0}.7.0({1:03d}*A)'.format(31 + 20 * phase, int(share * 1000 / 230)))
+        for phase in (range(3) if phases == 3 else range(1)):
+            lines.append('1-0:{0}.7.0({1:06.3f}*kW)'.format(21 + 20 * phase, share))
+        for phase in (range(3) if phases == 3 else range(1)):
+            lines.append('1-0:{0}.7.0({1:06.3f}*kW)'.format(22 + 20 * phase, received / phases))
+        if gas:
+            lines.append('0-1:24.1.0(003)')
+            lines.append('0-1:96.1.0({0})'.format(HexId(rng)))
+            lines.append('0-1:24.2.1({0})({1:09.3f}*m3)'.format(self._timestamp(self.time.replace(second=0)), self.gas))
+
+        body = '\r\n'.join(lines) + '\r\n!'
+        return body + '{0:04X}\r\n'.format(Crc16(body.encode('ascii')))
+
+    def corrupt(self, telegram, kind = None):
+        """
+        A damaged copy of a telegram, kind from CORRUPTIONS or random
+        """
+        rng = self.rng
+        kind = kind or rng.choice(CORRUPTIONS)
+        if kind == 'truncate':
+            return telegram[:rng.randint(1, len(telegram) - 1)]
+        if kind == 'bitflip':
+            position = rng.randint(0, len(telegram) - 1)
+            return telegram[:position] + chr(ord(telegram[position]) ^ (1 << rng.randint(0, 6))) + telegram[position + 1:]
+        lines = telegram.split('\r\n')
+        # Skip the header, blank line and footer
+        index = rng.randint(2, max(2, len(lines) - 3))
+        if kind == 'drop_line':
+            del lines[index]
+        elif kind == 'garble_value':
+            lines[index] = lines[index].replace('.', ',').replace('*', '')
+        elif kind == 'bad_crc':
+            footer = len(lines) - 2
+            lines[footer] = '!{0:04X}'.format(rng.randint(0, 0xFFFF))
+        return '\r\n'.join(lines)
+
+    def mix(self, count, versions = VERSIONS, corrupt_ratio = 0.0):
+        """
+        count telegrams over the given versions, single and three phase, with and without gas
+        """
+        telegrams = []
+        for index in range(count):
+            version = versions[index % len(versions)]
+            telegram = self.telegram(version, phases = self.rng.choice((1, 3)), gas = self.rng.random() < 0.8,
+                                     failure_log = self.rng.random() < 0.5)
+            if self.rng.random() < corrupt_ratio:
+                telegram = self.corrupt(telegram)
+            telegrams.append(telegram)
+        return telegrams
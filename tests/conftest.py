@@ -0,0 +1,37 @@
+import os, sys
+
+# The modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def config():
+    """
+    config.json with the optional features off, to be turned on per test
+    """
+    from appconfig import AppConfig
+    config = AppConfig()
+    config.app_config['mongodb'].update(validation='off', backend='pymongo', layout='document', encoding='nested', database='test')
+    config.app_config['parser']['crc'] = 'off'
+    config.app_config['suppress']['mode'] = 'off'
+    config.app_config['rollup']['enabled'] = False
+    config.app_config['spool']['enabled'] = False
+    config.app_config['latest']['enabled'] = False
+    config.app_config['ratelimit']['enabled'] = False
+    return config
+
+@pytest.fixture
+def mongomock_connect(monkeypatch):
+    """
+    MongoEngine on an in-memory mongomock database
+    """
+    mongomock = pytest.importorskip('mongomock')
+    import mongoengine
+    from mongoengine.connection import disconnect
+    import mongo
+    connect = mongoengine.connect
+    disconnect()
+    monkeypatch.setattr(mongo, 'connect', lambda **kwargs: connect(db=kwargs['db'], mongo_client_class=mongomock.MongoClient))
+    yield
+    disconnect()
@@ -0,0 +1,65 @@
+import pytest
+
+import crc16
+from crc16 import Crc16, CheckTelegram, CheckBatch, BAD_CRC, CRC_MISSING, NO_FOOTER, NO_HEADER, NOT_TEXT
+from telegram_generator import TelegramGenerator
+
+def Telegram(version = '50', seed = 1):
+    return TelegramGenerator(seed = seed).telegram(version)
+
+def test_check_value():
+    # CRC-16/ARC check value of the catalogue
+    assert Crc16(b'123456789') == 0xBB3D
+
+@pytest.mark.parametrize('data', [b'', b'/', b'/ISK5\\2M550T-1012\r\n!', bytes(range(256)) * 3 + b'!'])
+def test_table_matches_bitwise(monkeypatch, data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for i in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    # The two byte table, also when crcmod is installed
+    monkeypatch.setattr(crc16, '_crc_arc', None)
+    assert Crc16(data) == crc
+    assert Crc16(data[len(data) // 2:], Crc16(data[:len(data) // 2])) == crc
+
+@pytest.mark.parametrize('version', ['42', '50'])
+def test_valid(version):
+    assert CheckTelegram(Telegram(version)) == None
+
+def test_without_crc():
+    # DSMR 2.2 and 3.0 have no CRC
+    assert CheckTelegram(Telegram('22')) == None
+    assert CheckTelegram(Telegram('30')) == None
+
+def test_bad_crc():
+    telegram = Telegram()
+    end = telegram.rindex('!')
+    crc = int(telegram[end + 1:end + 5], 16)
+    assert CheckTelegram(telegram[:end + 1] + '{0:04X}\r\n'.format(crc ^ 1)) == BAD_CRC
+    assert CheckTelegram(telegram.replace('1-0:1.8.1(', '1-0:1.8.2(', 1)) == BAD_CRC
+
+def test_crc_missing():
+    telegram = Telegram()
+    assert CheckTelegram(telegram[:telegram.rindex('!') + 1]) == CRC_MISSING
+    assert CheckTelegram(telegram[:telegram.rindex('!') + 3]) == CRC_MISSING
+
+def test_stripped_carriage_returns():
+    telegram = Telegram()
+    assert CheckTelegram(telegram.replace('\r\n', '\n')) == None
+    # Only a telegram without any carriage return was stripped by a gateway
+    stripped = telegram.replace('\r\n', '\n')
+    assert CheckTelegram(stripped.replace('\n', '\r\n', 1)) == BAD_CRC
+
+def test_header_and_footer():
+    telegram = Telegram()
+    assert CheckTelegram(telegram[telegram.index('\n') + 1:]) == NO_HEADER
+    assert CheckTelegram('\r\n' + telegram) == None
+    assert CheckTelegram('garbage' + telegram) == NO_HEADER
+    assert CheckTelegram(telegram[:telegram.rindex('!')]) == NO_FOOTER
+    assert CheckTelegram(telegram.encode('ascii')) == NOT_TEXT
+    assert CheckTelegram(None) == NOT_TEXT
+
+def test_batch():
+    telegram = Telegram()
+    assert CheckBatch([telegram, telegram[:telegram.rindex('!') + 1], 'x']) == [None, CRC_MISSING, NO_HEADER]
@@ -0,0 +1,72 @@
+import pytest
+
+import dsmr
+from dsmr import DSMR_Parser, DetectStrategy, StrategyCache
+from telegram_generator import TelegramGenerator
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    cache = StrategyCache()
+    monkeypatch.setattr(dsmr, 'STRATEGY_CACHE', cache)
+    return cache
+
+def WithoutVersionLine(telegram):
+    return ''.join(line for line in telegram.splitlines(True) if not line.startswith('1-3:0.2.8('))
+
+@pytest.mark.parametrize('version', ['42', '50'])
+def test_frame_without_version_line_does_not_poison_the_cache(cache, version):
+    generator = TelegramGenerator(seed = 1)
+    first = generator.telegram(version)
+    header = first.split('\n', 1)[0]
+    damaged = WithoutVersionLine(first)
+    assert DetectStrategy(damaged) == '30'
+
+    DSMR_Parser(damaged, signature = 'meter').parse()
+    for i in range(3):
+        telegram = header + '\n' + generator.telegram(version).split('\n', 1)[1]
+        assert DSMR_Parser(telegram, signature = 'meter').parse() == DSMR_Parser(telegram).parse()
+        assert DSMR_Parser(telegram, signature = 'meter').reading().version == version
+
+@pytest.mark.parametrize('version', ['22', '30', '42', '50'])
+def test_cached_results_match_detection(cache, version):
+    generator = TelegramGenerator(seed = 2)
+    header = generator.telegram(version).split('\n', 1)[0]
+    for i in range(5):
+        telegram = header + '\n' + generator.telegram(version).split('\n', 1)[1]
+        assert DSMR_Parser(telegram, signature = 'meter').parse() == DSMR_Parser(telegram).parse()
+    assert cache.stats()['parser_cache_hits'] == 4
+
+def test_only_decoded_telegrams_are_cached(cache):
+    DSMR_Parser('/XMX5LGBBFG1009021021\r\n\r\nnonsense\r\n!0000\r\n', signature = 'meter').parse()
+    assert cache.stats()['parser_cache_meters'] == 0
+
+def test_other_header_is_detected_again(cache):
+    generator = TelegramGenerator(seed = 3)
+    old = generator.telegram('30')
+    new = generator.telegram('50')
+    DSMR_Parser(old, signature = 'meter').parse()
+    assert DSMR_Parser(new, signature = 'meter').parse() == DSMR_Parser(new).parse()
+    assert cache.stats()['parser_cache_changes'] == 1
+
+def WithCrc(telegram):
+    """
+    The telegram with the CRC of its current content
+    """
+    from crc16 import Crc16
+    end = telegram.rindex('!')
+    return telegram[:end + 1] + '{0:04X}'.format(Crc16(telegram[telegram.index('/'):end + 1].encode('ascii'))) + '\r\n'
+
+@pytest.mark.parametrize('version', ['22', '30', '42', '50'])
+@pytest.mark.parametrize('separator', ['\r\x0e', '\r\x0e\n', '\x00', '\r'])
+def test_obis_engine_reads_lines_like_the_regex_engine(version, separator):
+    from crc16 import CheckTelegram
+    telegram = TelegramGenerator(seed = 4).telegram(version)
+    damaged = WithCrc(telegram.replace('\r\n1-0:1.8.1(', separator + '1-0:1.8.1(', 1))
+    assert CheckTelegram(damaged) == None
+    expected = DSMR_Parser(telegram).parse()
+    assert DSMR_Parser(damaged).parse() == expected
+    assert DSMR_Parser(damaged, 'obis').parse() == expected
+
+def test_obis_code_glued_to_a_digit():
+    telegram = TelegramGenerator(seed = 5).telegram('50').replace('\r\n1-0:1.7.0(', '\r91-0:1.7.0(', 1)
+    assert DSMR_Parser(telegram, 'obis').parse() == DSMR_Parser(telegram).parse()
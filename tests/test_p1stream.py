@@ -0,0 +1,98 @@
+import asyncio, threading, time
+
+from p1stream import P1Framer, P1Stream
+from telegram_generator import TelegramGenerator
+
+def Telegrams(count, version = '50'):
+    generator = TelegramGenerator(seed = 1)
+    return [generator.telegram(version) for i in range(count)]
+
+def test_any_chunking_gives_the_same_telegrams():
+    telegrams = Telegrams(5)
+    stream = ''.join(telegrams).encode()
+    for size in (1, 7, 64, 1000, len(stream)):
+        framer = P1Framer()
+        frames = []
+        for start in range(0, len(stream), size):
+            frames.extend(framer.feed(stream[start:start + size]))
+        assert frames == telegrams
+        assert framer.stats() == {'frames': 5, 'partial': 0, 'oversized': 0, 'garbage_bytes': 0}
+
+def test_resync_on_a_cut_off_frame():
+    first, second, third = Telegrams(3)
+    framer = P1Framer()
+    frames = framer.feed(b'noise' + first[:200].encode() + second.encode() + b'\x00\x00' + third.encode())
+    assert frames == [second, third]
+    assert framer.stats() == {'frames': 2, 'partial': 1, 'oversized': 0, 'garbage_bytes': 7}
+
+def test_oversized_frame_is_dropped():
+    telegram = Telegrams(1)[0]
+    framer = P1Framer(max_size = 100)
+    assert framer.feed(telegram[:-8].encode()) == []
+    assert framer.stats()['oversized'] == 1
+    small = '/ABC5\r\n\r\n1-0:1.8.1(000001.000*kWh)\r\n!1234\r\n'
+    assert framer.feed(telegram[-8:].encode() + small.encode()) == [small]
+
+def test_trailer_split_over_chunks():
+    telegram = Telegrams(1)[0]
+    framer = P1Framer()
+    end = telegram.index('!')
+    assert framer.feed(telegram[:end + 2].encode()) == []
+    assert framer.feed(telegram[end + 2:-1].encode()) == []
+    assert framer.feed(telegram[-1:].encode()) == [telegram]
+
+def test_close_returns_a_telegram_without_line_end():
+    telegram = Telegrams(1)[0]
+    framer = P1Framer()
+    assert framer.feed(telegram.rstrip().encode()) == []
+    assert framer.close() == [telegram.rstrip()]
+
+class SlowMongo(object):
+    """
+    save() of one meter blocks until released
+    """
+    def __init__(self):
+        self.saved = []
+        self.release = threading.Event()
+
+    def save(self, json_payload, received = None):
+        datagram = json_payload['datagram']
+        if datagram['signature'] == 'slow':
+            self.release.wait(2)
+        self.saved.append(datagram['signature'])
+
+def test_slow_save_does_not_stall_other_streams(config):
+    telegrams = Telegrams(3)
+
+    async def run():
+        async def serve(reader, writer):
+            for telegram in telegrams:
+                writer.write(telegram.encode())
+            await writer.drain()
+            await asyncio.sleep(5)
+            writer.close()
+        servers = [await asyncio.start_server(serve, '127.0.0.1', 0) for i in range(2)]
+        ports = [server.sockets[0].getsockname()[1] for server in servers]
+        config.app_config['p1stream'] = {'sources': [
+            {'signature': 'slow', 'tcp': '127.0.0.1:{0}'.format(ports[0])},
+            {'signature': 'fast', 'tcp': '127.0.0.1:{0}'.format(ports[1])}
+        ]}
+        mongo = SlowMongo()
+        stream = P1Stream(config, mongo)
+        readers = [asyncio.create_task(stream.read(source)) for source in config['p1stream']['sources']]
+        deadline = time.monotonic() + 5
+        while mongo.saved.count('fast') < 3 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        fast = mongo.saved.count('fast')
+        mongo.release.set()
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        for server in servers:
+            server.close()
+        return fast, mongo
+
+    fast, mongo = asyncio.run(run())
+    assert fast == 3
+    # Stored while the slow meter was still waiting
+    assert mongo.saved[:3] == ['fast', 'fast', 'fast']
@@ -0,0 +1,63 @@
+import pytest
+
+from ratelimit import RateLimiter, INTERVAL, THROTTLED, SHED
+
+@pytest.fixture
+def limiter(config):
+    def create(**limits):
+        config.app_config['ratelimit'].update(dict(min_interval = 0.0, rate = 0.0, burst = 10, high_water = 0.0, max_meters = 100000), **limits)
+        return RateLimiter(config)
+    return create
+
+def test_min_interval(limiter):
+    limits = limiter(min_interval = 5.0)
+    assert limits.admit('meter', now = 100.0) == None
+    assert limits.admit('meter', now = 104.0) == INTERVAL
+    assert limits.admit('other', now = 104.0) == None
+    assert limits.admit('meter', now = 105.0) == None
+    assert limits.counts('meter') == (1, 0)
+
+def test_token_bucket(limiter):
+    limits = limiter(rate = 1.0, burst = 3)
+    assert [limits.admit('meter', now = 100.0) for i in range(4)] == [None, None, None, THROTTLED]
+    # One token per second comes back, never more than the burst
+    assert limits.admit('meter', now = 101.0) == None
+    assert limits.admit('meter', now = 101.5) == THROTTLED
+    assert [limits.admit('meter', now = 200.0) for i in range(4)] == [None, None, None, THROTTLED]
+    assert limits.counts('meter') == (3, 0)
+
+def test_shed_at_high_water(limiter):
+    limits = limiter(rate = 1.0, burst = 5, high_water = 0.8)
+    # The noisy meter used its burst, the quiet one did not
+    for i in range(3):
+        limits.admit('noisy', now = 100.0)
+    limits.admit('quiet', now = 100.0)
+    assert limits.admit('noisy', fill = 0.9, now = 100.0) == SHED
+    assert limits.admit('quiet', fill = 0.9, now = 100.0) == None
+    assert limits.admit('noisy', fill = 0.5, now = 100.0) == None
+    assert limits.counts('noisy') == (0, 1)
+
+def test_unbounded_rate_never_sheds(limiter):
+    limits = limiter(high_water = 0.8)
+    assert all(limits.admit('meter', fill = 1.0, now = 100.0) == None for i in range(20))
+
+def test_worst_and_stats(limiter):
+    limits = limiter(rate = 1.0, burst = 1)
+    for signature, messages in (('a', 2), ('b', 5), ('c', 1), ('d', 3)):
+        for i in range(messages):
+            limits.admit(signature, now = 100.0)
+    assert limits.worst(2) == [('b', 4, 0), ('d', 2, 0)]
+    assert limits.counts('unknown') == (0, 0)
+    stats = limits.stats()
+    assert (stats['ratelimit_admitted'], stats['ratelimit_throttled']) == (4, 7)
+    assert [signature for signature, throttled, shed in stats['ratelimit_worst']] == ['b', 'd', 'a']
+
+def test_max_meters(limiter):
+    limits = limiter(rate = 1.0, burst = 1, max_meters = 2)
+    limits.admit('a', now = 100.0)
+    limits.admit('b', now = 100.0)
+    limits.admit('a', now = 100.0)
+    # b is the least recent meter and makes room for c, a keeps its empty bucket
+    limits.admit('c', now = 100.0)
+    assert limits.admit('a', now = 100.0) == THROTTLED
+    assert limits.admit('b', now = 100.0) == None
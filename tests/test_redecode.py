@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from mongo import Envelope
+from telegram_generator import TelegramGenerator
+
+@pytest.mark.parametrize('layout', ['document', 'bucket'])
+def test_archived_telegrams_are_redecoded(config, mongomock_connect, layout):
+    import mongo
+    from layouts import CreateLayout
+    from mongoengine.connection import get_db
+    from redecode import Redecode
+    config.app_config['mongodb'].update(raw = 'archive', layout = layout)
+    engine = mongo.MongoEngine(config)
+    generator = TelegramGenerator(seed = 1)
+    batch = []
+    for index in range(20):
+        envelope = Envelope(generator.telegram('50'), None, 'meter', {}, {}, createdAt = datetime(2026, 1, 1) + timedelta(seconds = 10 * index))
+        engine._decode(envelope)
+        batch.append(envelope)
+    engine._flush(batch)
+    engine.stop()
+
+    # A parser bug: the stored readings lost their tariff
+    collection = CreateLayout(get_db(), config).collection
+    if layout == 'bucket':
+        for bucket in collection.find():
+            for reading in bucket['readings']:
+                reading['p1_decoded']['tariff'] = None
+            collection.replace_one({'_id': bucket['_id']}, bucket)
+    else:
+        collection.update_many({}, {'$set': {'p1_decoded.tariff': None}})
+
+    # mongomock has no array filters for the bucket update, a dry run still compares
+    redecode = Redecode(config, 'test', 1, 8, dry_run = layout == 'bucket', examples = 0)
+    redecode.run()
+    assert (redecode.scanned, redecode.changed, redecode.unparsed) == (20, 20, 0)
+    assert redecode.fields == {'tariff': 20}
+    if layout == 'document':
+        assert [document['p1_decoded'] for document in collection.find()] == [envelope.p1_decoded for envelope in batch]
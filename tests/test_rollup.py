@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from dsmr import Reading
+from mongo import Envelope
+from rollup import Rollup
+
+def Readings(signature, start, values, seconds = 20):
+    """
+    Envelopes with only energy_by_t1 set, seconds apart
+    """
+    envelopes = []
+    for index, value in enumerate(values):
+        envelope = Envelope(None, None, signature, {}, {}, createdAt = start + timedelta(seconds = seconds * index))
+        envelope.reading = Reading()
+        envelope.reading.energy_by_t1 = value
+        envelope.reading.power_delivered = 1.0
+        envelopes.append(envelope)
+    return envelopes
+
+@pytest.fixture
+def rollup(config):
+    mongomock = pytest.importorskip('mongomock')
+    config.app_config['rollup'].update(windows = [1], flush_interval = 3600)
+    rollup = Rollup(mongomock.MongoClient()['test'], config)
+    yield rollup
+    rollup.stop()
+
+def test_deltas_add_up_to_the_increase(rollup):
+    # Three readings per minute, the register moves between the windows too
+    start = datetime(2026, 1, 1)
+    values = [100.0 + index for index in range(9)]
+    rollup.add(Readings('meter', start, values))
+    rollup.flush(everything = True)
+
+    windows = list(rollup.read(1, 'meter', start, start + timedelta(minutes = 3)))
+    assert [window['energy']['energy_by_t1']['delta'] for window in windows] == [2.0, 3.0, 3.0]
+    assert sum(window['energy']['energy_by_t1']['delta'] for window in windows) == values[-1] - values[0]
+
+def test_delta_against_the_window_before_the_range(rollup):
+    start = datetime(2026, 1, 1)
+    rollup.add(Readings('meter', start, [100.0 + index for index in range(9)]))
+    rollup.add(Readings('other', start, [500.0 + 10 * index for index in range(9)]))
+    rollup.flush(everything = True)
+
+    windows = list(rollup.read(1, 'meter', start + timedelta(minutes = 1), start + timedelta(minutes = 3)))
+    assert [window['energy']['energy_by_t1']['delta'] for window in windows] == [3.0, 3.0]
+    assert windows[0]['stats']['power_delivered']['avg'] == 1.0
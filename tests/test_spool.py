@@ -0,0 +1,75 @@
+import os, time
+
+from spool import Spool, SpoolPosition, SpoolReplayer, RECORD_HEADER
+
+def Payloads(count):
+    return [('{"datagram": "telegram %d"}' % index).encode() for index in range(count)]
+
+def Crashed(directory, payloads, torn):
+    """
+    Spool of a run that crashed torn bytes into the write of its last record
+    """
+    spool = Spool(str(directory), fsync = 'never')
+    for payload in payloads:
+        spool.append(payload)
+    spool.close()
+    path = spool._path(spool.segments()[-1])
+    os.truncate(path, os.path.getsize(path) - torn)
+    return path
+
+def test_torn_tail_of_a_previous_run(tmp_path):
+    payloads = Payloads(5)
+    Crashed(tmp_path, payloads, torn = 3)
+    spool = Spool(str(tmp_path), fsync = 'never')
+    read, position = spool.read(spool.position, 100)
+    assert read == payloads[:4]
+    # Sealed segment, the torn record is skipped and replay goes on with the next segment
+    assert (position.segment, position.offset) == (2, 0)
+    spool.append(b'after')
+    assert spool.read(position, 100)[0] == [b'after']
+    spool.close()
+
+def test_torn_header(tmp_path):
+    payloads = Payloads(3)
+    Crashed(tmp_path, payloads, torn = len(payloads[-1]) + RECORD_HEADER.size - 2)
+    spool = Spool(str(tmp_path), fsync = 'never')
+    assert spool.read(spool.position, 100)[0] == payloads[:2]
+    spool.close()
+
+def test_corrupt_record(tmp_path):
+    payloads = Payloads(4)
+    path = Crashed(tmp_path, payloads, torn = 0)
+    with open(path, 'r+b') as segment:
+        segment.seek(2 * (RECORD_HEADER.size + len(payloads[0])) + RECORD_HEADER.size)
+        segment.write(b'X')
+    spool = Spool(str(tmp_path), fsync = 'never')
+    read, position = spool.read(spool.position, 100)
+    assert read == payloads[:2]
+    assert position.segment == 2
+    spool.close()
+
+def test_active_segment_waits_for_the_rest_of_a_record(tmp_path):
+    spool = Spool(str(tmp_path), fsync = 'never')
+    spool.append(b'complete')
+    # Half a record, as a reader may see it while a write is in progress elsewhere
+    with open(spool._path(spool._segment), 'ab') as segment:
+        segment.write(RECORD_HEADER.pack(100, 0) + b'partial')
+    read, position = spool.read(SpoolPosition(1, 0), 100)
+    assert read == [b'complete']
+    assert (position.segment, position.offset) == (1, RECORD_HEADER.size + len(b'complete'))
+    read, again = spool.read(position, 100)
+    assert read == [] and (again.segment, again.offset) == (position.segment, position.offset)
+    spool.close()
+
+def test_replay_after_a_crash(tmp_path):
+    payloads = Payloads(10)
+    Crashed(tmp_path, payloads, torn = 5)
+    stored = []
+    replayer = SpoolReplayer(Spool(str(tmp_path), fsync = 'never'), stored.extend, batch_size = 4, idle = 0.01)
+    replayer.start()
+    deadline = time.monotonic() + 5.0
+    while replayer.spool.position.segment < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    replayer.stop()
+    assert stored == payloads[:9]
+    assert replayer.spool.segments() == [2]
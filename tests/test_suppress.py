@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from mongo import Envelope
+from suppress import Reconstruct, Suppressor
+from telegram_generator import TelegramGenerator
+from dsmr import DSMR_Parser
+
+def Readings(count, signature = 'meter', seed = 1, repeat = 1, start = datetime(2026, 1, 1)):
+    """
+    Envelopes with a Reading 10 seconds apart, every telegram repeat times in a row
+    """
+    generator = TelegramGenerator(seed = seed, start = start)
+    envelopes = []
+    for index in range(count):
+        if index % repeat == 0:
+            telegram = generator.telegram('50', failure_log = False, gas = False)
+        envelope = Envelope(telegram, None, signature, {}, {}, createdAt = start + timedelta(seconds = 10 * index))
+        envelope.reading = DSMR_Parser(telegram).reading()
+        envelope.p1_decoded = envelope.reading.ToJSON()
+        envelopes.append(envelope)
+    return envelopes
+
+@pytest.fixture
+def suppressor(config):
+    def create(mode):
+        config.app_config['suppress']['mode'] = mode
+        return Suppressor(config)
+    return create
+
+def test_uncommitted_keyframe_is_never_a_base(suppressor):
+    delta = suppressor('delta')
+    first = Readings(4, seed = 1)
+    delta.apply(first)
+    assert first[0].base == None and first[1].base == first[0]._id
+    # The batch was not stored, its keyframe must not be the base of the next one
+    second = Readings(4, seed = 2)
+    delta.commit(delta.apply(second))
+    assert second[0].base == None
+    assert all(envelope.base == second[0]._id for envelope in second[1:])
+    assert delta.stats()['suppress_keyframes'] == 1
+
+def test_retry_after_failure_decides_the_same(suppressor):
+    drop = suppressor('drop')
+    batch = Readings(6, repeat = 3)
+    drop.apply(batch)
+    first = [envelope.suppressed for envelope in batch]
+    assert first == [False, True, True, False, True, True]
+    for envelope in batch:
+        envelope.suppressed = False
+    drop.commit(drop.apply(batch))
+    assert [envelope.suppressed for envelope in batch] == first
+
+def test_insert_failure_keeps_deltas_reconstructable(config, mongomock_connect, monkeypatch):
+    import mongo
+    from layouts import CreateLayout
+    from mongoengine.connection import get_db
+    config.app_config['suppress'].update(mode = 'delta', keyframe_seconds = 900)
+    engine = mongo.MongoEngine(config)
+    try:
+        batches = [Readings(4, seed = 1), Readings(4, seed = 2, start = datetime(2026, 1, 1, 0, 1))]
+        insert = engine.backend.insert
+        def failing(batch, decoded):
+            raise RuntimeError("insert failed")
+        monkeypatch.setattr(engine.backend, 'insert', failing)
+        engine._flush(batches[0])
+        monkeypatch.setattr(engine.backend, 'insert', insert)
+        engine._flush(batches[1])
+    finally:
+        engine.stop()
+
+    layout = CreateLayout(get_db(), config)
+    documents = list(layout.collection.find({'signature': 'meter'}).sort('createdAt', 1))
+    assert len(documents) == 4
+    readings = list(Reconstruct(iter(documents), layout.collection))
+    assert all('base' not in reading for reading in readings)
+    assert [reading['p1_decoded'] for reading in readings] == [envelope.p1_decoded for envelope in batches[1]]
+
+def test_reconstruct_keeps_base_of_lost_keyframe():
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient().db.readings
+    documents = [{'_id': 2, 'signature': 'meter', 'createdAt': datetime(2026, 1, 1), 'base': 1, 'p1_decoded': {'t': 2}}]
+    readings = list(Reconstruct(iter(documents), collection, 'compact'))
+    assert readings == [{'_id': 2, 'signature': 'meter', 'createdAt': datetime(2026, 1, 1), 'base': 1, 'p1_decoded': {'t': 2}}]